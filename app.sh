@@ -6,8 +6,5 @@ mkdir -p archive
 # remove database
 # rm database.db
 
-# unzip the file
-unzip -o data.zip
-
-# running scripts
-python main.py
\ No newline at end of file
+# running scripts, the files are read from the archive without unpacking
+python main.py --backfill --source data.zip
\ No newline at end of file
@@ -1,16 +1,18 @@
 # Import dependencies
+import argparse
 import sqlite3
 import sys
 import py_scripts as ps
 
 
-# connect to default database.db
-with sqlite3.connect("database.db") as conn:
+# connect to default database.db,
+# transactions are opened by ps.transaction instead of the driver
+with sqlite3.connect("database.db", isolation_level=None) as conn:
     # establish connection
     cursor = conn.cursor()
 
 
-def get_date():
+def get_date(source: str = "./"):
     """
     Get date
     """
@@ -19,7 +21,7 @@ def get_date():
     date = ''
 
     # date
-    date = ps.get_date_default(date)
+    date = ps.get_date_default(date, source)
 
     # if date not extracted
     if date is None:
@@ -29,53 +31,194 @@ def get_date():
         return date
 
 
-def execute_etl():
+def get_dates(source: str = "./"):
     """
-    - EXTRACTION, TRANSFORMATIONS and LOADING
+    Get all pending dates in chronological order
     """
 
-    try:
-        # clear data from STG
-        ps.load_sql_db("etl_stg_drop")
-        print('drop STG tables: ok')
+    dates = ps.get_dates_default(source)
+
+    # if dates not extracted
+    if not dates:
+        print("files not found")
+        sys.exit()
+    else:
+        return dates
+
+
+def execute_etl_day(date: str, source: str = "./", reference: bool = True, check_plans: bool = False,
+                    detector: str = "sql"):
+    """
+    - EXTRACTION, TRANSFORMATIONS and LOADING of one day
+    - Runs in the transaction of the caller, every stage has its own savepoint
+      and connection profile
+    - source: folder or zip archive with the daily files
+    - reference: load the snapshot of cards, accounts and clients
+    - check_plans: report the statements of the day with full scans
+    - detector: fraud detector of the data mart, one of ps.DETECTORS
+    - Returns the number of such statements
+    """
 
-        # date
-        date = get_date()
-        print(f"date: {date}")
+    print(f"date: {date}")
 
-        # creates each table
-        ps.load_sql_db("etl_schema")
-        print("creates DWH tables: ok")
+    ps.use_profile("bulk_load")
 
+    try:
         # extraction and transformation
-        ps.extraction_transformation_data(date)
+        with ps.savepoint("extraction"):
+            full_snapshot = ps.extraction_transformation_data(date, source, reference=reference)
     except (FileNotFoundError, BaseException) as e:
         print(e)
         sys.exit()
 
     print("extraction(finding data) and transformation: ok")
 
-    ps.load_dim_fact_tables()
+    with ps.savepoint("loading"):
+        ps.load_dim_fact_tables(full_snapshot)
     print("loading tables: ok")
 
-    ps.build_data_mart(date)
+    with ps.savepoint("manifest"):
+        ps.complete_manifest()
+    print("update manifest: ok")
+
+    ps.use_profile("detection")
+
+    with ps.savepoint("data_mart"):
+        ps.build_data_mart(date, detector)
     print("build report: ok")
 
-    ps.update_metadata()
+    ps.use_profile("bulk_load")
+
+    with ps.savepoint("metadata"):
+        ps.update_metadata()
     print("update metadata: ok")
 
+    ps.use_profile("report")
+
     print("report info:")
     ps.show_table("REP_FRAUD")
 
     # check the tables
     # ps.show_all_tables()
 
+    # the plans are explained while STG tables still exist
+    full_scans = ps.report_full_scans() if check_plans else 0
+    if check_plans:
+        print(f"check query plans: {full_scans} statements with full scans")
+
+    ps.use_profile("bulk_load")
+
     # clear data
-    ps.load_sql_db("etl_stg_drop")
+    with ps.savepoint("stg_drop"):
+        ps.load_sql_db("etl_stg_drop")
+
+    return full_scans
+
+
+def execute_etl(backfill: bool = False, source: str = "./", check_plans: bool = False, keep_months: int = None,
+                detector: str = "sql"):
+    """
+    - EXTRACTION, TRANSFORMATIONS and LOADING
+    - backfill: process every pending date in one run, the connection,
+      the schema and the snapshot of cards, accounts and clients are shared by the days
+    - source: folder or zip archive with the daily files,
+      the archive is read without unpacking and is always processed in full
+    - check_plans: explain every statement and exit with an error if any of them
+      repeats a full scan inside a join or a correlated subquery or scans the history
+    - Every day is loaded in one transaction, the files of the day are moved
+      to the backup folder after it is committed
+    - keep_months: number of the last monthly partitions of DWH_FACT_TRANSACTIONS
+      kept in the database, the older ones are moved to the backup folder
+    - detector: fraud detector of the data mart, one of ps.DETECTORS
+    """
+
+    if check_plans:
+        ps.start_plan_check()
+
+    # pragmas that can not be changed inside the transactions of the days
+    ps.use_profile("bulk_load")
+
+    # the archive is moved to the backup folder after the run, so all its dates are processed
+    archive = ps.is_archive(source)
+    backfill = backfill or archive
+
+    try:
+        with ps.transaction():
+            # clear data from STG
+            ps.load_sql_db("etl_ref_drop")
+            ps.load_sql_db("etl_stg_drop")
+            print('drop STG tables: ok')
+
+            # dates
+            dates = get_dates(source) if backfill else [get_date(source)]
+            print(f"dates: {', '.join(dates)}")
+
+            # creates each table
+            ps.migrate_schema()
+            ps.load_sql_db("etl_schema")
+            print("creates DWH tables: ok")
+    except (FileNotFoundError, BaseException) as e:
+        print(e)
+        sys.exit()
+
+    full_scans = 0
+
+    for number, date in enumerate(dates):
+        with ps.transaction():
+            if number > 0:
+                # STG tables were dropped by the previous day
+                ps.load_sql_db("etl_schema")
+
+            # the snapshot is loaded by the first day only
+            full_scans += execute_etl_day(date, source, number == 0, check_plans, detector)
+
+        ps.make_backup_all_files(date, source)
+        print('backup files: ok')
+
+    # clear data
+    with ps.transaction():
+        ps.load_sql_db("etl_ref_drop")
+
+    if keep_months:
+        for file in ps.archive_partitions(keep_months):
+            print(f"archive partition: {file}")
+
+    if archive:
+        ps.make_backup_archive(source)
+        print('backup archive: ok')
 
-    ps.make_backup_all_files(date)
-    print('backup files: ok')
+    if full_scans:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
-    execute_etl()
+    parser = argparse.ArgumentParser(description="ETL for fraud detection")
+    parser.add_argument(
+        "--backfill",
+        action="store_true",
+        help="process all pending dates in chronological order"
+    )
+    parser.add_argument(
+        "--source",
+        default="./",
+        help="folder or zip archive with the daily files"
+    )
+    parser.add_argument(
+        "--check-plans",
+        action="store_true",
+        help="fail if a statement repeats a full table scan or scans the history"
+    )
+    parser.add_argument(
+        "--keep-months",
+        type=int,
+        help="move the monthly partitions of transactions older than the last N to the backup folder"
+    )
+    parser.add_argument(
+        "--detector",
+        choices=ps.DETECTORS,
+        default="sql",
+        help="fraud detector: sql rules, the streaming detector or the sql rules evaluated by pandas"
+    )
+    args = parser.parse_args()
+
+    execute_etl(args.backfill, args.source, args.check_plans, args.keep_months, args.detector)
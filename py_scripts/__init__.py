@@ -1,7 +1,11 @@
 from .etl_extraction_transformation_data import load_sql_db, extraction_transformation_data
 from .etl_load_db import load_dim_fact_tables
-from .etl_data_mart import build_data_mart
-from .etl_metadata import update_metadata
-from .etl_tools import get_date_default, show_table, show_all_tables, make_backup_all_files
+from .etl_data_mart import build_data_mart, DETECTORS
+from .etl_metadata import update_metadata, complete_manifest
+from .etl_tools import get_date_default, get_dates_default, show_table, show_all_tables, make_backup_all_files
+from .etl_tools import is_archive, make_backup_archive, start_plan_check, report_full_scans, migrate_schema
+from .etl_scheduler import transaction, savepoint
+from .etl_profiles import use_profile
+from .etl_partitions import archive_partitions
 
 NAME = "py_scripts"
@@ -0,0 +1,169 @@
+# Importing dependencies
+import re
+import sqlite3
+import pandas as pd
+from main import cursor
+
+# BULK LOADING into staging tables
+
+# number of rows sent to one executemany call when a sql dump is loaded
+DUMP_BATCH_SIZE = 10_000
+
+# insert into table (col, ...) values (...);
+INSERT_PATTERN = re.compile(
+    r"\s*insert\s+into\s+(\w+)\s*\(([^)]*)\)\s*values\s*\((.*)\)\s*;\s*$",
+    re.IGNORECASE | re.DOTALL
+)
+
+# literals of the values list: 'text', null, numbers
+VALUE_PATTERN = re.compile(r"\s*(?:'((?:[^']|'')*)'|(null)|([-+]?\d+(?:\.\d*)?))\s*(?:,|$)", re.IGNORECASE)
+
+
+def as_rows(batch, columns: list):
+    """
+    - Iterate over a batch as tuples of values in the order of columns
+    - batch: pandas DataFrame, Arrow RecordBatch/Table or iterable of tuples
+    """
+
+    # pandas DataFrame
+    if isinstance(batch, pd.DataFrame):
+        batch = batch[columns]
+
+        # sqlite does not accept pandas timestamps
+        for column in batch.select_dtypes(include="datetime").columns:
+            batch = batch.assign(**{column: batch[column].dt.strftime("%Y-%m-%d %H:%M:%S")})
+
+        return zip(*(batch[column].tolist() for column in columns))
+
+    # Arrow RecordBatch or Table
+    if hasattr(batch, "column_names"):
+        return zip(*(batch.column(column).to_pylist() for column in columns))
+
+    # tuples
+    return batch
+
+
+def bulk_insert(table_name: str, columns: list, batch) -> int:
+    """
+    - Insert a batch into a table with one prepared statement
+    - Returns the number of inserted rows
+    """
+
+    placeholders = ", ".join("?" * len(columns))
+
+    cursor.executemany(
+        f"INSERT INTO {table_name} ({', '.join(columns)}) VALUES ({placeholders})",
+        as_rows(batch, columns)
+    )
+
+    return cursor.rowcount
+
+
+def load_staging(table_name: str, columns: list, batches) -> int:
+    """
+    - Load batches into a pre-created staging table
+    - The table is cleared and loaded in the transaction of the caller
+    - Returns the number of loaded rows
+    """
+
+    rows = 0
+
+    # clear staging table
+    cursor.execute(f"DELETE FROM {table_name}")
+
+    for batch in batches:
+        rows += bulk_insert(table_name, columns, batch)
+
+    return rows
+
+
+def parse_values(values: str):
+    """
+    - Parse the values list of an insert statement into a tuple
+    - Returns None if the list contains anything but literals
+    """
+
+    row = []
+    position = 0
+
+    while position < len(values):
+        match = VALUE_PATTERN.match(values, position)
+        if match is None or match.end() == position:
+            return None
+
+        text, null, number = match.groups()
+        if text is not None:
+            row.append(text.replace("''", "'"))
+        elif null is not None:
+            row.append(None)
+        else:
+            row.append(float(number) if "." in number else int(number))
+
+        position = match.end()
+
+    return tuple(row)
+
+
+def read_sql_statements(file: str):
+    """
+    - Read a sql file statement by statement, the file is never loaded at once
+    """
+
+    statement = ""
+
+    with open(file, "r", encoding="utf-8") as f:
+        for line in f:
+            statement += line
+            if sqlite3.complete_statement(statement):
+                yield statement
+                statement = ""
+
+    if statement.strip():
+        yield statement
+
+
+def load_sql_dump(file: str) -> int:
+    """
+    - Load a sql dump of 'create table' and 'insert into ... values' statements
+    - The inserts of one table are parsed into tuples and sent with prepared executemany
+      instead of parsing every statement in sqlite
+    - Everything is loaded in the transaction of the caller
+    - Returns the number of inserted rows
+    """
+
+    rows = 0
+
+    # inserts waiting for executemany: (table, columns) -> tuples
+    target, batch = None, []
+
+    def flush():
+        nonlocal rows, batch
+        if batch:
+            rows += bulk_insert(target[0], target[1], batch)
+            batch = []
+
+    for statement in read_sql_statements(file):
+        match = INSERT_PATTERN.match(statement)
+        row = parse_values(match.group(3)) if match else None
+
+        # anything but a plain insert of literals is executed as it is
+        if row is None:
+            flush()
+            cursor.execute(statement)
+            continue
+
+        columns = [column.strip() for column in match.group(2).split(",")]
+        if len(row) != len(columns):
+            flush()
+            cursor.execute(statement)
+            continue
+
+        if target != (match.group(1), columns) or len(batch) >= DUMP_BATCH_SIZE:
+            flush()
+            target = (match.group(1), columns)
+
+        batch.append(row)
+
+    flush()
+
+    return rows
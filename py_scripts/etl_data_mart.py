@@ -1,13 +1,197 @@
 # Importing dependencies
 import datetime
-from main import conn, cursor
+from main import cursor
+from .etl_load_db import MAX_DATE
+from .etl_metadata import get_watermark, update_watermark
+from .etl_partitions import PARTITION_COLUMNS, PARTITION_PREFIX, list_partitions
+from .etl_stream import detection_stream_fraud
+from .etl_tools import untraced
+from .etl_vectorized import detection_vectorized_fraud
 
 # DATA MART
 
+# META_WATERMARK of the detection: the last date evaluated by build_data_mart
+DETECTION_WATERMARK = "REP_FRAUD"
+
+# another city is searched in the last 3600 seconds before a transaction
+CITY_LOOKBACK = 3600
+
+# sum up fraud: a successful operation after SUM_UP_CHAIN rejected operations with decreasing amounts,
+# the first of them at most SUM_UP_WINDOW seconds before the successful one
+SUM_UP_CHAIN = 3
+SUM_UP_WINDOW = 1200
+
+# detectors of build_data_mart:
+# - sql: the rules of this module over STG_DETECTION_TRANSACTIONS
+# - stream: the streaming detector of etl_stream, one state per card, the same events as sql
+# - vectorized: the rules of this module evaluated by pandas in etl_vectorized, the same events as sql
+DETECTORS = ("sql", "stream", "vectorized")
+
+
+def create_detection_scope(date: str, lookback: int = CITY_LOOKBACK, window: int = SUM_UP_WINDOW):
+    """
+    - Create staging tables of the transactions evaluated by the rules:
+    - STG_DETECTION_CARDS: the cards of the new transactions and the changed cards,
+      trans_from is the first new transaction of a card, city_from and sum_up_from
+      are the first transactions of a card searched by the different city and the sum up rules
+    - lookback, window: the city lookback of detection_different_city_fraud
+      and the sum up window of detection_sum_up_fraud
+    - STG_DETECTION_HISTORY: the transactions of the cards from city_from or sum_up_from,
+      the partitions of the months before the first of them are not read
+    - STG_DETECTION_TRANSACTIONS: the new transactions and all transactions of the changed cards
+    - A card is changed if it was loaded into DWH_CARD_ENRICHMENT again, its passport was blacklisted
+      or its passport or account expired since the last evaluated date,
+      the old transactions of a changed card get events with the new attributes
+    - The whole history is evaluated by the first run and by a date that is not after the last evaluated one
+    """
+
+    # convert date to format '%Y-%m-%d'
+    date = datetime.datetime.strptime(date, "%d%m%Y").date().isoformat()
+
+    watermark = get_watermark(DETECTION_WATERMARK)
+
+    cursor.execute("DROP TABLE IF EXISTS STG_DETECTION_CARDS")
+
+    cursor.execute(
+        f"""
+        CREATE TABLE STG_DETECTION_CARDS
+        AS
+        SELECT
+            card_num,
+            CASE
+                WHEN MAX(changed_flg) = 1 THEN ''
+                ELSE MIN(first_date)
+            END AS trans_from,
+            CASE
+                WHEN MAX(changed_flg) = 1 THEN ''
+                ELSE DATETIME(MIN(first_date), '-{lookback} seconds')
+            END AS city_from,
+            CASE
+                WHEN MAX(changed_flg) = 1 THEN ''
+                ELSE DATETIME(MIN(first_date), '-{window} seconds')
+            END AS sum_up_from,
+            MAX(changed_flg) AS changed_flg
+        FROM (
+            SELECT
+                card_num,
+                trans_date AS first_date,
+                0 AS changed_flg
+            FROM
+                STG_TRANSACTIONS
+            UNION ALL
+            SELECT
+                card_num,
+                NULL,
+                1
+            FROM
+                STG_CARD_ENRICHMENT
+            UNION ALL
+            SELECT
+                card_num,
+                NULL,
+                1
+            FROM
+                DWH_CARD_ENRICHMENT
+            WHERE
+                passport_valid_to > :watermark AND :date >= passport_valid_to
+                OR account_valid_to > :watermark AND :date >= account_valid_to
+                OR passport_num IN (
+                    SELECT
+                        passport_num
+                    FROM
+                        STG_PASSPORT_BLACKLIST
+                    WHERE
+                        entry_dt > :watermark
+                )
+        )
+        WHERE
+            card_num IS NOT NULL
+        GROUP BY
+            card_num
+    """,
+        {"date": date, "watermark": watermark or ""}
+    )
+
+    cursor.execute("CREATE UNIQUE INDEX STG_DETECTION_CARDS_CARD_NUM_IDX ON STG_DETECTION_CARDS (card_num)")
+
+    # every card is changed, the whole history is read by design
+    if watermark is None or date <= watermark:
+        with untraced():
+            cursor.execute(
+                """
+                INSERT OR REPLACE INTO STG_DETECTION_CARDS
+                SELECT DISTINCT
+                    card_num,
+                    '',
+                    '',
+                    '',
+                    1
+                FROM
+                    DWH_FACT_TRANSACTIONS
+                WHERE
+                    card_num IS NOT NULL
+            """
+            )
+
+    cursor.execute("DROP TABLE IF EXISTS STG_DETECTION_HISTORY")
+
+    cursor.execute(f"CREATE TABLE STG_DETECTION_HISTORY ({PARTITION_COLUMNS})")
+
+    # the month of the first searched transaction, a changed card is searched in every month
+    cursor.execute("SELECT COALESCE(STRFTIME('%Y%m', MIN(MIN(city_from, sum_up_from))), '') FROM STG_DETECTION_CARDS")
+    first_month = cursor.fetchone()[0]
+
+    # partition by partition: sqlite reorders the joins with the view, the cards are the outer loop
+    # and every card is a search of the index (card_num, trans_date) of the partition
+    for name in list_partitions():
+        if name[len(PARTITION_PREFIX):] < first_month:
+            continue
+
+        cursor.execute(
+            f"""
+            INSERT INTO STG_DETECTION_HISTORY
+            SELECT
+                t1.*
+            FROM
+                STG_DETECTION_CARDS t0
+                CROSS JOIN {name} t1 ON t0.card_num = t1.card_num
+                AND t1.trans_date >= MIN(t0.city_from, t0.sum_up_from)
+        """
+        )
+
+    cursor.execute(
+        "CREATE INDEX STG_DETECTION_HISTORY_CARD_NUM_IDX ON STG_DETECTION_HISTORY (card_num, trans_date)"
+    )
+
+    cursor.execute("DROP TABLE IF EXISTS STG_DETECTION_TRANSACTIONS")
+
+    # a transaction repeated in the file is evaluated once
+    cursor.execute(
+        """
+        CREATE TABLE STG_DETECTION_TRANSACTIONS
+        AS
+        SELECT
+            t2.*
+        FROM
+            STG_DETECTION_CARDS t1
+            INNER JOIN STG_DETECTION_HISTORY t2 ON t1.card_num = t2.card_num
+        WHERE
+            t1.changed_flg = 1
+            OR t2.trans_date >= t1.trans_from
+            AND t2.trans_id IN (
+                SELECT
+                    trans_id
+                FROM
+                    STG_TRANSACTIONS
+            )
+    """
+    )
+
 
 def detection_passport_fraud(date: str):
     """
     - Searching passport fraud
+    - Passport, fio and phone are the current attributes of the card in DWH_CARD_ENRICHMENT
     """
 
     # convert date to format '%Y-%m-%d'
@@ -23,20 +207,18 @@ def detection_passport_fraud(date: str):
             event_type,
             report_dt
         ) SELECT
-            t4.trans_date AS event_dt,
-            t1.passport_num AS passport,
-            t1.last_name || ' ' || t1.first_name || ' ' || t1.patronymic AS fio,
-            t1.phone,
+            t1.trans_date AS event_dt,
+            t2.passport_num AS passport,
+            t2.fio,
+            t2.phone,
             1 AS event_type,
             DATETIME('now') AS report_dt
         FROM
-            DWH_DIM_CLIENTS t1
-            INNER JOIN DWH_DIM_ACCOUNTS_HIST t2 ON t1.client_id = t2.client
-            INNER JOIN DWH_DIM_CARDS_HIST t3 ON t2.account_num = t3.account_num
-            INNER JOIN DWH_FACT_TRANSACTIONS t4 ON t3.card_num = t4.card_num
+            STG_DETECTION_TRANSACTIONS t1
+            INNER JOIN DWH_CARD_ENRICHMENT t2 ON t1.card_num = t2.card_num
         WHERE
-            ? >= t1.passport_valid_to
-            OR t1.passport_num IN (
+            ? >= t2.passport_valid_to
+            OR t2.passport_num IN (
                 SELECT
                     passport_num
                 FROM
@@ -46,13 +228,11 @@ def detection_passport_fraud(date: str):
         [date]
     )
 
-    # saves all the modifications
-    conn.commit()
-
 
 def detection_account_fraud(date: str):
     """
-    - Searching account fraud
+    - Searching account fraud: the current account of the card in DWH_CARD_ENRICHMENT
+    - An account without transactions has no event
     """
 
     # convert date to format '%Y-%m-%d'
@@ -68,69 +248,76 @@ def detection_account_fraud(date: str):
             event_type,
             report_dt
         ) SELECT
-            t4.trans_date AS event_dt,
-            t1.passport_num,
-            t1.last_name || ' ' || t1.first_name || ' ' || t1.patronymic AS fio,
-            t1.phone,
+            t1.trans_date AS event_dt,
+            t2.passport_num,
+            t2.fio,
+            t2.phone,
             2 AS event_type,
             DATETIME('now')
         FROM
-            DWH_DIM_CLIENTS t1
-            LEFT JOIN DWH_DIM_ACCOUNTS_HIST t2 ON t1.client_id = t2.client
-            LEFT JOIN DWH_DIM_CARDS_HIST t3 ON t2.account_num = t3.account_num
-            LEFT JOIN DWH_FACT_TRANSACTIONS t4 ON t3.card_num = t4.card_num
+            STG_DETECTION_TRANSACTIONS t1
+            INNER JOIN DWH_CARD_ENRICHMENT t2 ON t1.card_num = t2.card_num
         WHERE
-            ? >= t2.valid_to
+            ? >= t2.account_valid_to
     """,
         [date]
     )
 
-    # saves all the modifications
-    conn.commit()
-
 
-def detection_different_city_fraud():
+def detection_different_city_fraud(lookback: int = CITY_LOOKBACK):
     """
-    - Searching different city fraud
+    - Searching different city fraud: a transaction is fraud if the card had a transaction
+      in another city in the last lookback seconds, one event per transaction
+    - The transactions of a card in time order are split into runs of the same city,
+      the last transaction in another city is the last transaction of the previous run:
+      one sort and two window functions instead of a search in the window of every transaction
+    - A card is read from city_from of create_detection_scope with the same lookback,
+      the city is the city of the current version of the terminal
+    - The transactions from trans_from are evaluated: a new transaction changes the events
+      of the transactions after it
     """
 
+    cursor.execute("DROP VIEW IF EXISTS STG_DETECTION_FRAUD_DIFFERENT_CITY")
+
     cursor.execute(
-        """
-        CREATE VIEW IF NOT EXISTS STG_DETECTION_FRAUD_DIFFERENT_CITY
+        f"""
+        CREATE VIEW STG_DETECTION_FRAUD_DIFFERENT_CITY
         AS
         SELECT
-            t1.card_num,
-            t1.trans_date AS current_city_date,
-            t2.terminal_city AS current_city,
-            LEAD(t2.terminal_city) OVER(
-                PARTITION BY t1.card_num
-                ORDER BY t1.trans_date
-            ) AS different_city,
-            LEAD(t1.trans_date) OVER(
-                PARTITION BY t1.card_num
-                ORDER BY t1.trans_date
+            card_num,
+            trans_date,
+            trans_from,
+            MAX(different_city_date) OVER (
+                PARTITION BY card_num
+                ORDER BY trans_date, trans_id
+                ROWS UNBOUNDED PRECEDING
             ) AS different_city_date
-        FROM
-            DWH_FACT_TRANSACTIONS t1
-            INNER JOIN DWH_DIM_TERMINALS_HIST t2 ON t1.terminal = t2.terminal_id
-        WHERE
-            t1.card_num IN (
-                SELECT
-                    t1.card_num
-                FROM
-                    DWH_FACT_TRANSACTIONS t1
-                    INNER JOIN DWH_DIM_TERMINALS_HIST t2 ON t1.terminal = t2.terminal_id
-                GROUP BY
-                    t1.card_num
-                HAVING
-                    COUNT(DISTINCT t2.terminal_city) > 1
+        FROM (
+            SELECT
+                t1.card_num,
+                t1.trans_id,
+                t1.trans_date,
+                t0.trans_from,
+                CASE
+                    WHEN t2.terminal_city <> LAG(t2.terminal_city) OVER card_time
+                    THEN LAG(t1.trans_date) OVER card_time
+                END AS different_city_date
+            FROM
+                STG_DETECTION_CARDS t0
+                INNER JOIN STG_DETECTION_HISTORY t1 ON t0.card_num = t1.card_num
+                AND t1.trans_date >= t0.city_from
+                INNER JOIN DWH_DIM_TERMINALS_HIST t2 ON t1.terminal = t2.terminal_id
+                AND t2.effective_to = {MAX_DATE}
+            WINDOW card_time AS (
+                PARTITION BY t1.card_num
+                ORDER BY t1.trans_date, t1.trans_id
             )
+        )
         """
     )
 
-    # 3600 seconds = 60 minutes
     cursor.execute(
-        """
+        f"""
         INSERT INTO STG_REP_FRAUD (
             event_dt,
             passport,
@@ -139,79 +326,89 @@ def detection_different_city_fraud():
             event_type,
             report_dt
         ) SELECT
-            MIN(t1.different_city_date) AS event_dt,
-            t4.passport_num AS passport,
-            t4.last_name || ' ' || t4.first_name || ' ' || t4.patronymic AS fio,
-            t4.phone,
+            t1.trans_date AS event_dt,
+            t2.passport_num AS passport,
+            t2.fio,
+            t2.phone,
             3 AS event_type,
             DATETIME('now')
         FROM
             STG_DETECTION_FRAUD_DIFFERENT_CITY t1
-            INNER JOIN DWH_DIM_CARDS_HIST t2 ON t1.card_num = t2.card_num
-            INNER JOIN DWH_DIM_ACCOUNTS_HIST t3 ON t2.account_num = t3.account_num
-            INNER JOIN DWH_DIM_CLIENTS_HIST t4 ON t3.client = t4.client_id
+            INNER JOIN DWH_CARD_ENRICHMENT t2 ON t1.card_num = t2.card_num
         WHERE
-            STRFTIME('%s', t1.current_city_date) - STRFTIME('%s', t1.different_city_date) <= 3600
-        GROUP BY
-            t1.card_num
+            t1.trans_date >= t1.trans_from
+            AND STRFTIME('%s', t1.trans_date) - STRFTIME('%s', t1.different_city_date) <= {lookback}
         """
     )
 
-    # saves all the modifications
-    conn.commit()
-
 
-def detection_sum_up_fraud():
+def detection_sum_up_fraud(chain: int = SUM_UP_CHAIN, window: int = SUM_UP_WINDOW):
     """
-    - Searching sum up fraud
+    - Searching sum up fraud: a successful operation with an amount less than the previous one,
+      the previous chain operations are rejected with decreasing amounts within window seconds
+    - The transactions of a card in time order are split into runs of rejected operations
+      with decreasing amounts: a rejected operation less than the previous rejected one continues the run,
+      chain_length is the length of the run before the operation,
+      the same window functions are used for a chain of any length
+    - A chain of a new transaction starts at most window seconds before it,
+      so a card is read from sum_up_from of create_detection_scope with the same window,
+      the transactions from trans_from are evaluated
+    - The view is created again: chain is a part of it
     """
 
+    cursor.execute("DROP VIEW IF EXISTS STG_DETECTION_FRAUD_SUM_UP")
+
     cursor.execute(
-        """
-        CREATE VIEW IF NOT EXISTS STG_DETECTION_FRAUD_SUM_UP
+        f"""
+        CREATE VIEW STG_DETECTION_FRAUD_SUM_UP
         AS
         SELECT
             card_num,
             trans_date,
-            oper_type,
+            trans_from,
             oper_result,
             amt,
-            LAG(oper_result, 1) OVER (
-                PARTITION BY card_num
-                ORDER BY trans_date
-            ) AS previous_oper_result_1,
-            LAG(amt, 1) OVER (
-                PARTITION BY card_num
-                ORDER BY trans_date
-            ) AS previous_amt_1,
-            LAG(oper_result, 2) OVER (
-                PARTITION BY card_num
-                ORDER BY trans_date
-            ) AS previous_oper_result_2,
-            LAG(amt, 2) OVER (
+            previous_oper_result,
+            previous_amt,
+            chain_date,
+            row_number - MAX(run_start) OVER (
                 PARTITION BY card_num
-                ORDER BY trans_date
-            ) AS previous_amt_2,
-            LAG(oper_result, 3) OVER (
-                PARTITION BY card_num
-                ORDER BY trans_date
-            ) AS previous_oper_result_3,
-            LAG(amt, 3) OVER (
-                PARTITION BY card_num
-                ORDER BY trans_date
-            ) AS previous_amt_3,
-            LAG(trans_date, 3) OVER (
-                PARTITION BY card_num
-                ORDER BY trans_date
-            ) AS previous_date_3
-        FROM
-            DWH_FACT_TRANSACTIONS
+                ORDER BY trans_date, trans_id
+                ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING
+            ) AS chain_length
+        FROM (
+            SELECT
+                t1.card_num,
+                t1.trans_id,
+                t1.trans_date,
+                t0.trans_from,
+                t1.oper_result,
+                t1.amt,
+                LAG(t1.oper_result) OVER card_time AS previous_oper_result,
+                LAG(t1.amt) OVER card_time AS previous_amt,
+                LAG(t1.trans_date, {chain}) OVER card_time AS chain_date,
+                ROW_NUMBER() OVER card_time AS row_number,
+                CASE
+                    WHEN t1.oper_result = 'REJECT'
+                        AND LAG(t1.oper_result) OVER card_time = 'REJECT'
+                        AND t1.amt < LAG(t1.amt) OVER card_time
+                    THEN NULL
+                    ELSE ROW_NUMBER() OVER card_time
+                END AS run_start
+            FROM
+                STG_DETECTION_CARDS t0
+                INNER JOIN STG_DETECTION_HISTORY t1 ON t0.card_num = t1.card_num
+                AND t1.trans_date >= t0.sum_up_from
+            WINDOW card_time AS (
+                PARTITION BY t1.card_num
+                ORDER BY t1.trans_date, t1.trans_id
+            )
+        )
         """
     )
 
-    # 1200 seconds = 20 minutes
     cursor.execute(
-        """
+        f"""
         INSERT INTO STG_REP_FRAUD (
             event_dt,
             passport,
@@ -221,29 +418,24 @@ def detection_sum_up_fraud():
             report_dt
         ) SELECT
             t1.trans_date AS event_dt,
-            t4.passport_num AS passport,
-            t4.last_name || ' ' || t4.first_name || ' ' || t4.patronymic AS fio,
-            t4.phone,
+            t2.passport_num AS passport,
+            t2.fio,
+            t2.phone,
             4 AS event_type,
             DATETIME('now')
         FROM
             STG_DETECTION_FRAUD_SUM_UP t1
-            LEFT JOIN DWH_DIM_CARDS_HIST t2 ON t1.card_num = t2.card_num
-            LEFT JOIN DWH_DIM_ACCOUNTS_HIST t3 ON t2.account_num = t3.account_num
-            LEFT JOIN DWH_DIM_CLIENTS_HIST t4 ON t3.client = t4.client_id
+            LEFT JOIN DWH_CARD_ENRICHMENT t2 ON t1.card_num = t2.card_num
         WHERE
-            t1.oper_result = 'SUCCESS'
-            AND t1.previous_oper_result_1 = 'REJECT'
-            AND t1.previous_oper_result_2 = 'REJECT'
-            AND t1.previous_oper_result_3 = 'REJECT'
-            AND t1.amt < t1.previous_amt_3 < t1.previous_amt_2 < t1.previous_amt_1
-            AND STRFTIME('%s', t1.trans_date) - STRFTIME('%s', t1.previous_date_3) <= 1200
+            t1.trans_date >= t1.trans_from
+            AND t1.oper_result = 'SUCCESS'
+            AND t1.previous_oper_result = 'REJECT'
+            AND t1.amt < t1.previous_amt
+            AND t1.chain_length >= {chain}
+            AND STRFTIME('%s', t1.trans_date) - STRFTIME('%s', t1.chain_date) <= {window}
         """
     )
 
-    # saves all the modifications
-    conn.commit()
-
 
 def not_allow_duplicate():
     """
@@ -271,7 +463,7 @@ def not_allow_duplicate():
         WHERE
             NOT EXISTS (
                 SELECT
-                    event_dt
+                    event_dt,
                     passport,
                     fio,
                     phone,
@@ -283,13 +475,13 @@ def not_allow_duplicate():
                     AND t2.passport = t1.passport
                     AND t2.fio = t1.fio
                     AND t2.phone = t1.phone
-                    AND t2.event_type = t2.event_type
+                    AND t2.event_type = t1.event_type
         )
     """
     )
 
 
-def build_data_mart(date: str):
+def build_data_mart(date: str, detector: str = "sql"):
     """
     - Build a Data Mart
     Fraud detection:
@@ -297,19 +489,34 @@ def build_data_mart(date: str):
     - 2) account fraud
     - 3) different city fraud
     - 4) sum up fraud
+    - Only the new transactions, their lookback and the changed cards are evaluated
+    - detector: one of DETECTORS
     """
 
-    # searching passport fraud
-    detection_passport_fraud(date)
+    # transactions evaluated by the rules
+    create_detection_scope(date, CITY_LOOKBACK, SUM_UP_WINDOW)
 
-    # searching account fraud
-    detection_account_fraud(date)
+    if detector == "stream":
+        # searching all fraud types transaction by transaction
+        detection_stream_fraud(date, CITY_LOOKBACK, SUM_UP_CHAIN, SUM_UP_WINDOW)
+    elif detector == "vectorized":
+        # searching all fraud types with array operations
+        detection_vectorized_fraud(date, CITY_LOOKBACK, SUM_UP_CHAIN, SUM_UP_WINDOW)
+    else:
+        # searching passport fraud
+        detection_passport_fraud(date)
 
-    # searching different city fraud
-    detection_different_city_fraud()
+        # searching account fraud
+        detection_account_fraud(date)
 
-    # searching sum up fraud
-    detection_sum_up_fraud()
+        # searching different city fraud
+        detection_different_city_fraud(CITY_LOOKBACK)
+
+        # searching sum up fraud
+        detection_sum_up_fraud(SUM_UP_CHAIN, SUM_UP_WINDOW)
 
     # avoiding duplicates
     not_allow_duplicate()
+
+    # the next run evaluates the transactions loaded after this date
+    update_watermark(DETECTION_WATERMARK, datetime.datetime.strptime(date, "%d%m%Y").date().isoformat())
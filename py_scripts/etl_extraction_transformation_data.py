@@ -1,69 +1,213 @@
 # Importing dependencies
+import hashlib
+import io
 import os
 import sys
+from concurrent.futures import ProcessPoolExecutor
+import openpyxl
 import pandas as pd
-from main import conn, cursor
-from .etl_tools import find_file
+from main import cursor
+from .etl_tools import file_checksum, find_file, open_file
+from .etl_metadata import is_file_loaded, register_file
+from .etl_bulk_load import load_sql_dump, load_staging, read_sql_statements
 
 # EXTRACTION (Finding Data) and TRANSFORMATIONS
 
+# parsed xlsx files, named by the content hash of the file
+CACHE_DIR = "./cache"
+
+# number of rows read from the transactions file at a time
+CHUNK_SIZE = 100_000
+
+# types of columns in transactions file:
+# - integer ids
+# - numeric amounts (the file uses a decimal comma: 1046,40)
+# - categories for the repeated short strings
+# 'transaction_date' is parsed separately into datetime64 (epoch-based int64)
+TRANSACTIONS_DTYPES = {
+    "transaction_id": "int64",
+    "amount": "float64",
+    "card_num": "str",
+    "oper_type": "category",
+    "oper_result": "category",
+    "terminal": "category"
+}
+
+# order of columns in STG_TRANSACTIONS
+TRANSACTIONS_COLUMNS = ["trans_id", "trans_date", "card_num", "oper_type", "amt", "oper_result", "terminal"]
+
+# order of columns in STG_TERMINALS
+TERMINALS_COLUMNS = ["terminal_id", "terminal_type", "terminal_city", "terminal_address"]
+
+# order of columns in STG_PASSPORT_BLACKLIST
+PASSPORT_BLACKLIST_COLUMNS = ["passport_num", "entry_dt"]
+
+
+def read_xlsx(file: str) -> pd.DataFrame:
+    """
+    - Read the active sheet of a xlsx file with openpyxl in read-only (streaming) mode
+    - The parsed sheet is cached in CACHE_DIR by the content hash of the file,
+      so the same workbook is never parsed twice
+    - The file may be a member of a zip archive or compressed
+    """
+
+    # openpyxl needs a seekable file, workbooks are small enough to be kept in memory
+    with open_file(file) as f:
+        content = f.read()
+
+    cache = os.path.join(CACHE_DIR, f"{hashlib.sha256(content).hexdigest()}.pkl")
+
+    # the workbook was already parsed
+    if os.path.exists(cache):
+        return pd.read_pickle(cache)
+
+    workbook = openpyxl.load_workbook(io.BytesIO(content), read_only=True, data_only=True)
+
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        # first row is the header
+        df = pd.DataFrame(rows, columns=next(rows))
+    finally:
+        workbook.close()
+
+    # read-only mode may return trailing empty rows
+    df = df.dropna(how="all")
+
+    # write to a temporary file first, so a broken cache file never appears
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    df.to_pickle(f"{cache}.tmp")
+    os.replace(f"{cache}.tmp", cache)
+
+    return df
+
+
+def find_pending_file(cur_dir: str, filename: str, filename_extension: str, skip_loaded: bool = True):
+    """
+    - Search for an input file and check its content hash in the load manifest
+    - Returns (file, file_size, file_hash) or None if the same content was already loaded
+    - skip_loaded: full snapshots are merged every time, they are only registered in the manifest
+    """
+
+    file = find_file(cur_dir, filename, filename_extension)
+    if file is None:
+        raise FileNotFoundError(f"{filename}{filename_extension} not found in {cur_dir}")
+
+    file_size, file_hash = file_checksum(file)
+
+    if skip_loaded and is_file_loaded(file_hash):
+        return None
+
+    return file, file_size, file_hash
+
+
+def stage_file(table_name: str, columns: list, pending, batches) -> int:
+    """
+    - Load batches of a pending file into a staging table and register the file in the load manifest
+    - The staging table is left empty for an already loaded file (pending is None)
+    - Returns the number of loaded rows
+    """
+
+    if pending is None:
+        return load_staging(table_name, columns, [])
+
+    rows = load_staging(table_name, columns, batches)
+
+    register_file(*pending, rows)
+
+    return rows
+
+
+def parse_terminals(file: str) -> pd.DataFrame:
+    """
+    - Extraction data: terminals
+    - Does not touch the database, so it can run in a worker process
+    """
+
+    # read xlsx to dataframe
+    return read_xlsx(file)
+
 
 def extraction_terminals(date: str, cur_dir: str = "./"):
     """
     - Extraction data: terminals
     """
 
-    # the input file with variable date
-    df = find_file(cur_dir, f"terminals_{date}", ".xlsx")
+    # the input file with variable date, terminals are a full snapshot and always merged
+    pending = find_pending_file(cur_dir, f"terminals_{date}", ".xlsx", skip_loaded=False)
 
-    # read xlsx to dataframe
-    df = pd.read_excel(df)
+    df = parse_terminals(pending[0])
 
-    # use pandas to load xlsx converted to DF into database
-    df.to_sql("STG_TERMINALS", conn, if_exists="replace", index=False)
+    # bulk load xlsx converted to DF into database
+    stage_file("STG_TERMINALS", TERMINALS_COLUMNS, pending, [df])
 
     return df
 
 
-def extraction_transformation_transactions(date: str, cur_dir: str = "./"):
+def transformation_transactions(df: pd.DataFrame) -> pd.DataFrame:
     """
-    - Extraction data: transactions
     - Transformation data: transactions
     """
 
-    # the input file with variable date
-    file = find_file(cur_dir, f"transactions_{date}", ".txt")
-
-    # read txt to dataframe
-    df = pd.read_csv(file, sep=";", encoding="utf-8")
-
     # rename columns
-    df.rename(columns={
+    df = df.rename(columns={
         "transaction_id": "trans_id",
         "transaction_date": "trans_date",
         "amount": "amt"
-    }, inplace=True)
+    })
 
     # convert 'trans_date' column from string to date type for decrease size dataframe
     df["trans_date"] = pd.to_datetime(df.trans_date, format="%Y-%m-%d %H:%M:%S")
 
-    # use pandas to load txt converted to DF into database
-    df.to_sql("STG_TRANSACTIONS", conn, if_exists="replace", index=False)
-
     return df
 
 
-def extraction_transformation_passport_blacklist(date: str, cur_dir: str = "./"):
+def extraction_transformation_transactions(date: str, cur_dir: str = "./", chunk_size: int = CHUNK_SIZE):
     """
-    - Extraction data: passport_blacklist
-    - Transformation data: passport_blacklist
+    - Extraction data: transactions
+    - Transformation data: transactions
+    - The file is read by chunks of chunk_size rows, so memory does not depend on the file size
+    - Returns the number of loaded rows
     """
 
     # the input file with variable date
-    file = find_file(cur_dir, f"passport_blacklist_{date}", ".xlsx")
+    pending = find_pending_file(cur_dir, f"transactions_{date}", ".txt")
+
+    # the file was already loaded
+    if pending is None:
+        return stage_file("STG_TRANSACTIONS", TRANSACTIONS_COLUMNS, None, [])
+
+    # the file may be a member of a zip archive or compressed, it is never unpacked to the disk
+    with open_file(pending[0]) as f:
+        # read txt to dataframe by chunks
+        chunks = pd.read_csv(
+            f,
+            sep=";",
+            decimal=",",
+            dtype=TRANSACTIONS_DTYPES,
+            encoding="utf-8",
+            chunksize=chunk_size
+        )
+
+        # bulk load the chunks, all chunks are saved in one transaction
+        rows = stage_file(
+            "STG_TRANSACTIONS",
+            TRANSACTIONS_COLUMNS,
+            pending,
+            (transformation_transactions(df) for df in chunks)
+        )
+
+    return rows
+
+
+def parse_passport_blacklist(file: str) -> pd.DataFrame:
+    """
+    - Extraction data: passport_blacklist
+    - Transformation data: passport_blacklist
+    - Does not touch the database, so it can run in a worker process
+    """
 
     # read xlsx to dataframe
-    df = pd.read_excel(file)
+    df = read_xlsx(file)
 
     # rename columns
     df.rename(columns={
@@ -72,10 +216,24 @@ def extraction_transformation_passport_blacklist(date: str, cur_dir: str = "./")
     }, inplace=True)
 
     # convert 'date' column from string to date type
-    df['entry_dt'] = pd.to_datetime(df.entry_dt, format="%d.%m.%y").dt.date
+    df['entry_dt'] = pd.to_datetime(df.entry_dt, format="%d.%m.%y").dt.strftime("%Y-%m-%d")
+
+    return df
+
+
+def extraction_transformation_passport_blacklist(date: str, cur_dir: str = "./"):
+    """
+    - Extraction data: passport_blacklist
+    - Transformation data: passport_blacklist
+    """
+
+    # the input file with variable date
+    pending = find_pending_file(cur_dir, f"passport_blacklist_{date}", ".xlsx")
+
+    df = parse_passport_blacklist(pending[0]) if pending else None
 
-    # use pandas to load xlsx converted to DF into database
-    df.to_sql("STG_PASSPORT_BLACKLIST", conn, if_exists="replace", index=False)
+    # bulk load xlsx converted to DF into database
+    stage_file("STG_PASSPORT_BLACKLIST", PASSPORT_BLACKLIST_COLUMNS, pending, [df] if pending else [])
 
     return df
 
@@ -83,32 +241,90 @@ def extraction_transformation_passport_blacklist(date: str, cur_dir: str = "./")
 def load_sql_db(filename: str, cur_dir: str = "./sql_scripts"):
     """
     - Load sql files
+    - Statements are executed one by one in the transaction of the caller,
+      executescript would commit it
     """
 
     # the input file
     file = find_file(cur_dir, filename, ".sql")
 
-    # open and read the file
-    with open(file, "r", encoding="utf-8") as f:
-        # execute every command from the input file
-        cursor.executescript(f.read())
-        # saves all the modifications
-        conn.commit()
+    # execute every command from the input file
+    for statement in read_sql_statements(file):
+        cursor.execute(statement)
+
+
+def load_reference_snapshot(filename: str = "ddl_dml", cur_dir: str = "./") -> bool:
+    """
+    - Bulk load the snapshot of cards, accounts and clients from the sql dump
+    - The snapshot is registered in the load manifest, the same snapshot is not loaded again
+    - Returns True if a new snapshot was loaded
+    """
+
+    # the input file
+    pending = find_pending_file(cur_dir, filename, ".sql")
+
+    if pending is None:
+        return False
+
+    register_file(*pending, load_sql_dump(pending[0]))
+
+    return True
 
 
-def extraction_transformation_data(date: str):
+def extraction_transformation_data(date: str, cur_dir: str = "./", parallel: bool = True, reference: bool = True):
     """
     - Load Data: ddl_dml, etl_schema, terminals, transactions
+    - parallel: parse the xlsx files in worker processes while
+      the transactions file is streamed into the database by this process
+    - reference: load the snapshot of cards, accounts and clients,
+      it is loaded once when several days are processed
+    - Returns True if a new snapshot of cards, accounts and clients was loaded
     """
 
-    # cards, accounts, clients
-    load_sql_db("ddl_dml", "./")
+    full_snapshot = False
+
+    if not parallel:
+        # cards, accounts, clients
+        if reference:
+            full_snapshot = load_reference_snapshot()
+
+        # terminals
+        extraction_terminals(date, cur_dir)
+
+        # passport_blacklist
+        extraction_transformation_passport_blacklist(date, cur_dir)
+
+        # transactions
+        extraction_transformation_transactions(date, cur_dir)
+
+        return full_snapshot
+
+    # already loaded passport_blacklist is not parsed again
+    terminals_file = find_pending_file(cur_dir, f"terminals_{date}", ".xlsx", skip_loaded=False)
+    passport_blacklist_file = find_pending_file(cur_dir, f"passport_blacklist_{date}", ".xlsx")
+
+    with ProcessPoolExecutor(max_workers=2) as pool:
+        # terminals and passport_blacklist are parsed by the workers
+        terminals = pool.submit(parse_terminals, terminals_file[0])
+        passport_blacklist = passport_blacklist_file and pool.submit(
+            parse_passport_blacklist,
+            passport_blacklist_file[0]
+        )
+
+        # cards, accounts, clients
+        if reference:
+            full_snapshot = load_reference_snapshot()
 
-    # terminals
-    extraction_terminals(date)
+        # transactions
+        extraction_transformation_transactions(date, cur_dir)
 
-    # passport_blacklist
-    extraction_transformation_passport_blacklist(date)
+        # the connection is used by one process only, the parsed frames are loaded here
+        stage_file("STG_TERMINALS", TERMINALS_COLUMNS, terminals_file, [terminals.result()])
+        stage_file(
+            "STG_PASSPORT_BLACKLIST",
+            PASSPORT_BLACKLIST_COLUMNS,
+            passport_blacklist_file,
+            [passport_blacklist.result()] if passport_blacklist else []
+        )
 
-    # transactions
-    extraction_transformation_transactions(date)
+    return full_snapshot
@@ -1,1513 +1,702 @@
 # Importing dependencies
+import functools
+import hashlib
 from main import conn, cursor
-
-# CARDS
-
-# LOADING SCD1 table: DWH_DIM_CARDS
-
-
-def init_stg_cards():
-    """
-    - Create staging table: STG_CARDS
-    - Staging Table has all required fields
-    """
-
-    cursor.execute(
-        """
-        INSERT INTO STG_CARDS (
-            card_num,
-            account_num,
-            create_dt,
-            update_dt
-        ) SELECT
-            card_num,
-            account,
-            create_dt,
-            update_dt
-        FROM
-            CARDS
-    """
-    )
-
-
-def create_not_matched_rows_cards():
-    """
-    - Create staging table: STG_NOT_MATCHED_ROWS_CARDS
-    - Select the not matched records
-    """
-
-    cursor.execute(
-        """
-        CREATE TABLE IF NOT EXISTS STG_NOT_MATCHED_ROWS_CARDS
-        AS
-        SELECT
-            t1.card_num,
-            t1.account_num,
-            t1.create_dt,
-            t1.update_dt
-        FROM
-            STG_CARDS t1
-            LEFT JOIN DWH_DIM_CARDS t2 ON t1.card_num = t2.card_num
-        WHERE
-            t2.card_num IS NULL
-    """
-    )
-
-
-def create_matched_rows_cards():
-    """
-    - Create staging tables: STG_MATCHED_ROWS_CARDS
-    - Select the matched records
-    """
-
-    cursor.execute(
-        """
-        CREATE TABLE IF NOT EXISTS STG_MATCHED_ROWS_CARDS
-        AS
-        SELECT
-            t1.card_num,
-            t1.account_num,
-            t1.create_dt,
-            t1.update_dt
-        FROM 
-            STG_CARDS t1
-            INNER JOIN DWH_DIM_CARDS t2 ON t1.card_num = t2.card_num
-            AND (
-                t1.account_num = t2.account_num
-                OR t1.create_dt = t2.create_dt
-                OR t1.update_dt = t2.update_dt
-            )
-    """
-    )
-
-
-def update_cards_scd1():
-    """
-    - Insert the new records and update the existing records
-    """
-
-    # new records
-    cursor.execute(
-        """
-        INSERT INTO DWH_DIM_CARDS (
-            card_num,
-            account_num,
-            create_dt,
-            update_dt
-        ) SELECT
-            card_num,
-            account_num,
-            create_dt,
-            update_dt
-        FROM
-            STG_NOT_MATCHED_ROWS_CARDS
-    """
-    )
-
-    # overwrite existing data
-    cursor.execute(
-        """
-        UPDATE
-            DWH_DIM_CARDS
-        SET
-            account_num = (
-                SELECT
-                    account_num
-                FROM 
-                    STG_MATCHED_ROWS_CARDS
-                WHERE
-                    card_num = DWH_DIM_CARDS.card_num
-            ),
-            create_dt = (
-                SELECT
-                    create_dt
-                FROM 
-                    STG_MATCHED_ROWS_CARDS
-                WHERE
-                    card_num = DWH_DIM_CARDS.card_num
-            ),
-            update_dt = (
-                SELECT
-                    update_dt
-                FROM
-                    STG_MATCHED_ROWS_CARDS
-                WHERE
-                    card_num = DWH_DIM_CARDS.card_num
-            )
-        WHERE
-            EXISTS (
-                SELECT
-                    account_num
-                FROM
-                    STG_MATCHED_ROWS_CARDS
-                WHERE
-                    card_num = DWH_DIM_CARDS.card_num
-            )
-            OR EXISTS (
-                SELECT
-                    create_dt
-                FROM
-                    STG_MATCHED_ROWS_CARDS
-                WHERE
-                    card_num = DWH_DIM_CARDS.card_num
-            )
-            OR EXISTS (
-                SELECT
-                    update_dt
-                FROM
-                    STG_MATCHED_ROWS_CARDS
-                WHERE
-                    card_num = DWH_DIM_CARDS.card_num
-            )
-    """
-    )
-
-    # saves all the modifications
-    conn.commit()
-
-# LOADING SCD2 table: DWH_DIM_CARDS_HIST
-
-
-def init_view_cards():
-    """
-    - Create staging view: STG_VIEW_CARDS
-    """
-
-    cursor.execute(
-        """
-        CREATE VIEW IF NOT EXISTS STG_VIEW_CARDS
-        AS
-        SELECT
-            card_num,
-            account_num
-        FROM
-            DWH_DIM_CARDS_HIST
-        WHERE
-            CURRENT_TIMESTAMP BETWEEN effective_from AND effective_to
-            AND deleted_flg = 0
-    """
-    )
-
-
-def create_new_rows_cards():
-    """
-    - Create staging table: STG_NEW_ROWS_CARDS
-    - Select the new records
-    """
-
-    cursor.execute(
-        """
-        CREATE TABLE IF NOT EXISTS STG_NEW_ROWS_CARDS
-        AS
-        SELECT
-            t1.card_num,
-            t1.account_num
-        FROM
-            DWH_DIM_CARDS t1
-            LEFT JOIN STG_VIEW_CARDS t2 ON t1.card_num = t2.card_num
-        WHERE
-            t2.card_num IS NULL
-    """
-    )
-
-
-def create_deleted_rows_cards():
-    """
-    - Create staging table: STG_DELETED_ROWS_CARDS
-    - Soft delete the records
-    """
-
-    cursor.execute(
-        """
-        CREATE TABLE IF NOT EXISTS STG_DELETED_ROWS_CARDS
-        AS
-        SELECT
-            t1.card_num,
-            t1.account_num
-        FROM
-            STG_VIEW_CARDS t1
-            LEFT JOIN DWH_DIM_CARDS t2 ON t1.card_num = t2.card_num
-        WHERE
-            t2.card_num IS NULL
-    """
-    )
-
-
-def create_changed_rows_cards():
-    """
-    - Create staging table: STG_CHANGED_ROWS_CARDS
-    - Select changed rows
-    """
-
-    cursor.execute(
-        """
-        CREATE TABLE IF NOT EXISTS STG_CHANGED_ROWS_CARDS
-        AS
-        SELECT
-            t1.card_num,
-            t1.account_num
-        FROM 
-            DWH_DIM_CARDS t1
-            INNER JOIN STG_VIEW_CARDS t2 ON t1.card_num = t2.card_num
-            AND t1.account_num <> t2.account_num
-    """
-    )
-
-
-def update_cards_scd2():
-    """
-    - Add new row
-    """
-
-    # new records
-    cursor.execute(
-        """
-        INSERT INTO DWH_DIM_CARDS_HIST (
-            card_num,
-            account_num
-        ) SELECT
-            card_num,
-            account_num
-        FROM
-            STG_NEW_ROWS_CARDS
-    """
-    )
-
-    # modified records
-    cursor.execute(
-        """
-        UPDATE
-            DWH_DIM_CARDS_HIST
-        SET
-            effective_to = DATETIME('now', '-1 second')
-        WHERE
-            card_num IN (
-                SELECT
-                    card_num
-                FROM
-                    STG_CHANGED_ROWS_CARDS
-            )
-            AND effective_to = DATETIME('2999-12-31 23:59:59')
-    """
-    )
-
-    cursor.execute(
-        """
-        INSERT INTO DWH_DIM_CARDS_HIST (
-            card_num,
-            account_num
-        ) SELECT
-            card_num,
-            account_num
-        FROM
-            STG_CHANGED_ROWS_CARDS
-    """
-    )
-
-    # soft deleted records
-    cursor.execute(
-        """
-        UPDATE
-            DWH_DIM_CARDS_HIST
-        SET
-            effective_to = DATETIME('now', '-1 second')
-        WHERE
-            card_num IN (
-                SELECT
-                    card_num
-                FROM
-                    STG_DELETED_ROWS_CARDS
-            )
-            AND effective_to = DATETIME('2999-12-31 23:59:59')
-    """
-    )
-
-    cursor.execute(
-        """
-        INSERT INTO DWH_DIM_CARDS_HIST (
-            card_num,
-            account_num,
-            deleted_flg
-        ) SELECT
-            card_num,
-            account_num,
-            1
-        FROM
-            STG_DELETED_ROWS_CARDS
-    """
-    )
-
-    # saves all the modifications
-    conn.commit()
-
-# ACCOUNTS
-
-# LOADING SCD1 table: DWH_DIM_ACCOUNTS
-
-
-def init_stg_accounts():
-    """
-    - Create staging table: STG_ACCOUNTS
-    - Staging Table has all required fields
-    """
-
-    cursor.execute(
-        """
-        INSERT INTO STG_ACCOUNTS (
-            account_num,
-            valid_to,
-            client,
-            create_dt,
-            update_dt
-        ) SELECT
-            account,
-            valid_to,
-            client,
-            create_dt,
-            update_dt
-        FROM
-            ACCOUNTS
-    """
-    )
-
-
-def create_not_matched_rows_accounts():
-    """
-    - Create staging table: STG_NOT_MATCHED_ROWS_ACCOUNTS
-    - Select the not matched records
-    """
-
-    cursor.execute(
-        """
-        CREATE TABLE IF NOT EXISTS STG_NOT_MATCHED_ROWS_ACCOUNTS
-        AS
-        SELECT
-            t1.account_num,
-            t1.valid_to,
-            t1.client,
-            t1.create_dt,
-            t1.update_dt
-        FROM
-            STG_ACCOUNTS t1
-            LEFT JOIN DWH_DIM_ACCOUNTS t2 ON t1.account_num = t2.account_num
-        WHERE
-            t2.account_num IS NULL
-    """
-    )
-
-
-def create_matched_rows_accounts():
-    """
-    - Create staging tables: STG_MATCHED_ROWS_ACCOUNTS
-    - Select the matched records
-    """
-
-    cursor.execute(
-        """
-        CREATE TABLE IF NOT EXISTS STG_MATCHED_ROWS_ACCOUNTS
-        AS
-        SELECT
-            t1.account_num,
-            t1.valid_to,
-            t1.client,
-            t1.create_dt,
-            t1.update_dt
-        FROM 
-            STG_ACCOUNTS t1
-            INNER JOIN DWH_DIM_ACCOUNTS t2 ON t1.account_num = t2.account_num
-            AND (
-                t1.client <> t2.client
-                OR t1.valid_to <> t2.valid_to
-                OR t1.create_dt <> t2.create_dt
-                OR t1.update_dt <> t2.update_dt
-                OR t1.account_num <> t2.account_num
-            )
-    """
-    )
-
-
-def update_accounts_scd1():
-    """
-    - Insert the new records and update the existing records
-    """
-
-    # new records
-    cursor.execute(
-        """
-        INSERT INTO DWH_DIM_ACCOUNTS (
-            account_num,
-            valid_to,
-            client,
-            create_dt,
-            update_dt
-        ) SELECT
-            account_num,
-            valid_to,
-            client,
-            create_dt,
-            update_dt
-        FROM
-            STG_NOT_MATCHED_ROWS_ACCOUNTS
-    """
-    )
-
-    # overwrite existing rows
-    cursor.execute(
-        """
-        UPDATE
-            DWH_DIM_ACCOUNTS
-        SET
-            valid_to = (
-                SELECT
-                    valid_to
-                FROM
-                    STG_MATCHED_ROWS_ACCOUNTS
-                WHERE
-                    account_num = DWH_DIM_ACCOUNTS.account_num
-            ),
-            client = (
-                SELECT
-                    client
-                FROM
-                    STG_MATCHED_ROWS_ACCOUNTS
-                WHERE
-                    account_num = DWH_DIM_ACCOUNTS.account_num
-                ),
-            create_dt = (
-                SELECT
-                    create_dt
-                FROM
-                    STG_MATCHED_ROWS_ACCOUNTS
-                WHERE
-                    account_num = DWH_DIM_ACCOUNTS.account_num
-                ),
-            update_dt = (
-                SELECT
-                    update_dt
-                FROM
-                    STG_MATCHED_ROWS_ACCOUNTS
-                WHERE
-                    account_num = DWH_DIM_ACCOUNTS.account_num
-                )
-        WHERE
-            EXISTS (
-                SELECT
-                    account_num
-                FROM
-                    STG_MATCHED_ROWS_ACCOUNTS
-                WHERE
-                    account_num = DWH_DIM_ACCOUNTS.account_num
-                )
-            OR EXISTS (
-                SELECT
-                    create_dt
-                FROM
-                    STG_MATCHED_ROWS_ACCOUNTS
-                WHERE
-                    account_num = DWH_DIM_ACCOUNTS.account_num
-                )
-            OR EXISTS (
-                SELECT
-                    update_dt
-                FROM
-                    STG_MATCHED_ROWS_ACCOUNTS
-                WHERE
-                    account_num = DWH_DIM_ACCOUNTS.account_num
-                )
-    """
-    )
-
-    # saves all the modifications
-    conn.commit()
-
-# LOADING SCD2 table: DWH_DIM_ACCOUNTS_HIST
-
-
-def init_view_accounts():
-    """
-    - Create staging view: STG_VIEW_ACCOUNTS
-    """
-
-    cursor.execute(
-        """
-        CREATE VIEW IF NOT EXISTS STG_VIEW_ACCOUNTS
-        AS
-        SELECT
-            account_num,
-            valid_to,
-            client
-        FROM
-            DWH_DIM_ACCOUNTS_HIST
-        WHERE
-            CURRENT_TIMESTAMP BETWEEN effective_from AND effective_to
-            AND deleted_flg = 0
-    """
-    )
-
-
-def create_new_rows_accounts():
-    """
-    - Create staging table: STG_NEW_ROWS_ACCOUNTS
-    - Select the new records
-    """
-
-    cursor.execute(
-        """
-        CREATE TABLE IF NOT EXISTS STG_NEW_ROWS_ACCOUNTS
-        AS
-        SELECT
-            t1.account_num,
-            t1.valid_to,
-            t1.client
-        FROM
-            DWH_DIM_ACCOUNTS t1
-            LEFT JOIN STG_VIEW_ACCOUNTS t2 ON t1.account_num = t2.account_num
-        WHERE
-            t2.account_num IS NULL
-    """
-    )
-
-
-def create_deleted_rows_accounts():
-    """
-    - Create staging table: STG_DELETED_ROWS_ACCOUNTS
-    - Soft delete the records
-    """
-
-    cursor.execute(
-        """
-        CREATE TABLE IF NOT EXISTS STG_DELETED_ROWS_ACCOUNTS
-        AS
-        SELECT
-            t1.account_num,
-            t1.valid_to,
-            t1.client
-        FROM
-            STG_VIEW_ACCOUNTS t1
-            LEFT JOIN DWH_DIM_ACCOUNTS t2 ON t1.account_num = t2.account_num
-        WHERE
-            t2.account_num IS NULL
-    """
-    )
-
-
-def create_changed_rows_accounts():
-    """
-    - Create staging table: STG_CHANGED_ROWS_ACCOUNTS
-    - Select changed rows
-    """
-
-    cursor.execute(
-        """
-        CREATE TABLE IF NOT EXISTS STG_CHANGED_ROWS_ACCOUNTS
-        AS
-        SELECT
-            t1.account_num,
-            t1.valid_to,
-            t1.client
-        FROM
-            DWH_DIM_ACCOUNTS t1
-            INNER JOIN STG_VIEW_ACCOUNTS t2 ON t1.account_num = t2.account_num
-            AND (
-                t1.valid_to <> t2.valid_to
-                OR t1.client <> t2.client
-            )
-    """
-    )
-
-
-def update_accounts_scd2():
-    """
-    - Add new row
-    """
-
-    # new records
-    cursor.execute(
-        """
-        INSERT INTO DWH_DIM_ACCOUNTS_HIST (
-            account_num,
-            valid_to,
-            client
-        ) SELECT
-            account_num,
-            valid_to,
-            client
-        FROM
-            STG_NEW_ROWS_ACCOUNTS
-    """
-    )
-
-    # modified records
-    cursor.execute(
-        """
-        UPDATE
-            DWH_DIM_ACCOUNTS_HIST
-        SET
-            effective_to = DATETIME('now', '-1 second')
-        WHERE
-            account_num IN (
-                SELECT
-                    account_num
-                FROM
-                    STG_CHANGED_ROWS_ACCOUNTS
-            )
-            AND effective_to = DATETIME('2999-12-31 23:59:59')
-    """
-    )
-
-    cursor.execute(
-        """
-        INSERT INTO DWH_DIM_ACCOUNTS_HIST (
-            account_num,
-            valid_to,
-            client
-        ) SELECT
-            account_num,
-            valid_to,
-            client
-        FROM
-            STG_CHANGED_ROWS_ACCOUNTS
-    """
-    )
-
-    # soft deleted records
-    cursor.execute(
-        """
-        UPDATE
-            DWH_DIM_ACCOUNTS_HIST
-        SET
-            effective_to = DATETIME('now', '-1 second')
-        WHERE
-            account_num IN (
-                SELECT
-                    account_num
-                FROM
-                    STG_DELETED_ROWS_ACCOUNTS
-            )
-            AND effective_to = DATETIME('2999-12-31 23:59:59')
-    """
-    )
-
-    cursor.execute(
-        """
-        INSERT INTO DWH_DIM_ACCOUNTS_HIST (
-            account_num,
-            valid_to,
-            client,
-            deleted_flg
-        ) SELECT
-            account_num,
-            valid_to,
-            client,
-            1
-        FROM
-            STG_DELETED_ROWS_ACCOUNTS
-    """
-    )
-
-    # saves all the modifications
-    conn.commit()
-
-# CLIENTS
-
-# LOADING SCD1 table: DWH_DIM_CLIENTS
-
-
-def init_stg_clients():
-    """
-    - Create staging table: STG_CLIENTS
-    - Staging Table has all required fields
-    """
-
-    cursor.execute(
-        """
-        INSERT INTO STG_CLIENTS (
-            client_id,
-            last_name,
-            first_name,
-            patronymic,
-            date_of_birth,
-            passport_num,
-            passport_valid_to,
-            phone,
-            create_dt,
-            update_dt
-        ) SELECT
-            client_id,
-            last_name,
-            first_name,
-            patronymic,
-            date_of_birth,
-            passport_num,
-            passport_valid_to,
-            phone,
-            create_dt,
-            update_dt
-        FROM
-            CLIENTS
-    """
-    )
-
-
-def create_not_matched_rows_clients():
-    """
-    - Create staging tables: STG_NOT_MATCHED_ROWS_CLIENTS
-    - Select the not matched records
-    """
-
-    cursor.execute(
-        """
-        CREATE TABLE IF NOT EXISTS STG_NOT_MATCHED_ROWS_CLIENTS
-        AS
-        SELECT
-            t1.client_id,
-            t1.last_name,
-            t1.first_name,
-            t1.patronymic,
-            t1.date_of_birth,
-            t1.passport_num,
-            t1.passport_valid_to,
-            t1.phone,
-            t1.create_dt,
-            t1.update_dt
-        FROM
-            STG_CLIENTS t1
-            LEFT JOIN DWH_DIM_CLIENTS t2 ON t1.client_id = t2.client_id
-        WHERE
-            t2.client_id IS NULL
-    """
-    )
-
-
-def create_matched_rows_clients():
-    """
-    - Create staging tables: STG_MATCHED_ROWS_CLIENTS
-    - Select the matched records
-    """
-
-    cursor.execute(
-        """
-        CREATE TABLE IF NOT EXISTS STG_MATCHED_ROWS_CLIENTS
-        AS
-        SELECT
-            t1.client_id,
-            t1.last_name,
-            t1.first_name,
-            t1.patronymic,
-            t1.date_of_birth,
-            t1.passport_num,
-            t1.passport_valid_to,
-            t1.phone,
-            t1.create_dt,
-            t1.update_dt
-        FROM
-            STG_CLIENTS t1
-            INNER JOIN DWH_DIM_CLIENTS t2 ON t1.client_id = t2.client_id
-            AND (
-                t1.phone = t2.phone
-                OR t1.client_id = t2.client_id
-                OR t1.last_name = t2.last_name
-                OR t1.create_dt = t2.create_dt
-                OR t1.update_dt = t2.update_dt
-                OR t1.first_name = t2.first_name
-                OR t1.patronymic = t2.patronymic
-                OR t1.passport_num = t2.passport_num
-                OR t1.date_of_birth = t2.date_of_birth
-                OR t1.passport_valid_to = t2.passport_valid_to
-            )
-    """
-    )
-
-
-def update_clients_scd1():
-    """
-    - Insert the new records and update the existing records
-    """
-
-    # new records
-    cursor.execute(
-        """
-        INSERT OR IGNORE INTO DWH_DIM_CLIENTS (
-            client_id,
-            last_name,
-            first_name,
-            patronymic,
-            date_of_birth,
-            passport_num,
-            passport_valid_to,
-            phone,
-            create_dt,
-            update_dt
-        ) SELECT
-            client_id,
-            last_name,
-            first_name,
-            patronymic,
-            date_of_birth,
-            passport_num,
-            passport_valid_to,
-            phone,
-            create_dt,
-            update_dt
-        FROM
-            STG_NOT_MATCHED_ROWS_CLIENTS
+from .etl_metadata import get_watermark, update_watermark
+from .etl_scheduler import run_stages
+from .etl_partitions import LOADED_IDS, load_partitions
+
+# DIMENSIONS
+
+# SCD tables loaded by merge_dimension, a new dimension is added here:
+# - source: snapshot table loaded from ddl_dml.sql, None if the staging table is loaded from a file
+# - source_columns: columns of the staging table -> columns of the source table
+# - stg: staging table
+# - scd1: SCD1 table, None if the dimension has SCD2 table only
+# - hist: SCD2 table, loaded from the staging table
+# - key: business key
+# - columns: attributes tracked by the SCD2 table, row_hash is computed from them
+# - watermark: change date of a row in the staging table, the first not NULL column,
+#   only the rows changed since the high watermark of the source table are staged
+DIMENSIONS = {
+    "CARDS": {
+        "source": "CARDS",
+        "source_columns": {
+            "card_num": "card_num",
+            "account_num": "account",
+            "create_dt": "create_dt",
+            "update_dt": "update_dt"
+        },
+        "stg": "STG_CARDS",
+        "scd1": "DWH_DIM_CARDS",
+        "hist": "DWH_DIM_CARDS_HIST",
+        "key": "card_num",
+        "columns": ["account_num"],
+        "watermark": ["update_dt", "create_dt"]
+    },
+    "ACCOUNTS": {
+        "source": "ACCOUNTS",
+        "source_columns": {
+            "account_num": "account",
+            "valid_to": "valid_to",
+            "client": "client",
+            "create_dt": "create_dt",
+            "update_dt": "update_dt"
+        },
+        "stg": "STG_ACCOUNTS",
+        "scd1": "DWH_DIM_ACCOUNTS",
+        "hist": "DWH_DIM_ACCOUNTS_HIST",
+        "key": "account_num",
+        "columns": ["valid_to", "client"],
+        "watermark": ["update_dt", "create_dt"]
+    },
+    "CLIENTS": {
+        "source": "CLIENTS",
+        "source_columns": {
+            "client_id": "client_id",
+            "last_name": "last_name",
+            "first_name": "first_name",
+            "patronymic": "patronymic",
+            "date_of_birth": "date_of_birth",
+            "passport_num": "passport_num",
+            "passport_valid_to": "passport_valid_to",
+            "phone": "phone",
+            "create_dt": "create_dt",
+            "update_dt": "update_dt"
+        },
+        "stg": "STG_CLIENTS",
+        "scd1": "DWH_DIM_CLIENTS",
+        "hist": "DWH_DIM_CLIENTS_HIST",
+        "key": "client_id",
+        "columns": [
+            "last_name",
+            "first_name",
+            "patronymic",
+            "date_of_birth",
+            "passport_num",
+            "passport_valid_to",
+            "phone"
+        ],
+        "watermark": ["update_dt", "create_dt"]
+    },
+    "TERMINALS": {
+        "source": None,
+        "source_columns": None,
+        "stg": "STG_TERMINALS",
+        "scd1": None,
+        "hist": "DWH_DIM_TERMINALS_HIST",
+        "key": "terminal_id",
+        "columns": ["terminal_type", "terminal_city", "terminal_address"],
+        "watermark": None
+    }
+}
+
+# effective_to of the current version in SCD2 tables,
+# the same expression as in the partial indexes of etl_schema.sql
+MAX_DATE = "DATETIME('2999-12-31 23:59:59')"
+
+
+def row_hash(*values) -> str:
+    """
+    - Hash of the tracked attributes of a row: ROW_HASH(column, ...) in the statements
+    - NULL and an empty string give different hashes
+    """
+
+    return hashlib.md5(repr(values).encode("utf-8")).hexdigest()
+
+
+def create_functions(connection):
+    """
+    - Register the functions of the statements on a connection: the connection of the day
+      and the worker connections of run_stages
+    """
+
+    # the function is deterministic, so sqlite may use it in indexes and skip repeated calls
+    connection.create_function("ROW_HASH", -1, row_hash, deterministic=True)
+
+
+create_functions(conn)
+
+
+def join_columns(columns: list, alias: str = None) -> str:
+    """
+    - Comma separated list of columns for a generated statement
+    """
+
+    prefix = f"{alias}." if alias else ""
+
+    return ", ".join(f"{prefix}{column}" for column in columns)
+
+
+def changed_since(spec: dict) -> str:
     """
-    )
-
-    # overwrite existing data
-    cursor.execute(
-        """
-        UPDATE
-            DWH_DIM_CLIENTS
-        SET
-            last_name = (
-                SELECT
-                    last_name
-                FROM
-                    STG_MATCHED_ROWS_CLIENTS
-                WHERE
-                    client_id = DWH_DIM_CLIENTS.client_id
-            ),
-            first_name = (
-                SELECT
-                    first_name
-                FROM
-                    STG_MATCHED_ROWS_CLIENTS
-                WHERE
-                    client_id = DWH_DIM_CLIENTS.client_id
-            ),
-            patronymic = (
-                SELECT
-                    patronymic
-                FROM
-                    STG_MATCHED_ROWS_CLIENTS
-                WHERE
-                    client_id = DWH_DIM_CLIENTS.client_id
-            ),
-            date_of_birth = (
-                SELECT
-                    date_of_birth
-                FROM
-                    STG_MATCHED_ROWS_CLIENTS
-                WHERE
-                    client_id = DWH_DIM_CLIENTS.client_id
-            ),
-            passport_num = (
-                SELECT
-                    passport_num
-                FROM
-                    STG_MATCHED_ROWS_CLIENTS
-                WHERE
-                    client_id = DWH_DIM_CLIENTS.client_id
-            ),
-            passport_valid_to = (
-                SELECT
-                    passport_valid_to
-                FROM
-                    STG_MATCHED_ROWS_CLIENTS
-                WHERE
-                    client_id = DWH_DIM_CLIENTS.client_id
-            ),
-            phone = (
-                SELECT
-                    phone
-                FROM
-                    STG_MATCHED_ROWS_CLIENTS
-                WHERE
-                    client_id = DWH_DIM_CLIENTS.client_id
-            ),
-            create_dt = (
-                SELECT
-                    create_dt
-                FROM
-                    STG_MATCHED_ROWS_CLIENTS
-                WHERE
-                    client_id = DWH_DIM_CLIENTS.client_id
-            ),
-            update_dt = (
+    - Change date of a row for a generated statement
+    """
+
+    return f"COALESCE({join_columns(spec['watermark'])})"
+
+
+def init_stg(spec: dict, full_snapshot: bool = False):
+    """
+    - Load staging table from the snapshot table
+    - Staging Table has all required fields
+    - Only the rows changed since the high watermark are loaded, a row without
+      a change date is always loaded. The rows of the watermark date are loaded again,
+      they may have changed after the previous load
+    - full_snapshot: the rows with a key missing in the SCD1 table are loaded too,
+      a key deleted before and back in the snapshot may keep an older change date
+    """
+
+    # the staging table is loaded from a file
+    if spec["source"] is None:
+        return
+
+    # the snapshot was already loaded, ddl_dml.sql is the same
+    cursor.execute("SELECT 1 FROM SQLITE_MASTER WHERE type = 'table' AND name = ? COLLATE NOCASE", [spec["source"]])
+    if cursor.fetchone() is None:
+        return
+
+    columns = list(spec["source_columns"])
+
+    missing = f"""
+            OR {spec["source_columns"][spec["key"]]} NOT IN (
                 SELECT
-                    update_dt
+                    {spec["key"]}
                 FROM
-                    STG_MATCHED_ROWS_CLIENTS
+                    {spec["scd1"]}
                 WHERE
-                    client_id = DWH_DIM_CLIENTS.client_id
-            )
+                    {spec["key"]} IS NOT NULL
+            )""" if full_snapshot else ""
+
+    cursor.execute(
+        f"""
+        INSERT INTO {spec["stg"]} (
+            {join_columns(columns)}
+        ) SELECT
+            {join_columns(spec["source_columns"][column] for column in columns)}
+        FROM
+            {spec["source"]}
         WHERE
-            EXISTS (
-                SELECT
-                    last_name
-                FROM
-                    STG_MATCHED_ROWS_CLIENTS
-                WHERE
-                    client_id = DWH_DIM_CLIENTS.client_id
-            )
-            OR EXISTS (
-                SELECT
-                    first_name
-                FROM
-                    STG_MATCHED_ROWS_CLIENTS
-                WHERE
-                    client_id = DWH_DIM_CLIENTS.client_id
-            )
-            OR EXISTS (
-                SELECT 
-                    patronymic
-                FROM 
-                    STG_MATCHED_ROWS_CLIENTS
-                WHERE 
-                    client_id = DWH_DIM_CLIENTS.client_id
-            )
-            OR EXISTS (
-                SELECT
-                    date_of_birth
-                FROM
-                    STG_MATCHED_ROWS_CLIENTS
-                WHERE
-                    client_id = DWH_DIM_CLIENTS.client_id
-            )
-            OR EXISTS (
-                SELECT
-                    passport_num
-                FROM
-                    STG_MATCHED_ROWS_CLIENTS
-                WHERE
-                    client_id = DWH_DIM_CLIENTS.client_id
-            )
-            OR EXISTS (
-                SELECT
-                    passport_valid_to
-                FROM
-                    STG_MATCHED_ROWS_CLIENTS
-                WHERE
-                    client_id = DWH_DIM_CLIENTS.client_id
-            )
-            OR EXISTS (
-                SELECT
-                    phone
-                FROM
-                    STG_MATCHED_ROWS_CLIENTS
-                WHERE
-                    client_id = DWH_DIM_CLIENTS.client_id
-            )
-            OR EXISTS (
-                SELECT
-                    create_dt
-                FROM
-                    STG_MATCHED_ROWS_CLIENTS
-                WHERE
-                    client_id = DWH_DIM_CLIENTS.client_id
-            )
-            OR EXISTS (
-                SELECT
-                    update_dt
-                FROM
-                    STG_MATCHED_ROWS_CLIENTS
-                WHERE
-                    client_id = DWH_DIM_CLIENTS.client_id
-            )
-    """
+            {changed_since(spec)} IS NULL
+            OR {changed_since(spec)} >= ?{missing}
+    """,
+        [get_watermark(spec["source"]) or ""]
     )
 
-    # saves all the modifications
-    conn.commit()
 
-# LOADING SCD2 table: DWH_DIM_CLIENTS_HIST
+def hash_stg(spec: dict, db_cursor=cursor):
+    """
+    - Compute row_hash of the staging table
+    """
+
+    db_cursor.execute(
+        f"""
+        UPDATE
+            {spec["stg"]}
+        SET
+            row_hash = ROW_HASH({join_columns(spec["columns"])})
+    """
+    )
 
 
-def init_view_clients():
+def hash_hist(spec: dict):
     """
-    - Create staging view: STG_VIEW_CLIENTS
+    - Compute the missing row_hash of the current versions in the SCD2 table,
+      versions loaded before the row_hash column was added
     """
 
     cursor.execute(
-        """
-        CREATE VIEW IF NOT EXISTS STG_VIEW_CLIENTS
-        AS
-        SELECT
-            client_id,
-            last_name,
-            first_name,
-            patronymic,
-            date_of_birth,
-            passport_num,
-            passport_valid_to,
-            phone
-        FROM
-            DWH_DIM_CLIENTS_HIST
+        f"""
+        UPDATE
+            {spec["hist"]}
+        SET
+            row_hash = ROW_HASH({join_columns(spec["columns"])})
         WHERE
-            CURRENT_TIMESTAMP BETWEEN effective_from AND effective_to
-            AND deleted_flg = 0
+            row_hash IS NULL
+            AND effective_to = {MAX_DATE}
     """
     )
 
 
-def create_new_rows_clients():
+def update_scd1(spec: dict):
     """
-    - Create staging table: STG_NEW_ROWS_CLIENTS
-    - Select the new records
+    - LOADING SCD1 table
+    - Insert the new records and update the existing records in one statement,
+      the key of the staging table is the primary key of the SCD1 table
     """
 
+    key = spec["key"]
+    columns = list(spec["source_columns"])
+
+    assignments = ",\n                ".join(
+        f"{column} = excluded.{column}" for column in columns if column != key
+    )
+
+    # 'WHERE true' tells the parser that ON CONFLICT belongs to the insert, not to a join
     cursor.execute(
-        """
-        CREATE TABLE IF NOT EXISTS STG_NEW_ROWS_CLIENTS
-        AS
-        SELECT
-            t1.client_id,
-            t1.last_name,
-            t1.first_name,
-            t1.patronymic,
-            t1.date_of_birth,
-            t1.passport_num,
-            t1.passport_valid_to,
-            t1.phone
+        f"""
+        INSERT INTO {spec["scd1"]} (
+            {join_columns(columns)}
+        ) SELECT
+            {join_columns(columns, "t1")}
         FROM
-            DWH_DIM_CLIENTS t1
-            LEFT JOIN STG_VIEW_CLIENTS t2 ON t1.client_id = t2.client_id
+            {spec["stg"]} t1
         WHERE
-            t2.client_id IS NULL
+            true
+        ON CONFLICT ({key}) DO UPDATE
+            SET
+                {assignments}
     """
     )
 
 
-def create_deleted_rows_clients():
+def delete_scd1(spec: dict):
     """
-    - Create staging table: STG_DELETED_ROWS_CLIENTS
-    - Soft delete the records
+    - Delete the records of the SCD1 table missing in the full snapshot
     """
 
+    source_key = spec["source_columns"][spec["key"]]
+
     cursor.execute(
-        """
-        CREATE TABLE IF NOT EXISTS STG_DELETED_ROWS_CLIENTS
-        AS
-        SELECT
-            t1.client_id,
-            t1.last_name,
-            t1.first_name,
-            t1.patronymic,
-            t1.date_of_birth,
-            t1.passport_num,
-            t1.passport_valid_to,
-            t1.phone
-        FROM
-            STG_VIEW_CLIENTS t1
-            LEFT JOIN DWH_DIM_CLIENTS t2 ON t1.client_id = t2.client_id
+        f"""
+        DELETE FROM
+            {spec["scd1"]}
         WHERE
-            t2.client_id IS NULL
+            {spec["key"]} NOT IN (
+                SELECT
+                    {source_key}
+                FROM
+                    {spec["source"]}
+            )
     """
     )
 
 
-def create_changed_rows_clients():
+def create_diff_rows(name: str, spec: dict, full_snapshot: bool, db_cursor=cursor):
     """
-    - Create staging table: STG_CHANGED_ROWS_CLIENTS
-    - Select changed rows
+    - Create staging table: STG_DIFF_<name>
+    - New, changed and deleted rows of the SCD2 table in one table, op: 'N', 'U', 'D'
+    - A row is changed if its row_hash differs from the hash of the current version
+    - A key deleted before and back in the snapshot is a changed row
+    - full_snapshot: search deleted rows, a key is deleted if it is missing
+      in the SCD1 table or in the staging table of a dimension without SCD1 table
     """
 
-    cursor.execute(
-        """
-        CREATE TABLE IF NOT EXISTS STG_CHANGED_ROWS_CLIENTS
-        AS
+    key = spec["key"]
+    columns = spec["columns"]
+
+    # the keys of the full snapshot
+    snapshot = spec["scd1"] or spec["stg"]
+
+    # an incremental load has no deleted rows, the aliases differ from the first select for the plan check
+    deleted = f"""UNION ALL
         SELECT
-            t1.client_id,
-            t1.last_name,
-            t1.first_name,
-            t1.patronymic,
-            t1.date_of_birth,
-            t1.passport_num,
-            t1.passport_valid_to,
-            t1.phone
+            t3.{key},
+            {join_columns(columns, "t3")},
+            t3.row_hash,
+            'D' AS op
         FROM
-            DWH_DIM_CLIENTS t1
-            INNER JOIN STG_VIEW_CLIENTS t2 ON t1.client_id = t2.client_id
-            AND (
-                t1.phone <> t2.phone
-                OR t1.last_name <> t2.last_name
-                OR t1.first_name <> t2.first_name
-                OR t1.patronymic <> t2.patronymic
-                OR t1.passport_num <> t2.passport_num
-                OR t1.date_of_birth <> t2.date_of_birth
-                OR t1.passport_valid_to <> t2.passport_valid_to
-            )
+            {spec["hist"]} t3
+        WHERE
+            t3.effective_to = {MAX_DATE}
+            AND t3.deleted_flg = 0
+            AND NOT EXISTS (
+                SELECT
+                    1
+                FROM
+                    {snapshot} t4
+                WHERE
+                    t4.{key} = t3.{key}
+            )""" if full_snapshot else ""
+
+    db_cursor.execute(f"DROP TABLE IF EXISTS STG_DIFF_{name}")
+
+    db_cursor.execute(
+        f"""
+        CREATE TABLE STG_DIFF_{name}
+        AS
+        SELECT
+            t1.{key},
+            {join_columns(columns, "t1")},
+            t1.row_hash,
+            CASE WHEN t2.{key} IS NULL THEN 'N' ELSE 'U' END AS op
+        FROM
+            {spec["stg"]} t1
+            LEFT JOIN {spec["hist"]} t2 ON t1.{key} = t2.{key}
+            AND t2.effective_to = {MAX_DATE}
+        WHERE
+            t2.{key} IS NULL
+            OR t2.deleted_flg = 1
+            OR t2.row_hash IS NOT t1.row_hash
+        {deleted}
     """
     )
 
 
-def update_clients_scd2():
+def update_scd2(name: str, spec: dict):
     """
-    - Add new row
+    - LOADING SCD2 table from STG_DIFF_<name>
+    - Close the current versions of changed and deleted rows and add the new versions
     """
 
-    # new records
-    cursor.execute(
-        """
-        INSERT INTO DWH_DIM_CLIENTS_HIST (
-            client_id,
-            last_name,
-            first_name,
-            patronymic,
-            date_of_birth,
-            passport_num,
-            passport_valid_to,
-            phone
-        ) SELECT
-            client_id,
-            last_name,
-            first_name,
-            patronymic,
-            date_of_birth,
-            passport_num,
-            passport_valid_to,
-            phone
-        FROM
-            STG_NEW_ROWS_CLIENTS
-    """
-    )
+    key = spec["key"]
+    columns = [key] + spec["columns"] + ["row_hash"]
 
-    # modified records
+    # modified and soft deleted records
     cursor.execute(
-        """
+        f"""
         UPDATE
-            DWH_DIM_CLIENTS_HIST
+            {spec["hist"]}
         SET
             effective_to = DATETIME('now', '-1 second')
         WHERE
-            client_id IN (
+            {key} IN (
                 SELECT
-                    client_id
+                    {key}
                 FROM
-                    STG_CHANGED_ROWS_CLIENTS
+                    STG_DIFF_{name}
+                WHERE
+                    op <> 'N'
             )
-            AND effective_to = DATETIME('2999-12-31 23:59:59')
+            AND effective_to = {MAX_DATE}
     """
     )
 
+    # new records, effective_from has the default of the table
     cursor.execute(
-        """
-        INSERT INTO DWH_DIM_CLIENTS_HIST (
-            client_id,
-            last_name,
-            first_name,
-            patronymic,
-            date_of_birth,
-            passport_num,
-            passport_valid_to,
-            phone
+        f"""
+        INSERT INTO {spec["hist"]} (
+            {join_columns(columns)}
         ) SELECT
-            client_id,
-            last_name,
-            first_name,
-            patronymic,
-            date_of_birth,
-            passport_num,
-            passport_valid_to,
-            phone
+            {join_columns(columns)}
         FROM
-            STG_CHANGED_ROWS_CLIENTS
-    """
-    )
-
-    # soft deleted records
-    cursor.execute(
-        """
-        UPDATE
-            DWH_DIM_CLIENTS_HIST
-        SET
-            effective_to = DATETIME('now', '-1 second')
+            STG_DIFF_{name}
         WHERE
-            client_id IN (
-                SELECT
-                    client_id
-                FROM
-                    STG_DELETED_ROWS_CLIENTS
-            )
-            AND effective_to = DATETIME('2999-12-31 23:59:59')
+            op = 'N'
     """
     )
 
+    # new versions of modified and soft deleted records
     cursor.execute(
-        """
-        INSERT INTO DWH_DIM_CLIENTS_HIST (
-            client_id,
-            last_name,
-            first_name,
-            patronymic,
-            date_of_birth,
-            passport_num,
-            passport_valid_to,
-            phone,
-            deleted_flg
+        f"""
+        INSERT INTO {spec["hist"]} (
+            {join_columns(columns)},
+            deleted_flg,
+            effective_from
         ) SELECT
-            client_id,
-            last_name,
-            first_name,
-            patronymic,
-            date_of_birth,
-            passport_num,
-            passport_valid_to,
-            phone,
-            1
+            {join_columns(columns)},
+            op = 'D',
+            DATETIME('now')
         FROM
-            STG_DELETED_ROWS_CLIENTS
+            STG_DIFF_{name}
+        WHERE
+            op <> 'N'
     """
     )
 
-    # saves all the modifications
-    conn.commit()
 
-# TERMINALS
+def stage_dimension(name: str, full_snapshot: bool = False) -> tuple:
+    """
+    - Load the staging table of one dimension of DIMENSIONS for diff_dimension
+    - full_snapshot: a new snapshot was loaded from ddl_dml.sql, deleted rows are searched,
+      a dimension loaded from a file always gets a full snapshot
+    - Returns the staged rows, the keys of the full snapshot and the last rowid of the SCD2 table
+    """
 
-# LOADING SCD2 table: DWH_DIM_TERMINALS_HIST
+    spec = DIMENSIONS[name]
+    full_snapshot = full_snapshot or spec["source"] is None
 
+    init_stg(spec, full_snapshot)
 
-def init_view_terminals():
-    """
-    - Create staging view: STG_VIEW_TERMINALS
-    """
+    columns = [spec["key"]] + spec["columns"]
+    cursor.execute(f"SELECT {join_columns(columns)} FROM {spec['stg']}")
+    staged = cursor.fetchall()
 
-    cursor.execute(
-        """
-        CREATE VIEW IF NOT EXISTS STG_VIEW_TERMINALS
-        AS
-        SELECT
-            terminal_id,
-            terminal_type,
-            terminal_city,
-            terminal_address
-        FROM
-            DWH_DIM_TERMINALS_HIST
-        WHERE
-            CURRENT_TIMESTAMP BETWEEN effective_from AND effective_to
-            AND deleted_flg = 0
-    """
-    )
+    # the keys of the SCD1 table after merge_dimension
+    keys = []
+    if full_snapshot and spec["scd1"]:
+        source_key = spec["source_columns"][spec["key"]]
+        cursor.execute(f"SELECT {source_key} FROM {spec['source']} WHERE {source_key} IS NOT NULL")
+        keys = cursor.fetchall()
+
+    cursor.execute(f"SELECT MAX(rowid) FROM {spec['hist']}")
 
+    return staged, keys, cursor.fetchone()[0]
 
-def create_new_rows_terminals():
+
+def diff_dimension(name: str, full_snapshot: bool, staged: list, keys: list, last_rowid: int, connection) -> list:
     """
-    - Create staging table: STG_NEW_ROWS_TERMINALS
-    - Select the new records
+    - Compute STG_DIFF_<name> on a worker connection of run_stages: the staging table and the SCD1 keys
+      of the full snapshot are copied into the database of the worker, the SCD2 table is read
+      from the committed warehouse
+    - last_rowid: the SCD2 table is not changed by the transaction of the day before the stage
+    - Returns the rows of STG_DIFF_<name>
     """
 
-    cursor.execute(
-        """
-        CREATE TABLE IF NOT EXISTS STG_NEW_ROWS_TERMINALS
-        AS
-        SELECT
-            t1.terminal_id,
-            t1.terminal_type,
-            t1.terminal_city,
-            t1.terminal_address
-        FROM
-            STG_TERMINALS t1
-            LEFT JOIN STG_VIEW_TERMINALS t2 ON t1.terminal_id = t2.terminal_id
-        WHERE
-            t2.terminal_id IS NULL
-    """
-    )
+    spec = DIMENSIONS[name]
+    full_snapshot = full_snapshot or spec["source"] is None
+    key = spec["key"]
+    columns = [key] + spec["columns"]
 
+    create_functions(connection)
+    db_cursor = connection.cursor()
 
-def create_deleted_rows_terminals():
-    """
-    - Create staging table: STG_DELETED_ROWS_TERMINALS
-    - Soft delete the records
-    """
+    db_cursor.execute(f"SELECT MAX(rowid) FROM {spec['hist']}")
+    if db_cursor.fetchone()[0] != last_rowid:
+        raise RuntimeError(f"{spec['hist']} was changed by the transaction before the stage {name}")
 
-    cursor.execute(
-        """
-        CREATE TABLE IF NOT EXISTS STG_DELETED_ROWS_TERMINALS
-        AS
-        SELECT
-            t1.terminal_id,
-            t1.terminal_type,
-            t1.terminal_city,
-            t1.terminal_address
-        FROM
-            STG_VIEW_TERMINALS t1
-            LEFT JOIN STG_TERMINALS t2 ON t1.terminal_id = t2.terminal_id
-        WHERE
-            t2.terminal_id IS NULL
-    """
+    db_cursor.execute(f"CREATE TABLE {spec['stg']} ({join_columns(columns)}, row_hash)")
+    db_cursor.executemany(
+        f"INSERT INTO {spec['stg']} ({join_columns(columns)}) VALUES ({', '.join('?' * len(columns))})", staged
     )
+    db_cursor.execute(f"CREATE INDEX {spec['stg']}_{key.upper()}_IDX ON {spec['stg']} ({key})")
+
+    # the SCD1 table of the worker hides the table of the warehouse
+    if full_snapshot and spec["scd1"]:
+        db_cursor.execute(f"CREATE TABLE {spec['scd1']} ({key} PRIMARY KEY)")
+        db_cursor.executemany(f"INSERT OR IGNORE INTO {spec['scd1']} ({key}) VALUES (?)", keys)
+
+    hash_stg(spec, db_cursor)
+    create_diff_rows(name, spec, full_snapshot, db_cursor)
+
+    db_cursor.execute(f"SELECT {join_columns(columns)}, row_hash, op FROM STG_DIFF_{name}")
+
+    return db_cursor.fetchall()
 
 
-def create_changed_rows_terminals():
+def merge_dimension(name: str, full_snapshot: bool, diff_rows: list):
     """
-    - Create staging table: STG_CHANGED_ROWS_TERMINALS
-    - Select changed rows
+    - Loading one dimension of DIMENSIONS: SCD1 table from the staging table,
+      SCD2 table from the rows of STG_DIFF_<name> computed by diff_dimension
     """
 
-    cursor.execute(
-        """
-        CREATE TABLE IF NOT EXISTS STG_CHANGED_ROWS_TERMINALS
-        AS
-        SELECT
-            t1.terminal_id,
-            t1.terminal_type,
-            t1.terminal_city,
-            t1.terminal_address
-        FROM STG_TERMINALS t1
-            INNER JOIN STG_VIEW_TERMINALS t2 ON t1.terminal_id = t2.terminal_id
-            AND (
-                t1.terminal_type <> t2.terminal_type
-                OR t1.terminal_city <> t2.terminal_city
-                OR t1.terminal_address <> t2.terminal_address
-            )
-    """
+    spec = DIMENSIONS[name]
+    full_snapshot = full_snapshot or spec["source"] is None
+    columns = [spec["key"]] + spec["columns"] + ["row_hash", "op"]
+
+    if spec["scd1"]:
+        update_scd1(spec)
+
+        if full_snapshot:
+            delete_scd1(spec)
+
+    cursor.execute(f"DROP TABLE IF EXISTS STG_DIFF_{name}")
+    cursor.execute(f"CREATE TABLE STG_DIFF_{name} ({join_columns(columns)})")
+    cursor.executemany(
+        f"INSERT INTO STG_DIFF_{name} ({join_columns(columns)}) VALUES ({', '.join('?' * len(columns))})", diff_rows
     )
 
+    update_scd2(name, spec)
+
+    # the next load starts from the last change date of the staged rows
+    if spec["watermark"]:
+        cursor.execute(f"SELECT MAX({changed_since(spec)}) FROM {spec['stg']}")
+        update_watermark(spec["source"], cursor.fetchone()[0])
+
+# LOADING DWH_CARD_ENRICHMENT
+
 
-def update_hist_terminals():
+def refresh_card_enrichment():
     """
-    - Add new row
+    - Loading DWH_CARD_ENRICHMENT: passport, fio, phone, passport and account validity
+      of the current versions of the card, its account and its client, one row per card
+      with an account and a client
+    - Only the cards with a new version of the card, its account or its client in STG_DIFF_<name>
+      are loaded again, the table is loaded in full while it is empty
+    - STG_CARD_ENRICHMENT: the loaded cards, the data mart evaluates their transactions again
     """
 
-    # new records
-    cursor.execute(
-        """
-        INSERT INTO DWH_DIM_TERMINALS_HIST (
-            terminal_id,
-            terminal_type,
-            terminal_city,
-            terminal_address
-        ) SELECT
-            terminal_id,
-            terminal_type,
-            terminal_city,
-            terminal_address
-        FROM
-            STG_NEW_ROWS_TERMINALS
-    """
-    )
+    cursor.execute("DROP TABLE IF EXISTS STG_CARD_ENRICHMENT")
 
-    # modified records
-    cursor.execute(
-        """
-        UPDATE
-            DWH_DIM_TERMINALS_HIST
-        SET
-            effective_to = DATETIME('now', '-1 second')
-        WHERE
-            terminal_id IN (
-                SELECT
-                    terminal_id
-                FROM
-                    STG_CHANGED_ROWS_TERMINALS
-            )
-            AND effective_to = DATETIME('2999-12-31 23:59:59')
-    """
-    )
+    cursor.execute("SELECT EXISTS (SELECT 1 FROM DWH_CARD_ENRICHMENT)")
 
-    cursor.execute(
+    if cursor.fetchone()[0]:
+        # the cards of the changed accounts and clients are searched in the current versions,
+        # a card missing in DWH_CARD_ENRICHMENT comes back with its account or client
+        cursor.execute(
+            f"""
+            CREATE TABLE STG_CARD_ENRICHMENT
+            AS
+            SELECT
+                card_num
+            FROM
+                STG_DIFF_CARDS
+            UNION
+            SELECT
+                card_num
+            FROM
+                DWH_DIM_CARDS_HIST
+            WHERE
+                effective_to = {MAX_DATE}
+                AND account_num IN (
+                    SELECT
+                        account_num
+                    FROM
+                        STG_DIFF_ACCOUNTS
+                    UNION
+                    SELECT
+                        account_num
+                    FROM
+                        DWH_DIM_ACCOUNTS_HIST
+                    WHERE
+                        effective_to = {MAX_DATE}
+                        AND client IN (
+                            SELECT
+                                client_id
+                            FROM
+                                STG_DIFF_CLIENTS
+                        )
+                )
         """
-        INSERT INTO DWH_DIM_TERMINALS_HIST (
-            terminal_id,
-            terminal_type,
-            terminal_city,
-            terminal_address
-        ) SELECT
-            terminal_id,
-            terminal_type,
-            terminal_city,
-            terminal_address
-        FROM
-            STG_CHANGED_ROWS_TERMINALS
-    """
-    )
+        )
+    else:
+        cursor.execute(
+            f"""
+            CREATE TABLE STG_CARD_ENRICHMENT
+            AS
+            SELECT DISTINCT
+                card_num
+            FROM
+                DWH_DIM_CARDS_HIST
+            WHERE
+                effective_to = {MAX_DATE}
+        """
+        )
 
-    # soft deleted records
+    cursor.execute("CREATE UNIQUE INDEX STG_CARD_ENRICHMENT_CARD_NUM_IDX ON STG_CARD_ENRICHMENT (card_num)")
+
+    # deleted cards and cards without an account or a client are not loaded again
     cursor.execute(
         """
-        UPDATE
-            DWH_DIM_TERMINALS_HIST
-        SET
-            effective_to = DATETIME('now', '-1 second')
+        DELETE FROM
+            DWH_CARD_ENRICHMENT
         WHERE
-            terminal_id IN (
+            card_num IN (
                 SELECT
-                    terminal_id
+                    card_num
                 FROM
-                    STG_DELETED_ROWS_TERMINALS
+                    STG_CARD_ENRICHMENT
             )
-            AND effective_to = DATETIME('2999-12-31 23:59:59')
     """
     )
 
     cursor.execute(
-        """
-        INSERT INTO DWH_DIM_TERMINALS_HIST (
-            terminal_id,
-            terminal_type,
-            terminal_city,
-            terminal_address,
-            deleted_flg
+        f"""
+        INSERT INTO DWH_CARD_ENRICHMENT (
+            card_num,
+            account_num,
+            client_id,
+            passport_num,
+            fio,
+            phone,
+            passport_valid_to,
+            account_valid_to,
+            update_dt
         ) SELECT
-            terminal_id,
-            terminal_type,
-            terminal_city,
-            terminal_address,
-            1
-        FROM
-            STG_DELETED_ROWS_TERMINALS
+            t1.card_num,
+            t1.account_num,
+            t2.client,
+            t3.passport_num,
+            t3.last_name || ' ' || t3.first_name || ' ' || t3.patronymic,
+            t3.phone,
+            t3.passport_valid_to,
+            t2.valid_to,
+            CURRENT_TIMESTAMP
+        FROM
+            STG_CARD_ENRICHMENT t0
+            INNER JOIN DWH_DIM_CARDS_HIST t1 ON t0.card_num = t1.card_num
+            AND t1.effective_to = {MAX_DATE}
+            AND t1.deleted_flg = 0
+            INNER JOIN DWH_DIM_ACCOUNTS_HIST t2 ON t1.account_num = t2.account_num
+            AND t2.effective_to = {MAX_DATE}
+            AND t2.deleted_flg = 0
+            INNER JOIN DWH_DIM_CLIENTS_HIST t3 ON t2.client = t3.client_id
+            AND t3.effective_to = {MAX_DATE}
+            AND t3.deleted_flg = 0
     """
     )
 
-    # saves all the modifications
-    conn.commit()
-
 # LOADING FACT table: DWH_FACT_TRANSACTIONS
 
 
-def load_fact_transactions():
+def load_fact_transactions() -> int:
     """
-    - Loading DWH_FACT_TRANSACTIONS
+    - Loading DWH_FACT_TRANSACTIONS: the partitions of the months of the staged rows
+    - trans_id is a unique key: a loaded transaction is ignored,
+      a staged row with a loaded trans_id and different content goes to DWH_FACT_TRANSACTIONS_CONFLICTS
+    - A staged row with the trans_id of an archived partition is ignored, its content is not compared:
+      the archived rows are not read
+    - Returns the number of conflicting rows
     """
 
+    load_partitions("STG_TRANSACTIONS")
+
+    # every staged row has a loaded row with the same trans_id now,
+    # including the duplicates inside the file, LOADED_IDS gives its partition
+    cursor.execute("DROP TABLE IF EXISTS STG_TRANSACTION_PARTITIONS")
+
     cursor.execute(
-        """
-        INSERT INTO DWH_FACT_TRANSACTIONS (
-            trans_id,
-            trans_date,
-            card_num,
-            oper_type,
-            amt,
-            oper_result,
-            terminal
-        ) SELECT
+        f"""
+        CREATE TABLE STG_TRANSACTION_PARTITIONS
+        AS
+        SELECT
             t1.trans_id,
             t1.trans_date,
             t1.card_num,
             t1.oper_type,
             t1.amt,
             t1.oper_result,
-            t1.terminal
+            t1.terminal,
+            t2.partition_name
         FROM
             STG_TRANSACTIONS t1
-        WHERE
-            NOT EXISTS (
-                SELECT
-                    trans_id
-                    trans_date,
-                    card_num,
-                    oper_type,
-                    amt,
-                    oper_result,
-                    terminal
-                FROM
-                    DWH_FACT_TRANSACTIONS t2
-                WHERE
-                    t2.amt = t1.amt
-                    AND t2.trans_id = t1.trans_id
-                    AND t2.card_num = t1.card_num
-                    AND t2.terminal = t1.terminal
-                    AND t2.oper_type = t1.oper_type
-                    AND t2.trans_date = t1.trans_date
-                    AND t2.oper_result = t1.oper_result
-            )
-    """
-    )
+            INNER JOIN {LOADED_IDS} t2 ON t1.trans_id = t2.trans_id
+    """
+    )
+
+    cursor.execute("SELECT DISTINCT partition_name FROM STG_TRANSACTION_PARTITIONS")
+    partitions = [row[0] for row in cursor.fetchall()]
+
+    conflicts = 0
+
+    for name in partitions:
+        cursor.execute(
+            f"""
+            INSERT INTO DWH_FACT_TRANSACTIONS_CONFLICTS (
+                trans_id,
+                trans_date,
+                card_num,
+                oper_type,
+                amt,
+                oper_result,
+                terminal
+            ) SELECT
+                t1.trans_id,
+                t1.trans_date,
+                t1.card_num,
+                t1.oper_type,
+                t1.amt,
+                t1.oper_result,
+                t1.terminal
+            FROM
+                STG_TRANSACTION_PARTITIONS t1
+                INNER JOIN {name} t2 ON t1.trans_id = t2.trans_id
+            WHERE
+                t1.partition_name = ?
+                AND (
+                    t1.trans_date IS NOT t2.trans_date
+                    OR t1.card_num IS NOT t2.card_num
+                    OR t1.oper_type IS NOT t2.oper_type
+                    OR t1.amt IS NOT t2.amt
+                    OR t1.oper_result IS NOT t2.oper_result
+                    OR t1.terminal IS NOT t2.terminal
+                )
+        """,
+            [name]
+        )
+        conflicts += cursor.rowcount
 
-    # saves all the modifications
-    conn.commit()
+    return conflicts
 
 # LOADING FACT table: DWH_FACT_PASSPORT_BLACKLIST
 
@@ -1541,63 +730,46 @@ def load_fact_passport_blacklist():
     """
     )
 
-    # saves all the modifications
-    conn.commit()
+
+def report_fact_transactions():
+    """
+    - Loading DWH_FACT_TRANSACTIONS and report the conflicting rows
+    """
+
+    conflicts = load_fact_transactions()
+    if conflicts:
+        print(f"transactions with a loaded trans_id and different content: {conflicts}")
 
 
-def load_dim_fact_tables():
+def load_dim_fact_tables(full_snapshot: bool = False) -> dict:
     """
     - Loading all tables: SCD1, SCD2 and FACT
-    """
+    - full_snapshot: a new snapshot of cards, accounts and clients was loaded
+    - Every table is a stage of run_stages, the dimensions and the facts do not depend
+      on each other: each of them reads its own staging table only,
+      DWH_CARD_ENRICHMENT is loaded after the dimensions of cards, accounts and clients
+    - The diffs of the dimensions are computed by the workers of run_stages
+      while the facts are loaded
+    - Returns the duration of every stage in seconds
+    """
+
+    # DWH_DIM_CARDS, DWH_DIM_ACCOUNTS, DWH_DIM_CLIENTS and SCD2 tables
+    stages = {
+        name: (
+            functools.partial(merge_dimension, name, full_snapshot),
+            [],
+            functools.partial(diff_dimension, name, full_snapshot, *stage_dimension(name, full_snapshot))
+        )
+        for name in DIMENSIONS
+    }
 
-    # DWH_DIM_CARDS
-    init_stg_cards()
-    create_not_matched_rows_cards()
-    create_matched_rows_cards()
-    update_cards_scd1()
-
-    # DWH_DIM_CARDS_HIST
-    init_view_cards()
-    create_new_rows_cards()
-    create_deleted_rows_cards()
-    create_changed_rows_cards()
-    update_cards_scd2()
-
-    # DWH_DIM_ACCOUNTS
-    init_stg_accounts()
-    create_not_matched_rows_accounts()
-    create_matched_rows_accounts()
-    update_accounts_scd1()
-
-    # DWH_DIM_ACCOUNTS_HIST
-    init_view_accounts()
-    create_new_rows_accounts()
-    create_deleted_rows_accounts()
-    create_changed_rows_accounts()
-    update_accounts_scd2()
-
-    # DWH_DIM_CLIENTS
-    init_stg_clients()
-    create_not_matched_rows_clients()
-    create_matched_rows_clients()
-    update_clients_scd1()
-
-    # DWH_DIM_CLIENTS_HIST
-    init_view_clients()
-    create_new_rows_clients()
-    create_deleted_rows_clients()
-    create_changed_rows_clients()
-    update_clients_scd2()
-
-    # DWH_DIM_TERMINALS_HIST
-    init_view_terminals()
-    create_new_rows_terminals()
-    create_deleted_rows_terminals()
-    create_changed_rows_terminals()
-    update_hist_terminals()
+    # DWH_CARD_ENRICHMENT reads the new versions of cards, accounts and clients
+    stages["CARD_ENRICHMENT"] = (refresh_card_enrichment, ["CARDS", "ACCOUNTS", "CLIENTS"])
 
     # DWH_FACT_TRANSACTIONS
-    load_fact_transactions()
+    stages["TRANSACTIONS"] = (report_fact_transactions, [])
 
     # DWH_FACT_PASSPORT_BLACKLIST
-    load_fact_passport_blacklist()
\ No newline at end of file
+    stages["PASSPORT_BLACKLIST"] = (load_fact_passport_blacklist, [])
+
+    return run_stages(stages)
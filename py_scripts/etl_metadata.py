@@ -1,5 +1,6 @@
 # Importing dependencies
-from main import conn, cursor
+import os
+from main import cursor
 
 
 def update_metadata():
@@ -31,3 +32,101 @@ def update_metadata():
             )
     """
     )
+
+
+def is_file_loaded(file_hash: str) -> bool:
+    """
+    - Check META_LOAD_MANIFEST for a loaded file with the same content
+    """
+
+    cursor.execute(
+        """
+        SELECT
+            EXISTS (
+                SELECT
+                    1
+                FROM
+                    META_LOAD_MANIFEST
+                WHERE
+                    file_hash = ?
+                    AND load_status = 'loaded'
+            )
+    """,
+        [file_hash]
+    )
+
+    return bool(cursor.fetchone()[0])
+
+
+def register_file(file: str, file_size: int, file_hash: str, row_count: int):
+    """
+    - Register a staged file in META_LOAD_MANIFEST
+    """
+
+    cursor.execute(
+        """
+        INSERT OR REPLACE INTO META_LOAD_MANIFEST (
+            file_name,
+            file_size,
+            file_hash,
+            row_count,
+            load_status,
+            load_dt
+        ) VALUES (?, ?, ?, ?, 'staged', CURRENT_TIMESTAMP)
+    """,
+        [os.path.basename(file), file_size, file_hash, row_count]
+    )
+
+
+def complete_manifest():
+    """
+    - Mark the staged files as loaded into DWH tables
+    """
+
+    cursor.execute(
+        """
+        UPDATE
+            META_LOAD_MANIFEST
+        SET
+            load_status = 'loaded',
+            load_dt = CURRENT_TIMESTAMP
+        WHERE
+            load_status = 'staged'
+    """
+    )
+
+
+def get_watermark(tbl_name: str):
+    """
+    - High watermark of a source table in META_WATERMARK: the last change date of its loaded rows
+    - Returns None if the table was never loaded
+    """
+
+    cursor.execute("SELECT watermark FROM META_WATERMARK WHERE tbl_name = ?", [tbl_name])
+    result = cursor.fetchone()
+
+    return result[0] if result else None
+
+
+def update_watermark(tbl_name: str, watermark):
+    """
+    - Move the high watermark of a source table forward, it never goes back
+    """
+
+    if watermark is None:
+        return
+
+    cursor.execute(
+        """
+        INSERT INTO META_WATERMARK (
+            tbl_name,
+            watermark,
+            load_dt
+        ) VALUES (?, ?, CURRENT_TIMESTAMP)
+        ON CONFLICT (tbl_name) DO UPDATE
+            SET
+                watermark = MAX(watermark, excluded.watermark),
+                load_dt = excluded.load_dt
+    """,
+        [tbl_name, watermark]
+    )
@@ -0,0 +1,408 @@
+# Importing dependencies
+import os
+from main import cursor
+from .etl_scheduler import transaction
+
+# PARTITIONS of DWH_FACT_TRANSACTIONS
+
+# DWH_FACT_TRANSACTIONS is a view over one table per month of trans_date: DWH_FACT_TRANSACTIONS_YYYYMM
+FACT_VIEW = "DWH_FACT_TRANSACTIONS"
+
+# name of a partition table without the month
+PARTITION_PREFIX = "DWH_FACT_TRANSACTIONS_"
+
+# month of a transaction, rows without a date go to the partition 000000
+PARTITION_MONTH = "COALESCE(STRFTIME('%Y%m', trans_date), '000000')"
+
+# trans_id of the archived partitions: load_partitions can not read the archive files
+ARCHIVED_IDS = "META_ARCHIVED_TRANSACTIONS"
+
+# trans_id of the partitions of the view and the partition of every trans_id:
+# a trans_id is searched once instead of in every partition
+LOADED_IDS = "META_LOADED_TRANSACTIONS"
+
+# columns of a partition table
+PARTITION_COLUMNS = """
+    trans_id VARCHAR(128),
+    trans_date DATE,
+    card_num VARCHAR(128),
+    oper_type VARCHAR(128),
+    amt DECIMAL(10,2),
+    oper_result VARCHAR(128),
+    terminal VARCHAR(128)
+"""
+
+
+def list_partitions() -> list:
+    """
+    - Names of the partition tables in month order
+    """
+
+    cursor.execute(
+        """
+        SELECT
+            name
+        FROM
+            SQLITE_MASTER
+        WHERE
+            type = 'table'
+            AND name GLOB ?
+        ORDER BY
+            name
+    """,
+        [f"{PARTITION_PREFIX}[0-9][0-9][0-9][0-9][0-9][0-9]"]
+    )
+
+    return [row[0] for row in cursor.fetchall()]
+
+
+def refresh_fact_view():
+    """
+    - Create the view DWH_FACT_TRANSACTIONS: UNION ALL of the partitions
+    - sqlite pushes joins, filters and windows into every partition, so its indexes are used
+    """
+
+    partitions = list_partitions()
+
+    if partitions:
+        select = "\n        UNION ALL\n        ".join(f"SELECT * FROM {name}" for name in partitions)
+    else:
+        # no transactions were loaded yet
+        select = """SELECT
+            CAST(NULL AS VARCHAR(128)) AS trans_id,
+            CAST(NULL AS DATE) AS trans_date,
+            CAST(NULL AS VARCHAR(128)) AS card_num,
+            CAST(NULL AS VARCHAR(128)) AS oper_type,
+            CAST(NULL AS DECIMAL(10,2)) AS amt,
+            CAST(NULL AS VARCHAR(128)) AS oper_result,
+            CAST(NULL AS VARCHAR(128)) AS terminal
+        WHERE
+            false"""
+
+    cursor.execute(f"DROP VIEW IF EXISTS {FACT_VIEW}")
+
+    cursor.execute(
+        f"""
+        CREATE VIEW {FACT_VIEW}
+        AS
+        {select}
+    """
+    )
+
+
+def create_partition(month: str) -> str:
+    """
+    - Create the partition of a month (YYYYMM) with its indexes
+    - Returns the name of the partition
+    """
+
+    name = f"{PARTITION_PREFIX}{month}"
+
+    cursor.execute(f"CREATE TABLE IF NOT EXISTS {name} ({PARTITION_COLUMNS})")
+
+    # trans_id is a unique key of a partition, the other partitions are checked by load_partitions
+    cursor.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS {name}_TRANS_ID_IDX ON {name} (trans_id)")
+
+    # transactions of a card in time order: joins by card_num and windows partitioned by card_num
+    cursor.execute(f"CREATE INDEX IF NOT EXISTS {name}_CARD_NUM_IDX ON {name} (card_num, trans_date)")
+
+    return name
+
+
+def load_partitions(table_name: str) -> int:
+    """
+    - Insert the rows of a staging table into the partitions of their months
+    - A row is ignored if its trans_id is already in any partition or in an archived partition,
+      the rows of an archived month get a new partition which is appended to the archive
+    - The trans_id of the inserted rows are added to LOADED_IDS
+    - Returns the number of inserted rows
+    """
+
+    cursor.execute(f"SELECT DISTINCT {PARTITION_MONTH} FROM {table_name} ORDER BY 1")
+    months = [row[0] for row in cursor.fetchall()]
+
+    partitions = list_partitions()
+    names = [create_partition(month) for month in months]
+
+    # the view has to include the new partitions
+    if set(names) - set(partitions):
+        refresh_fact_view()
+
+    rows = 0
+
+    # month by month, so a trans_id repeated in two months of the batch is loaded once
+    for month, name in zip(months, names):
+        cursor.execute(
+            f"""
+            INSERT OR IGNORE INTO {name} (
+                trans_id,
+                trans_date,
+                card_num,
+                oper_type,
+                amt,
+                oper_result,
+                terminal
+            ) SELECT
+                t1.trans_id,
+                t1.trans_date,
+                t1.card_num,
+                t1.oper_type,
+                t1.amt,
+                t1.oper_result,
+                t1.terminal
+            FROM
+                {table_name} t1
+            WHERE
+                {PARTITION_MONTH} = ?
+                AND NOT EXISTS (
+                    SELECT
+                        1
+                    FROM
+                        {LOADED_IDS} t2
+                    WHERE
+                        t2.trans_id = t1.trans_id
+                )
+                AND NOT EXISTS (
+                    SELECT
+                        1
+                    FROM
+                        {ARCHIVED_IDS} t3
+                    WHERE
+                        t3.trans_id = t1.trans_id
+                )
+        """,
+            [month]
+        )
+        rows += cursor.rowcount
+
+        cursor.execute(
+            f"""
+            INSERT OR IGNORE INTO {LOADED_IDS} (
+                trans_id,
+                partition_name
+            ) SELECT
+                trans_id,
+                ?
+            FROM
+                {name}
+            WHERE
+                trans_id IN (
+                    SELECT
+                        trans_id
+                    FROM
+                        {table_name}
+                    WHERE
+                        {PARTITION_MONTH} = ?
+                )
+        """,
+            [name, month]
+        )
+
+    return rows
+
+
+def create_archived_ids():
+    """
+    - Create ARCHIVED_IDS and LOADED_IDS, before the rows of an old DWH_FACT_TRANSACTIONS table are loaded
+    - LOADED_IDS of a database loaded before it existed gets the trans_id of the partitions
+    """
+
+    cursor.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS {ARCHIVED_IDS} (
+            trans_id VARCHAR(128) PRIMARY KEY,
+            partition_name VARCHAR(128)
+        )
+    """
+    )
+
+    cursor.execute("SELECT 1 FROM SQLITE_MASTER WHERE type = 'table' AND name = ?", [LOADED_IDS])
+    if cursor.fetchone():
+        return
+
+    cursor.execute(
+        f"""
+        CREATE TABLE {LOADED_IDS} (
+            trans_id VARCHAR(128) PRIMARY KEY,
+            partition_name VARCHAR(128)
+        )
+    """
+    )
+
+    for name in list_partitions():
+        cursor.execute(
+            f"""
+            INSERT OR IGNORE INTO {LOADED_IDS} (
+                trans_id,
+                partition_name
+            ) SELECT
+                trans_id,
+                ?
+            FROM
+                {name}
+        """,
+            [name]
+        )
+
+
+def partition_fact_table():
+    """
+    - Move the rows of the table DWH_FACT_TRANSACTIONS into the partitions
+      and replace the table with the view
+    - The view is created on every run, it does not exist in a new database
+    """
+
+    create_archived_ids()
+
+    cursor.execute("SELECT type FROM SQLITE_MASTER WHERE name = ?", [FACT_VIEW])
+    result = cursor.fetchone()
+
+    if result and result[0] == "table":
+        # the indexes of the table are dropped with it
+        cursor.execute(f"ALTER TABLE {FACT_VIEW} RENAME TO {FACT_VIEW}_UNPARTITIONED")
+        load_partitions(f"{FACT_VIEW}_UNPARTITIONED")
+        cursor.execute(f"DROP TABLE {FACT_VIEW}_UNPARTITIONED")
+
+    refresh_fact_view()
+
+
+def restore_archived_ids():
+    """
+    - Load the trans_id of the partitions archived before ARCHIVED_IDS existed from their files
+    - ATTACH is not allowed inside a transaction
+    """
+
+    cursor.execute(
+        f"""
+        SELECT
+            t1.partition_name,
+            t1.archive_file
+        FROM
+            META_PARTITIONS t1
+        WHERE
+            NOT EXISTS (
+                SELECT
+                    1
+                FROM
+                    {ARCHIVED_IDS} t2
+                WHERE
+                    t2.partition_name = t1.partition_name
+            )
+    """
+    )
+
+    for name, file in cursor.fetchall():
+        if not os.path.exists(file):
+            continue
+
+        cursor.execute("ATTACH DATABASE ? AS partition_archive", [file])
+
+        try:
+            with transaction():
+                cursor.execute(
+                    f"""
+                    INSERT OR IGNORE INTO {ARCHIVED_IDS} (
+                        trans_id,
+                        partition_name
+                    ) SELECT
+                        trans_id,
+                        ?
+                    FROM
+                        partition_archive.{name}
+                """,
+                    [name]
+                )
+        finally:
+            cursor.execute("DETACH DATABASE partition_archive")
+
+
+def archive_partitions(keep_months: int, archive_dir: str = "archive") -> list:
+    """
+    - Move the partitions older than the last keep_months partitions into their own database files
+      in archive_dir and remove them from the view
+    - A partition is appended to its archived table and dropped, the other partitions are not touched:
+      a month archived before keeps its rows, the rows of late transactions are added to them
+    - The trans_id of the archived rows are moved from LOADED_IDS to ARCHIVED_IDS
+    - ATTACH is not allowed inside a transaction, so it runs after the days are loaded
+    - Returns the archived files
+    """
+
+    restore_archived_ids()
+
+    partitions = list_partitions()
+    old = partitions[:max(len(partitions) - keep_months, 0)]
+
+    files = []
+    os.makedirs(archive_dir, exist_ok=True)
+
+    for name in old:
+        file = os.path.join(archive_dir, f"{name}.db")
+
+        cursor.execute("ATTACH DATABASE ? AS partition_archive", [file])
+
+        try:
+            # a transaction of attached WAL databases is not atomic across the files,
+            # so the copy is committed before the partition is dropped,
+            # the copy is repeated if the partition was not dropped, its rows are not added twice
+            with transaction():
+                cursor.execute(f"CREATE TABLE IF NOT EXISTS partition_archive.{name} ({PARTITION_COLUMNS})")
+                cursor.execute(
+                    f"CREATE UNIQUE INDEX IF NOT EXISTS partition_archive.{name}_TRANS_ID_IDX ON {name} (trans_id)"
+                )
+                cursor.execute(f"INSERT OR IGNORE INTO partition_archive.{name} SELECT * FROM main.{name}")
+
+            with transaction():
+                cursor.execute(
+                    f"""
+                    INSERT OR IGNORE INTO {ARCHIVED_IDS} (
+                        trans_id,
+                        partition_name
+                    ) SELECT
+                        trans_id,
+                        ?
+                    FROM
+                        main.{name}
+                """,
+                    [name]
+                )
+
+                cursor.execute(
+                    f"""
+                    DELETE FROM
+                        {LOADED_IDS}
+                    WHERE
+                        trans_id IN (
+                            SELECT
+                                trans_id
+                            FROM
+                                main.{name}
+                        )
+                """
+                )
+
+                cursor.execute(
+                    f"""
+                    INSERT OR REPLACE INTO META_PARTITIONS (
+                        partition_name,
+                        row_count,
+                        archive_file,
+                        archive_dt
+                    ) SELECT
+                        ?,
+                        COUNT(*),
+                        ?,
+                        CURRENT_TIMESTAMP
+                    FROM
+                        partition_archive.{name}
+                """,
+                    [name, file]
+                )
+
+                cursor.execute(f"DROP TABLE main.{name}")
+                refresh_fact_view()
+        finally:
+            cursor.execute("DETACH DATABASE partition_archive")
+
+        files.append(file)
+
+    return files
@@ -0,0 +1,63 @@
+# Importing dependencies
+from main import conn, cursor
+
+# CONNECTION PROFILES
+
+# pragmas of the connection for every stage of the pipeline:
+# - page_size: used when the database file is created only, so it goes before journal_mode
+# - journal_mode: WAL, readers of the database are not blocked by the ETL
+# - synchronous: NORMAL is safe with WAL, a day lost by a power failure is loaded again
+# - temp_store: sorts of window functions and temporary b-trees are kept in memory
+# - cache_size: negative value is the size in KiB
+# - mmap_size: bytes of the database file read through memory-mapped I/O
+# - query_only: the report stage can not modify the database
+PROFILES = {
+    # staging and loading of DWH tables: most pages are written once
+    "bulk_load": {
+        "page_size": 8192,
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "temp_store": "MEMORY",
+        "cache_size": -262144,
+        "mmap_size": 0,
+        "query_only": "OFF"
+    },
+    # detection of fraud: window functions and joins over the whole history
+    "detection": {
+        "page_size": 8192,
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "temp_store": "MEMORY",
+        "cache_size": -524288,
+        "mmap_size": 1073741824,
+        "query_only": "OFF"
+    },
+    # read-only report
+    "report": {
+        "page_size": 8192,
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "temp_store": "MEMORY",
+        "cache_size": -65536,
+        "mmap_size": 1073741824,
+        "query_only": "ON"
+    }
+}
+
+# pragmas that sqlite allows to change inside a transaction
+TRANSACTION_PRAGMAS = ("cache_size", "mmap_size", "query_only")
+
+
+def use_profile(name: str):
+    """
+    - Switch the connection to a profile of PROFILES
+    - Inside a transaction only TRANSACTION_PRAGMAS are changed,
+      the other pragmas keep the values of the profile used before the transaction
+    """
+
+    for pragma, value in PROFILES[name].items():
+        if conn.in_transaction and pragma not in TRANSACTION_PRAGMAS:
+            continue
+
+        # some pragmas return the new value, the statement is finished by fetching it
+        cursor.execute(f"PRAGMA {pragma} = {value}").fetchall()
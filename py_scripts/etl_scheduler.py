@@ -0,0 +1,154 @@
+# Importing dependencies
+import concurrent.futures
+import pathlib
+import sqlite3
+import time
+from contextlib import contextmanager
+from main import cursor
+
+# TRANSACTIONS and STAGE SCHEDULER
+
+# trace callback of the worker connections, set by start_plan_check of etl_tools
+WORKER_TRACE = {"callback": None}
+
+
+@contextmanager
+def transaction():
+    """
+    - Run a block in one transaction: committed at the end, rolled back on any error
+    - The write lock is taken at the start, readers of the WAL database are not blocked
+    """
+
+    cursor.execute("BEGIN IMMEDIATE")
+
+    try:
+        yield
+    except BaseException:
+        cursor.execute("ROLLBACK")
+        raise
+
+    cursor.execute("COMMIT")
+
+
+@contextmanager
+def savepoint(name: str):
+    """
+    - Run a stage of the transaction: the changes of a failed stage are rolled back
+    """
+
+    cursor.execute(f"SAVEPOINT {name}")
+
+    try:
+        yield
+    except BaseException:
+        cursor.execute(f"ROLLBACK TO {name}")
+        cursor.execute(f"RELEASE {name}")
+        raise
+
+    cursor.execute(f"RELEASE {name}")
+
+
+def order_stages(stages: dict) -> list:
+    """
+    - Order the stages so that every stage runs after its dependencies
+    - stages: name -> (function, names of the stages it depends on[, compute])
+    - Independent stages keep the order of the dict
+    - A stage with a compute has no dependencies: its worker does not see the other stages
+    """
+
+    order = []
+    pending = dict(stages)
+
+    for name, stage in stages.items():
+        if len(stage) > 2 and stage[1]:
+            raise ValueError(f"stage {name} has a compute and dependencies")
+
+    while pending:
+        ready = [name for name, (_, depends, *_) in pending.items() if set(depends) <= set(order)]
+
+        if not ready:
+            raise ValueError(f"stages with unknown or cyclic dependencies: {', '.join(pending)}")
+
+        for name in ready:
+            order.append(name)
+            del pending[name]
+
+    return order
+
+
+def run_worker(compute, database: str):
+    """
+    - Run the compute of a stage on a worker connection: an in-memory database for its own tables
+      with the warehouse attached read only
+    - The worker reads the warehouse committed before the transaction of the day
+    - database: the file of the warehouse
+    - Returns the result of the compute and its duration in seconds
+    """
+
+    start = time.perf_counter()
+
+    connection = sqlite3.connect(":memory:", isolation_level=None, uri=True)
+
+    try:
+        if WORKER_TRACE["callback"]:
+            connection.set_trace_callback(WORKER_TRACE["callback"])
+
+        connection.execute("ATTACH ? AS DWH", [pathlib.Path(database).as_uri() + "?mode=ro"])
+
+        # every statement of the compute reads the same version of the warehouse
+        connection.execute("BEGIN")
+        result = compute(connection)
+        connection.execute("ROLLBACK")
+    finally:
+        connection.close()
+
+    return result, time.perf_counter() - start
+
+
+def run_stages(stages: dict) -> dict:
+    """
+    - Run the stages in the order of their dependencies, every stage in its own savepoint
+    - stages: name -> (function, names of the stages it depends on) or
+      name -> (function, [], compute)
+    - compute(connection) starts at once on a worker connection, concurrently with the other stages,
+      function(result) writes its result on the connection and in the transaction of the day:
+      sqlite has one writer, and a worker does not see the staging tables before the commit
+    - A stage waiting for its compute gives way to the stages that are ready
+    - Returns the duration of every stage in seconds
+    """
+
+    order = order_stages(stages)
+    database = cursor.execute("PRAGMA database_list").fetchone()[2]
+
+    timings = {}
+
+    with concurrent.futures.ThreadPoolExecutor() as pool:
+        computes = {
+            name: pool.submit(run_worker, stage[2], database)
+            for name, stage in stages.items() if len(stage) > 2
+        }
+
+        while len(timings) < len(order):
+            ready = [name for name in order if name not in timings and set(stages[name][1]) <= set(timings)]
+            running = [computes[name] for name in ready if name in computes and not computes[name].done()]
+
+            if len(running) == len(ready):
+                concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                continue
+
+            name = next(name for name in ready if name not in computes or computes[name].done())
+            start = time.perf_counter()
+
+            with savepoint(f"stage_{name}"):
+                if name in computes:
+                    result, worker_time = computes[name].result()
+                    stages[name][0](result)
+                else:
+                    worker_time = None
+                    stages[name][0]()
+
+            timings[name] = time.perf_counter() - start
+            worker = f" (worker {worker_time:.3f} s)" if worker_time is not None else ""
+            print(f"stage {name}: {timings[name]:.3f} s{worker}")
+
+    return timings
@@ -0,0 +1,238 @@
+# Importing dependencies
+import collections
+import datetime
+import functools
+import time
+from main import cursor
+from .etl_load_db import MAX_DATE
+
+# STREAMING DETECTION
+
+# trans_date is stored without a time zone
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def load_cards() -> dict:
+    """
+    - Current attributes of every card from DWH_CARD_ENRICHMENT:
+      card_num -> (passport, fio, phone, passport_valid_to, valid_to, blacklisted)
+    """
+
+    cursor.execute(
+        """
+        SELECT
+            t1.card_num,
+            t1.passport_num,
+            t1.fio,
+            t1.phone,
+            t1.passport_valid_to,
+            t1.account_valid_to,
+            EXISTS (
+                SELECT
+                    1
+                FROM
+                    DWH_FACT_PASSPORT_BLACKLIST t2
+                WHERE
+                    t2.passport_num = t1.passport_num
+            ) AS blacklisted
+        FROM
+            DWH_CARD_ENRICHMENT t1
+    """
+    )
+
+    return {row[0]: row[1:] for row in cursor.fetchall()}
+
+
+def load_terminals() -> dict:
+    """
+    - City of the current version of every terminal: terminal_id -> terminal_city
+    """
+
+    cursor.execute(
+        f"""
+        SELECT
+            terminal_id,
+            terminal_city
+        FROM
+            DWH_DIM_TERMINALS_HIST
+        WHERE
+            effective_to = {MAX_DATE}
+    """
+    )
+
+    return dict(cursor.fetchall())
+
+
+def new_card_state(chain: int) -> dict:
+    """
+    - State of a card: the city and the time of its last transaction, the last time of the card
+      in another city, the last operation, the length of the run of rejected operations
+      with decreasing amounts ending with it and the times of the last chain operations
+    """
+
+    return {
+        "city": None,
+        "time": None,
+        "other_time": None,
+        "oper_result": None,
+        "amt": None,
+        "run": 0,
+        "times": collections.deque(maxlen=chain)
+    }
+
+
+def detect_transaction(state: dict, card: tuple, city: str, trans_date: str, amt: float, oper_result: str,
+                       date: str, lookback: int, chain: int, window: int) -> list:
+    """
+    - Evaluate one transaction against the state of its card and update the state
+    - card: attributes of the card from load_cards, None if the card is unknown
+    - date: the evaluated date, the passport and the account are checked on it like by the sql rules
+    - lookback: the city lookback of detection_different_city_fraud
+    - chain, window: the sum up chain of detection_sum_up_fraud
+    - Returns the event types of the transaction
+    - The work does not depend on the number of earlier transactions of the card and on chain
+    """
+
+    seconds = (datetime.datetime.fromisoformat(trans_date) - EPOCH).total_seconds()
+
+    events = []
+
+    if card:
+        _, _, _, passport_valid_to, valid_to, blacklisted = card
+
+        # 1) expired or blacklisted passport
+        if blacklisted or passport_valid_to is not None and date >= passport_valid_to:
+            events.append(1)
+
+        # 2) expired account
+        if valid_to is not None and date >= valid_to:
+            events.append(2)
+
+    # 3) a transaction of the card in another city within lookback seconds:
+    # the last transaction if its city is another one, else the last time in another city
+    if city is not None and state["city"] is not None:
+        other_time = state["time"] if city != state["city"] else state["other_time"]
+
+        if other_time is not None and seconds - other_time <= lookback:
+            events.append(3)
+
+    # 4) a successful operation less than the last one after a run of chain rejected operations
+    # with decreasing amounts, the first of the last chain operations within window seconds
+    times = state["times"]
+    decreasing = state["oper_result"] == "REJECT" and amt is not None and state["amt"] is not None and amt < state["amt"]
+
+    if (
+        oper_result == "SUCCESS"
+        and decreasing
+        and state["run"] >= chain
+        and seconds - times[0] <= window
+    ):
+        events.append(4)
+
+    if city is not None:
+        if state["city"] is not None and city != state["city"]:
+            state["other_time"] = state["time"]
+
+        state["city"] = city
+        state["time"] = seconds
+
+    if oper_result == "REJECT":
+        state["run"] = state["run"] + 1 if decreasing else 1
+    else:
+        state["run"] = 0
+
+    state["oper_result"] = oper_result
+    state["amt"] = amt
+    times.append(seconds)
+
+    return events
+
+
+def detection_stream_fraud(date: str, lookback: int, chain: int, window: int):
+    """
+    - Searching all fraud types with the streaming detector over the staging tables
+      of create_detection_scope: the transactions of STG_DETECTION_HISTORY are consumed
+      in time order, one state per card
+    - lookback: the city lookback of detection_different_city_fraud
+    - chain, window: the sum up chain of detection_sum_up_fraud
+    - The state of a card is restored from its transactions before trans_from, they do not raise events again
+    - The passport and account events are raised for the transactions of STG_DETECTION_TRANSACTIONS,
+      the different city and sum up events for the transactions of the card from trans_from like by the sql rules:
+      a new transaction changes the events of the transactions after it
+    - Passport, fio and phone are the current attributes of the card,
+      a different city event needs a known card like the sql rule
+    """
+
+    # convert date to format '%Y-%m-%d'
+    date = datetime.datetime.strptime(date, "%d%m%Y").date().isoformat()
+
+    cards = load_cards()
+    terminals = load_terminals()
+
+    cursor.execute(
+        """
+        SELECT
+            t1.trans_date,
+            t1.card_num,
+            t1.amt,
+            t1.oper_result,
+            t1.terminal,
+            t0.trans_from,
+            t1.trans_id IN (
+                SELECT
+                    trans_id
+                FROM
+                    STG_DETECTION_TRANSACTIONS
+            ) AS new_flg
+        FROM
+            STG_DETECTION_CARDS t0
+            INNER JOIN STG_DETECTION_HISTORY t1 ON t0.card_num = t1.card_num
+        ORDER BY
+            t1.trans_date,
+            t1.trans_id
+    """
+    )
+
+    states = collections.defaultdict(functools.partial(new_card_state, chain))
+    rows = []
+    elapsed, count = 0.0, 0
+
+    # the rows are consumed from the cursor, the history of the scope is not kept in memory
+    for trans_date, card_num, amt, oper_result, terminal, trans_from, new_flg in cursor:
+        card = cards.get(card_num)
+
+        start = time.perf_counter()
+        events = detect_transaction(
+            states[card_num], card, terminals.get(terminal), trans_date, amt, oper_result, date, lookback, chain,
+            window
+        )
+
+        if trans_date < trans_from:
+            continue
+
+        elapsed += time.perf_counter() - start
+        count += 1
+
+        passport, fio, phone = card[:3] if card else (None, None, None)
+        rows.extend(
+            (trans_date, passport, fio, phone, event_type)
+            for event_type in events
+            if event_type in (1, 2) and new_flg or event_type == 3 and card or event_type == 4
+        )
+
+    cursor.executemany(
+        """
+        INSERT INTO STG_REP_FRAUD (
+            event_dt,
+            passport,
+            fio,
+            phone,
+            event_type,
+            report_dt
+        ) VALUES (?, ?, ?, ?, ?, DATETIME('now'))
+    """,
+        rows
+    )
+
+    if count:
+        print(f"stream detection: {count} transactions, {elapsed / count * 1000:.4f} ms per transaction")
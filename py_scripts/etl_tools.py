@@ -1,35 +1,140 @@
 # Importing dependencies
+import contextlib
+import datetime
+import gzip
+import hashlib
 import os
 import re
 import shutil
+import zipfile
 from main import conn, cursor
+from .etl_load_db import DIMENSIONS, hash_hist
+from .etl_partitions import partition_fact_table
+from .etl_scheduler import WORKER_TRACE
+
+# statements executed while the query plans are checked: sql -> None
+TRACED_STATEMENTS = {}
+
+# statements which may read other tables, bulk inserts of values are not traced
+TRACED_PATTERN = re.compile(r"\s*(SELECT|UPDATE|DELETE|INSERT\s.*\bSELECT\b|CREATE\s+TABLE\s.*\bAS\b)", re.IGNORECASE | re.DOTALL)
+
+# tables that grow with the history: facts and SCD2 tables
+HISTORY_PATTERN = re.compile(r"DWH_FACT_\w+|DWH_\w+_HIST")
+
+# compressed files are read without unpacking them to the disk
+COMPRESSED_EXTENSIONS = (".gz", ".zst")
+
+
+def is_archive(cur_dir: str) -> bool:
+    """
+    - Check if the source of files is a zip archive instead of a directory
+    """
+
+    return os.path.isfile(cur_dir) and zipfile.is_zipfile(cur_dir)
+
+
+def list_files(cur_dir: str) -> list:
+    """
+    - List the files of a directory or the members of a zip archive
+    """
+
+    if is_archive(cur_dir):
+        with zipfile.ZipFile(cur_dir) as archive:
+            return archive.namelist()
+
+    return os.listdir(cur_dir)
 
 
 def find_file(cur_dir: str, filename: str, filename_extension: str):
     """
     - Search for a file in directory
-    - cur_dir: dir from where search starts
+    - cur_dir: dir from where search starts, may be a zip archive
+    - A file of a directory may be compressed: name.ext.gz, name.ext.zst,
+      the members of a zip archive are compressed by the archive and are not matched compressed
     """
 
-    for file in os.listdir(cur_dir):
-        if file.startswith(filename) and file.endswith(filename_extension):
+    extensions = [filename_extension]
+    if not is_archive(cur_dir):
+        extensions += [filename_extension + c for c in COMPRESSED_EXTENSIONS]
+
+    for file in list_files(cur_dir):
+        if file.startswith(filename) and file.endswith(tuple(extensions)):
             # concatenates various path components
             return os.path.join(cur_dir, file)
 
 
-def get_date_default(date: str) -> str:
+def open_file(file: str):
+    """
+    - Open a file found by find_file for binary reading
+    - Members of a zip archive and .gz/.zst files of a directory are decompressed on the fly
+    """
+
+    # member of a zip archive
+    archive = os.path.dirname(file)
+    if is_archive(archive):
+        with zipfile.ZipFile(archive) as f:
+            # the member keeps the archive open until it is closed
+            return f.open(os.path.basename(file))
+
+    if file.endswith(".gz"):
+        return gzip.open(file, "rb")
+
+    if file.endswith(".zst"):
+        # optional dependency, only needed for .zst files
+        import zstandard
+        return zstandard.ZstdDecompressor().stream_reader(open(file, "rb"), closefd=True)
+
+    return open(file, "rb")
+
+
+def file_checksum(file: str) -> tuple:
+    """
+    - Size and SHA-256 of the file content
+    - Compressed files and members of a zip archive are measured decompressed
+    """
+
+    sha = hashlib.sha256()
+    size = 0
+
+    # read by blocks to keep memory constant
+    with open_file(file) as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+            size += len(block)
+
+    return size, sha.hexdigest()
+
+
+def get_dates_default(cur_dir: str = "./") -> list:
+    """
+    - Get all the dates of given files in data folder
+    - Dates are sorted in chronological order, not as strings (ddmmyyyy)
+    """
+
+    regex = re.compile(r"\d{8}")  # pattern to capture date
+
+    dates = set()
+    for file in list_files(cur_dir):
+        if file.startswith('terminals'):
+            match_array = regex.findall(file)
+            if match_array:
+                dates.add(match_array[0])
+
+    return sorted(dates, key=lambda date: datetime.datetime.strptime(date, "%d%m%Y"))
+
+
+def get_date_default(date: str, cur_dir: str = None) -> str:
     """
     - Get default to the date
+    - cur_dir: data folder or zip archive, current working directory by default
     """
 
     # extract current date from given files names in data folder
     if date == '' or date == ' ':
-        for file in sorted(os.listdir(os.getcwd())):
-            if file.startswith('terminals'):
-                regex = re.compile(r"\d{8}")  # pattern to capture date
-                match_array = regex.findall(file)
-                date = match_array[0]
-                return date
+        dates = get_dates_default(cur_dir or os.getcwd())
+        if dates:
+            # the earliest date is processed first
+            return dates[0]
     else:
         # date format to use for files
         return re.sub(r"(\d\d)\W?(\d\d)\W?(\d{4})", r"\1\2\3", date)
@@ -79,14 +184,243 @@ def make_backup_file(filename: str, filename_extension: str, cur_dir: str = "./"
     shutil.move(source, backup)
 
 
-def make_backup_all_files(date: str):
+def make_backup_all_files(date: str, cur_dir: str = "./"):
     """
     - Create a backup copy of a files
+    - Files of a zip archive stay in it, the archive is moved by make_backup_archive
+    """
+
+    if is_archive(cur_dir):
+        return
+
+    make_backup_file(f"passport_blacklist_{date}", ".xlsx", cur_dir)
+    make_backup_file(f"terminals_{date}", ".xlsx", cur_dir)
+    make_backup_file(f"transactions_{date}", ".txt", cur_dir)
+
+
+def make_backup_archive(archive: str):
+    """
+    - Move a processed zip archive to the backup folder
+    """
+
+    # prevent overwriting a file
+    backup = get_next_file(os.path.basename(archive))
+
+    shutil.move(archive, backup)
+
+
+def drop_primary_key(table_name: str):
+    """
+    - Rebuild a table without its primary key, the data is kept
+    - The indexes of the table are created again by etl_schema
+    """
+
+    cursor.execute("SELECT sql FROM SQLITE_MASTER WHERE type = 'table' AND name = ?", [table_name])
+    result = cursor.fetchone()
+
+    # the table does not exist yet or has no primary key
+    if result is None or "PRIMARY KEY" not in result[0].upper():
+        return
+
+    sql = re.sub(r"\s+PRIMARY\s+KEY", "", result[0], flags=re.IGNORECASE)
+    sql = sql.replace(table_name, f"{table_name}_NEW", 1)
+
+    cursor.execute(sql)
+    cursor.execute(f"INSERT INTO {table_name}_NEW SELECT * FROM {table_name}")
+    cursor.execute(f"DROP TABLE {table_name}")
+    cursor.execute(f"ALTER TABLE {table_name}_NEW RENAME TO {table_name}")
+
+
+def add_primary_key(table_name: str, key: str):
+    """
+    - Rebuild a table with its key as the primary key, the last loaded row of every key is kept
+    - A table created before the key was the primary key is kept by etl_schema otherwise
     """
 
-    make_backup_file(f"passport_blacklist_{date}", ".xlsx")
-    make_backup_file(f"terminals_{date}", ".xlsx")
-    make_backup_file(f"transactions_{date}", ".txt")
+    cursor.execute("SELECT sql FROM SQLITE_MASTER WHERE type = 'table' AND name = ?", [table_name])
+    result = cursor.fetchone()
+
+    # the table does not exist yet or already has a primary key
+    if result is None or "PRIMARY KEY" in result[0].upper():
+        return
+
+    sql = re.sub(rf"(\b{key}\s+\w+(\(\d+\))?)", r"\1 PRIMARY KEY", result[0], count=1)
+    sql = sql.replace(table_name, f"{table_name}_NEW", 1)
+
+    cursor.execute(sql)
+    cursor.execute(f"INSERT OR REPLACE INTO {table_name}_NEW SELECT * FROM {table_name} ORDER BY rowid")
+    cursor.execute(f"DROP TABLE {table_name}")
+    cursor.execute(f"ALTER TABLE {table_name}_NEW RENAME TO {table_name}")
+
+
+def add_column(table_name: str, column: str, column_type: str) -> bool:
+    """
+    - Add a column to an existing table
+    - Returns True if the column was added
+    """
+
+    columns = [row[1] for row in cursor.execute(f"PRAGMA table_info({table_name})").fetchall()]
+
+    # the table does not exist yet or already has the column
+    if not columns or column in columns:
+        return False
+
+    cursor.execute(f"ALTER TABLE {table_name} ADD COLUMN {column} {column_type}")
+
+    return True
+
+
+def convert_amounts(table_name: str):
+    """
+    - Convert the amounts loaded as text with a decimal comma ('1046,40') to numbers
+    """
+
+    cursor.execute("SELECT 1 FROM SQLITE_MASTER WHERE type = 'table' AND name = ?", [table_name])
+
+    # the table does not exist yet or is a view over the partitions
+    if cursor.fetchone() is None:
+        return
+
+    cursor.execute(
+        f"""
+        UPDATE
+            {table_name}
+        SET
+            amt = CAST(REPLACE(amt, ',', '.') AS REAL)
+        WHERE
+            TYPEOF(amt) = 'text'
+    """
+    )
+
+
+def move_duplicate_transactions():
+    """
+    - Keep the first loaded row of every trans_id in DWH_FACT_TRANSACTIONS,
+      the other rows are moved to DWH_FACT_TRANSACTIONS_CONFLICTS
+    - Runs before the unique index on trans_id is created
+    """
+
+    cursor.execute(
+        """
+        SELECT
+            SUM(type = 'table' AND name = 'DWH_FACT_TRANSACTIONS'),
+            SUM(type = 'index' AND name = 'DWH_FACT_TRANSACTIONS_TRANS_ID_IDX')
+        FROM
+            SQLITE_MASTER
+    """
+    )
+
+    # the table does not exist yet or trans_id is already a unique key
+    table, index = cursor.fetchone()
+    if not table or index:
+        return
+
+    # rows loaded before trans_id was a unique key
+    cursor.execute(
+        """
+        CREATE TEMP TABLE STG_DUPLICATE_TRANSACTIONS
+        AS
+        SELECT
+            rowid AS row_id
+        FROM
+            DWH_FACT_TRANSACTIONS
+        WHERE
+            rowid NOT IN (
+                SELECT
+                    MIN(rowid)
+                FROM
+                    DWH_FACT_TRANSACTIONS
+                GROUP BY
+                    trans_id
+            )
+    """
+    )
+
+    cursor.execute("SELECT COUNT(*) FROM STG_DUPLICATE_TRANSACTIONS")
+    duplicates = cursor.fetchone()[0]
+
+    if duplicates:
+        # conflict_dt has no default in the copy, the table is created by etl_schema otherwise
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS DWH_FACT_TRANSACTIONS_CONFLICTS
+            AS
+            SELECT
+                *,
+                CURRENT_TIMESTAMP AS conflict_dt
+            FROM
+                DWH_FACT_TRANSACTIONS
+            WHERE
+                false
+        """
+        )
+
+        cursor.execute(
+            """
+            INSERT INTO DWH_FACT_TRANSACTIONS_CONFLICTS
+            SELECT
+                *,
+                CURRENT_TIMESTAMP
+            FROM
+                DWH_FACT_TRANSACTIONS
+            WHERE
+                rowid IN (
+                    SELECT
+                        row_id
+                    FROM
+                        STG_DUPLICATE_TRANSACTIONS
+                )
+        """
+        )
+
+        cursor.execute(
+            """
+            DELETE FROM
+                DWH_FACT_TRANSACTIONS
+            WHERE
+                rowid IN (
+                    SELECT
+                        row_id
+                    FROM
+                        STG_DUPLICATE_TRANSACTIONS
+                )
+        """
+        )
+
+        print(f"duplicate transactions moved to DWH_FACT_TRANSACTIONS_CONFLICTS: {duplicates}")
+
+    cursor.execute("DROP TABLE STG_DUPLICATE_TRANSACTIONS")
+
+
+def migrate_schema():
+    """
+    - Bring the tables of an existing database to etl_schema
+    - Runs before etl_schema
+    """
+
+    # SCD2 table keeps several versions of an account
+    drop_primary_key("DWH_DIM_ACCOUNTS_HIST")
+
+    # SCD1 tables are loaded by an upsert on their key, a table left by a failed run
+    # of the earlier versions has no primary key
+    for spec in DIMENSIONS.values():
+        if spec["scd1"]:
+            add_primary_key(spec["scd1"], spec["key"])
+
+    # amounts are numbers, the rows loaded before are compared with the new ones
+    convert_amounts("DWH_FACT_TRANSACTIONS")
+    convert_amounts("DWH_FACT_TRANSACTIONS_CONFLICTS")
+
+    # trans_id is a unique key of DWH_FACT_TRANSACTIONS
+    move_duplicate_transactions()
+
+    # DWH_FACT_TRANSACTIONS is a view over the partitions by month
+    partition_fact_table()
+
+    # change detection of SCD2 tables by row_hash
+    for spec in DIMENSIONS.values():
+        if add_column(spec["hist"], "row_hash", "VARCHAR(32)"):
+            hash_hist(spec)
 
 
 def count_rows(table_name: str):
@@ -132,3 +466,132 @@ def show_all_tables():
     show_table("DWH_FACT_PASSPORT_BLACKLIST")
     show_table("DWH_FACT_TRANSACTIONS")
     show_table("REP_FRAUD")
+
+
+def trace_statement(sql: str):
+    """
+    - Remember a statement for report_full_scans
+    """
+
+    if TRACED_PATTERN.match(sql):
+        TRACED_STATEMENTS.setdefault(sql.strip(), None)
+
+
+def start_plan_check():
+    """
+    - Trace every statement executed by the connection and by the worker connections of run_stages
+    """
+
+    TRACED_STATEMENTS.clear()
+    conn.set_trace_callback(trace_statement)
+    WORKER_TRACE["callback"] = trace_statement
+
+
+@contextlib.contextmanager
+def untraced():
+    """
+    - Leave the statements executed in the block out of report_full_scans:
+      statements that read the whole history by design
+    """
+
+    traced = set(TRACED_STATEMENTS)
+
+    yield
+
+    for sql in set(TRACED_STATEMENTS) - traced:
+        del TRACED_STATEMENTS[sql]
+
+
+def full_scans(sql: str) -> list:
+    """
+    - Explain a statement and return its full scans:
+    - a table scan or an automatic index inside a join or a correlated subquery,
+      it is repeated for every row
+    - a scan of a table that grows with the history: the partitions of DWH_FACT_TRANSACTIONS
+      and the other facts, the SCD2 tables, unless it reads a partial index of the current versions
+    - Other scans of the outermost loop read the table once and are allowed
+    """
+
+    # the select of 'CREATE TABLE ... AS SELECT' is explained
+    match = re.match(r"\s*CREATE\s+TABLE\s.*?\bAS\b(.*)", sql, re.IGNORECASE | re.DOTALL)
+    if match:
+        sql = match.group(1)
+
+    plan = cursor.execute(f"EXPLAIN QUERY PLAN {sql}").fetchall()
+
+    parents = {node: parent for node, parent, _, _ in plan}
+    details = {node: detail for node, _, _, detail in plan}
+
+    # the plan names the tables by their aliases, an alias may name different tables
+    # in the arms of a compound select
+    aliases = {}
+    for table, alias in re.findall(r"\b(\w+)\s+(?:AS\s+)?(t\d+)\b(?!\.)", sql):
+        aliases.setdefault(alias.upper(), set()).add(table.upper())
+
+    # the tables of the indexes and the partial indexes of the current versions
+    index_tables, partial_indexes = {}, set()
+    for name, table, definition in cursor.execute(
+        "SELECT name, tbl_name, sql FROM SQLITE_MASTER WHERE type = 'index'"
+    ).fetchall():
+        index_tables[name.upper()] = table.upper()
+        if definition and " WHERE " in definition.upper():
+            partial_indexes.add(name.upper())
+
+    scans = []
+    # the first loop of every parent node
+    outer = set()
+
+    for node, parent, _, detail in plan:
+        if not detail.startswith(("SCAN", "SEARCH")):
+            continue
+
+        is_outer = parent not in outer
+        outer.add(parent)
+
+        # a correlated subquery is executed for every row of the outer query
+        ancestor, correlated = parent, False
+        while ancestor:
+            correlated = correlated or details.get(ancestor, "").startswith("CORRELATED")
+            ancestor = parents.get(ancestor, 0)
+
+        # system tables are small
+        if "SQLITE_MASTER" in detail.upper():
+            continue
+
+        full_scan = detail.startswith("SCAN") and "CONSTANT ROW" not in detail or "AUTOMATIC" in detail
+
+        words = detail.upper().split()
+        index = words[words.index("INDEX") + 1] if "INDEX" in words else None
+        tables = {index_tables[index]} if index in index_tables else aliases.get(words[1], {words[1]})
+        history_scan = index not in partial_indexes and any(HISTORY_PATTERN.fullmatch(table) for table in tables)
+
+        if full_scan and (correlated or not is_outer or history_scan):
+            scans.append(detail if tables == {words[1]} else f"{detail} ({', '.join(sorted(tables))})")
+
+    return scans
+
+
+def report_full_scans() -> int:
+    """
+    - Print the traced statements with full scans
+    - Must be called before the STG tables are dropped
+    - Returns the number of such statements
+    """
+
+    statements = 0
+
+    for sql in list(TRACED_STATEMENTS):
+        try:
+            scans = full_scans(sql)
+        except Exception:
+            # the statement refers to a table which does not exist anymore
+            continue
+
+        if scans:
+            statements += 1
+            print(f"full scan: {', '.join(scans)}")
+            print(sql)
+
+    TRACED_STATEMENTS.clear()
+
+    return statements
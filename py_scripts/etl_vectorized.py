@@ -0,0 +1,265 @@
+# Importing dependencies
+import datetime
+import numpy as np
+import pandas as pd
+from main import conn, cursor
+from .etl_load_db import MAX_DATE
+
+# VECTORIZED DETECTION
+
+# the rules of etl_data_mart evaluated by pandas over the transactions of STG_DETECTION_CARDS:
+# the transactions are sorted once by card and time, the windows are shifts of the sorted arrays
+
+# columns of an event of STG_REP_FRAUD without report_dt
+EVENT_COLUMNS = ["event_dt", "passport", "fio", "phone", "event_type"]
+
+
+def read_table(sql: str, params: dict = None) -> pd.DataFrame:
+    """
+    - Read the result of a query into a DataFrame
+    """
+
+    return pd.read_sql_query(sql, conn, params=params)
+
+
+def join(left: pd.DataFrame, right: pd.DataFrame, left_on: str, right_on: str, how: str = "inner") -> pd.DataFrame:
+    """
+    - Join of two DataFrames with the NULL semantics of sql: a NULL key has no match
+    """
+
+    right = right[right[right_on].notna()]
+
+    if how == "inner":
+        left = left[left[left_on].notna()]
+
+    return left.merge(right, how=how, left_on=left_on, right_on=right_on, suffixes=("", "_right"))
+
+
+def to_seconds(dates: pd.Series) -> np.ndarray:
+    """
+    - STRFTIME('%s', date) of every date, NaN if the date is NULL
+    """
+
+    dates = pd.to_datetime(dates, format="%Y-%m-%d %H:%M:%S", errors="coerce")
+
+    return (dates - pd.Timestamp(0)).dt.total_seconds().to_numpy()
+
+
+def read_dimensions(date: str) -> dict:
+    """
+    - DWH tables used by the rules, the conditions on one row of a dimension are evaluated by sqlite:
+    - cards: DWH_CARD_ENRICHMENT with passport_fraud and account_fraud
+    - terminals: current versions of DWH_DIM_TERMINALS_HIST
+    """
+
+    return {
+        "cards": read_table(
+            """
+            SELECT
+                card_num AS card,
+                passport_num AS passport,
+                fio,
+                phone,
+                COALESCE(
+                    :date >= passport_valid_to
+                    OR passport_num IN (
+                        SELECT
+                            passport_num
+                        FROM
+                            DWH_FACT_PASSPORT_BLACKLIST
+                    ),
+                    0
+                ) AS passport_fraud,
+                COALESCE(:date >= account_valid_to, 0) AS account_fraud
+            FROM
+                DWH_CARD_ENRICHMENT
+        """,
+            {"date": date}
+        ),
+        "terminals": read_table(
+            f"""
+            SELECT
+                terminal_id,
+                terminal_city
+            FROM
+                DWH_DIM_TERMINALS_HIST
+            WHERE
+                effective_to = {MAX_DATE}
+        """
+        )
+    }
+
+
+def client_events(dims: dict, transactions: pd.DataFrame, flag: str, event_type: int) -> pd.DataFrame:
+    """
+    - Passport and account fraud: every transaction of a card with the flag of the rule
+    """
+
+    cards = dims["cards"]
+
+    events = join(transactions, cards[cards[flag] == 1], "card_num", "card")
+
+    events["event_dt"] = events["trans_date"]
+    events["event_type"] = event_type
+
+    return events[EVENT_COLUMNS]
+
+
+def card_clients(dims: dict, events: pd.DataFrame, how: str = "inner") -> pd.DataFrame:
+    """
+    - Current client of the cards of the events from DWH_CARD_ENRICHMENT
+    """
+
+    return join(events, dims["cards"], "card_num", "card", how)
+
+
+def different_city_events(dims: dict, transactions: pd.DataFrame, lookback: int) -> pd.DataFrame:
+    """
+    - Different city fraud of detection_different_city_fraud: a transaction after a transaction
+      of the card in another city within lookback seconds
+    - The last transaction in another city is the last transaction of the previous run of the same city
+    - The transactions of a card from trans_from are evaluated
+    """
+
+    dates = transactions["trans_date"]
+    rows = transactions[dates.notna() & (dates.fillna("") >= transactions["city_from"])]
+
+    rows = join(rows, dims["terminals"], "terminal", "terminal_id")
+    rows = rows.sort_values(["card_num", "trans_date", "trans_id"], kind="stable")
+
+    groups = rows.groupby("card_num")
+    seconds = to_seconds(rows["trans_date"])
+
+    # the first transaction of a run: the time of the previous transaction
+    previous_city = groups["terminal_city"].shift(1)
+    run_start = (previous_city.notna() & (rows["terminal_city"] != previous_city)).to_numpy()
+    different_city = np.where(run_start, to_seconds(groups["trans_date"].shift(1)), -np.inf)
+
+    # carried to the other transactions of the run
+    different_city = pd.Series(different_city, index=rows.index).groupby(rows["card_num"]).cummax()
+
+    matched = (
+        (rows["trans_date"] >= rows["trans_from"]).to_numpy()
+        & (seconds - different_city.to_numpy() <= lookback)
+    )
+
+    events = rows.loc[matched, ["card_num", "trans_date"]]
+
+    events = card_clients(dims, events)
+
+    events["event_dt"] = events["trans_date"]
+    events["event_type"] = 3
+
+    return events[EVENT_COLUMNS]
+
+
+def sum_up_events(dims: dict, transactions: pd.DataFrame, chain: int, window: int) -> pd.DataFrame:
+    """
+    - Sum up fraud of detection_sum_up_fraud: a successful operation after chain rejected ones
+      with decreasing amounts within window seconds
+    - chain_length is the length of the run of rejected operations with decreasing amounts
+      before the operation
+    - The transactions of a card from trans_from are evaluated
+    """
+
+    dates = transactions["trans_date"]
+    rows = transactions[dates.notna() & (dates.fillna("") >= transactions["sum_up_from"])]
+    rows = rows.sort_values(["card_num", "trans_date", "trans_id"], kind="stable")
+
+    groups = rows.groupby("card_num")
+    amt = rows["amt"].to_numpy(dtype=float)
+
+    previous_rejected = (groups["oper_result"].shift(1) == "REJECT").to_numpy()
+    decreasing = amt < groups["amt"].shift(1).to_numpy(dtype=float)
+
+    # a rejected operation less than the previous rejected one continues the run,
+    # the first operation of a run keeps its row number
+    row_number = groups.cumcount().to_numpy() + 1
+    continued = (rows["oper_result"] == "REJECT").to_numpy() & previous_rejected & decreasing
+    run_start = pd.Series(np.where(continued, 0, row_number), index=rows.index)
+    run_start = run_start.groupby(rows["card_num"]).cummax().groupby(rows["card_num"]).shift(1)
+
+    chain_length = row_number - run_start.to_numpy(dtype=float)
+    chain_seconds = to_seconds(rows["trans_date"]) - to_seconds(groups["trans_date"].shift(chain))
+
+    matched = (
+        (rows["trans_date"] >= rows["trans_from"]).to_numpy()
+        & (rows["oper_result"] == "SUCCESS").to_numpy()
+        & previous_rejected
+        & decreasing
+        & (chain_length >= chain)
+        & (chain_seconds <= window)
+    )
+
+    events = rows.loc[matched, ["card_num", "trans_date"]]
+    events = card_clients(dims, events, "left")
+
+    events["event_dt"] = events["trans_date"]
+    events["event_type"] = 4
+
+    return events[EVENT_COLUMNS]
+
+
+def insert_events(events: pd.DataFrame):
+    """
+    - Insert events into STG_REP_FRAUD, NaN is NULL
+    """
+
+    events = events.astype(object).where(events.notna(), None)
+
+    cursor.executemany(
+        """
+        INSERT INTO STG_REP_FRAUD (
+            event_dt,
+            passport,
+            fio,
+            phone,
+            event_type,
+            report_dt
+        ) VALUES (?, ?, ?, ?, ?, DATETIME('now'))
+    """,
+        events.itertuples(index=False, name=None)
+    )
+
+
+def detection_vectorized_fraud(date: str, lookback: int, chain: int, window: int):
+    """
+    - Searching all fraud types with pandas over the staging tables of create_detection_scope
+    - Inserts the same rows into STG_REP_FRAUD as the sql rules, in the order of the rules
+    - lookback: the city lookback of detection_different_city_fraud
+    - chain, window: the sum up chain of detection_sum_up_fraud
+    """
+
+    # convert date to format '%Y-%m-%d'
+    date = datetime.datetime.strptime(date, "%d%m%Y").date().isoformat()
+
+    dims = read_dimensions(date)
+
+    # transactions of the passport and account rules
+    transactions = read_table("SELECT * FROM STG_DETECTION_TRANSACTIONS")
+
+    # history of the cards of the window rules
+    history = read_table(
+        """
+        SELECT
+            t1.*,
+            t0.trans_from,
+            t0.city_from,
+            t0.sum_up_from
+        FROM
+            STG_DETECTION_CARDS t0
+            INNER JOIN STG_DETECTION_HISTORY t1 ON t0.card_num = t1.card_num
+    """
+    )
+
+    # searching passport fraud
+    insert_events(client_events(dims, transactions, "passport_fraud", 1))
+
+    # searching account fraud
+    insert_events(client_events(dims, transactions, "account_fraud", 2))
+
+    # searching different city fraud
+    insert_events(different_city_events(dims, history, lookback))
+
+    # searching sum up fraud
+    insert_events(sum_up_events(dims, history, chain, window))
@@ -0,0 +1,6 @@
+-- DROP TABLES
+
+-- Clear staging tables from ddl_dml.sql
+DROP TABLE IF EXISTS CARDS;
+DROP TABLE IF EXISTS ACCOUNTS;
+DROP TABLE IF EXISTS CLIENTS;
@@ -2,15 +2,19 @@
 
 -- create FACT tables
 
--- create table DWH_FACT_TRANSACTIONS 
-CREATE TABLE IF NOT EXISTS DWH_FACT_TRANSACTIONS (
+-- DWH_FACT_TRANSACTIONS is a view over the partitions DWH_FACT_TRANSACTIONS_YYYYMM,
+-- the partitions, the view, META_ARCHIVED_TRANSACTIONS and META_LOADED_TRANSACTIONS are created by etl_partitions.py
+
+-- create table DWH_FACT_TRANSACTIONS_CONFLICTS: rows with a loaded trans_id and different content
+CREATE TABLE IF NOT EXISTS DWH_FACT_TRANSACTIONS_CONFLICTS (
     trans_id VARCHAR(128),
     trans_date DATE,
     card_num VARCHAR(128),
     oper_type VARCHAR(128),
     amt DECIMAL(10,2),
     oper_result VARCHAR(128),
-    terminal VARCHAR(128)
+    terminal VARCHAR(128),
+    conflict_dt DATETIME DEFAULT CURRENT_TIMESTAMP
 );
 
 -- create table DWH_FACT_PASSPORT_BLACKLIST 
@@ -20,11 +24,13 @@ CREATE TABLE IF NOT EXISTS DWH_FACT_PASSPORT_BLACKLIST (
 );
 
 -- create a SCD2 table for where data will be loaded
+-- row_hash: ROW_HASH of the tracked attributes of the version
 
 -- create DWH_DIM_CARDS_HIST
 CREATE TABLE IF NOT EXISTS DWH_DIM_CARDS_HIST (
     card_num VARCHAR(128),
     account_num VARCHAR(128),
+    row_hash VARCHAR(32),
     deleted_flg INTEGER DEFAULT 0,
     effective_from DATETIME DEFAULT (
         DATETIME('2001-01-01')
@@ -36,9 +42,10 @@ CREATE TABLE IF NOT EXISTS DWH_DIM_CARDS_HIST (
 
 -- create DWH_DIM_ACCOUNTS_HIST
 CREATE TABLE IF NOT EXISTS DWH_DIM_ACCOUNTS_HIST (
-    account_num VARCHAR(128) PRIMARY KEY,
+    account_num VARCHAR(128),
     valid_to DATE,
     client VARCHAR(128),
+    row_hash VARCHAR(32),
     deleted_flg INTEGER DEFAULT 0,
     effective_from DATETIME DEFAULT (
         DATETIME('1900-01-01')
@@ -58,6 +65,7 @@ CREATE TABLE IF NOT EXISTS DWH_DIM_CLIENTS_HIST (
     passport_num VARCHAR(128),
     passport_valid_to DATE,
     phone VARCHAR(128),
+    row_hash VARCHAR(32),
     deleted_flg INTEGER DEFAULT 0,
     effective_from DATETIME DEFAULT (
         DATETIME('1900-01-01')
@@ -73,6 +81,7 @@ CREATE TABLE IF NOT EXISTS DWH_DIM_TERMINALS_HIST (
     terminal_type VARCHAR(128),
     terminal_city VARCHAR(128),
     terminal_address VARCHAR(128),
+    row_hash VARCHAR(32),
     deleted_flg INTEGER DEFAULT 0,
     effective_from DATETIME DEFAULT CURRENT_TIMESTAMP,
     effective_to DATETIME DEFAULT (
@@ -104,6 +113,31 @@ CREATE TABLE IF NOT EXISTS META_TABLE AS
         AND tbl_name NOT LIKE "sqlite%"
         AND tbl_name NOT LIKE "META%";
 
+-- create META_LOAD_MANIFEST: loaded input files
+CREATE TABLE IF NOT EXISTS META_LOAD_MANIFEST (
+    file_hash VARCHAR(64) PRIMARY KEY,
+    file_name VARCHAR(128),
+    file_size INTEGER,
+    row_count INTEGER,
+    load_status VARCHAR(16),
+    load_dt DATETIME DEFAULT CURRENT_TIMESTAMP
+);
+
+-- create META_WATERMARK: last change date (update_dt or create_dt) of the loaded rows of a source table
+CREATE TABLE IF NOT EXISTS META_WATERMARK (
+    tbl_name VARCHAR(128) PRIMARY KEY,
+    watermark DATETIME,
+    load_dt DATETIME DEFAULT CURRENT_TIMESTAMP
+);
+
+-- create META_PARTITIONS: partitions of DWH_FACT_TRANSACTIONS moved to the archive
+CREATE TABLE IF NOT EXISTS META_PARTITIONS (
+    partition_name VARCHAR(128) PRIMARY KEY,
+    row_count INTEGER,
+    archive_file VARCHAR(256),
+    archive_dt DATETIME DEFAULT CURRENT_TIMESTAMP
+);
+
 -- Create a STG tables
 
 -- create STG_CARDS
@@ -111,7 +145,8 @@ CREATE TABLE IF NOT EXISTS STG_CARDS (
     card_num VARCHAR(128),
     account_num VARCHAR(128),
     create_dt DATE,
-    update_dt DATE
+    update_dt DATE,
+    row_hash VARCHAR(32)
 );
 
 -- create STG_ACCOUNTS 
@@ -120,7 +155,8 @@ CREATE TABLE IF NOT EXISTS STG_ACCOUNTS (
     valid_to DATE,
     client VARCHAR(128),
     create_dt DATE,
-    update_dt DATE
+    update_dt DATE,
+    row_hash VARCHAR(32)
 );
 
 -- create STG_CLIENTS
@@ -134,7 +170,34 @@ CREATE TABLE IF NOT EXISTS STG_CLIENTS (
     passport_valid_to DATE,
     phone VARCHAR(128),
     create_dt DATE,
-    update_dt DATE
+    update_dt DATE,
+    row_hash VARCHAR(32)
+);
+
+-- create STG_TRANSACTIONS
+CREATE TABLE IF NOT EXISTS STG_TRANSACTIONS (
+    trans_id VARCHAR(128),
+    trans_date DATE,
+    card_num VARCHAR(128),
+    oper_type VARCHAR(128),
+    amt DECIMAL(10,2),
+    oper_result VARCHAR(128),
+    terminal VARCHAR(128)
+);
+
+-- create STG_TERMINALS
+CREATE TABLE IF NOT EXISTS STG_TERMINALS (
+    terminal_id VARCHAR(128),
+    terminal_type VARCHAR(128),
+    terminal_city VARCHAR(128),
+    terminal_address VARCHAR(128),
+    row_hash VARCHAR(32)
+);
+
+-- create STG_PASSPORT_BLACKLIST
+CREATE TABLE IF NOT EXISTS STG_PASSPORT_BLACKLIST (
+    passport_num VARCHAR(128),
+    entry_dt DATE
 );
 
 -- create STG_REP_FRAUD
@@ -151,7 +214,7 @@ CREATE TABLE IF NOT EXISTS STG_REP_FRAUD (
 
 -- create DWH_DIM_CARDS
 CREATE TABLE IF NOT EXISTS DWH_DIM_CARDS (
-    card_num VARCHAR(128),
+    card_num VARCHAR(128) PRIMARY KEY,
     account_num VARCHAR(128),
     create_dt DATE,
     update_dt DATE
@@ -159,7 +222,7 @@ CREATE TABLE IF NOT EXISTS DWH_DIM_CARDS (
 
 -- create DWH_DIM_ACCOUNTS 
 CREATE TABLE IF NOT EXISTS DWH_DIM_ACCOUNTS (
-    account_num VARCHAR(128),
+    account_num VARCHAR(128) PRIMARY KEY,
     valid_to DATE,
     client VARCHAR(128),
     create_dt DATE,
@@ -168,7 +231,7 @@ CREATE TABLE IF NOT EXISTS DWH_DIM_ACCOUNTS (
 
 -- create DWH_DIM_CLIENTS
 CREATE TABLE IF NOT EXISTS DWH_DIM_CLIENTS (
-    client_id VARCHAR(128),
+    client_id VARCHAR(128) PRIMARY KEY,
     last_name VARCHAR(128),
     first_name VARCHAR(128),
     patronymic VARCHAR(128),
@@ -178,4 +241,85 @@ CREATE TABLE IF NOT EXISTS DWH_DIM_CLIENTS (
     phone VARCHAR(128),
     create_dt DATE,
     update_dt DATE
-);
\ No newline at end of file
+);
+
+-- create DWH_CARD_ENRICHMENT: current account and client of every card for the data mart
+CREATE TABLE IF NOT EXISTS DWH_CARD_ENRICHMENT (
+    card_num VARCHAR(128) PRIMARY KEY,
+    account_num VARCHAR(128),
+    client_id VARCHAR(128),
+    passport_num VARCHAR(128),
+    fio VARCHAR(364),
+    phone VARCHAR(128),
+    passport_valid_to DATE,
+    account_valid_to DATE,
+    update_dt DATETIME DEFAULT CURRENT_TIMESTAMP
+);
+
+-- CREATE INDEXES
+
+-- FACT tables
+
+-- the indexes of DWH_FACT_TRANSACTIONS partitions are created by etl_partitions.py
+
+-- covering index for the dedup of the accumulated blacklist and for passport lookups
+CREATE INDEX IF NOT EXISTS DWH_FACT_PASSPORT_BLACKLIST_PASSPORT_NUM_IDX
+    ON DWH_FACT_PASSPORT_BLACKLIST (passport_num, entry_dt);
+
+-- SCD2 tables: every lookup reads the current versions only,
+-- the partial indexes skip the closed versions accumulated by the history
+
+-- replaced by the partial indexes of the current versions
+DROP INDEX IF EXISTS DWH_DIM_CARDS_HIST_CARD_NUM_IDX;
+DROP INDEX IF EXISTS DWH_DIM_CARDS_HIST_ACCOUNT_NUM_IDX;
+DROP INDEX IF EXISTS DWH_DIM_ACCOUNTS_HIST_ACCOUNT_NUM_IDX;
+DROP INDEX IF EXISTS DWH_DIM_ACCOUNTS_HIST_CLIENT_IDX;
+DROP INDEX IF EXISTS DWH_DIM_CLIENTS_HIST_CLIENT_ID_IDX;
+DROP INDEX IF EXISTS DWH_DIM_TERMINALS_HIST_TERMINAL_ID_IDX;
+
+CREATE INDEX IF NOT EXISTS DWH_DIM_CARDS_HIST_CURRENT_CARD_NUM_IDX
+    ON DWH_DIM_CARDS_HIST (card_num)
+    WHERE effective_to = DATETIME('2999-12-31 23:59:59');
+
+CREATE INDEX IF NOT EXISTS DWH_DIM_CARDS_HIST_CURRENT_ACCOUNT_NUM_IDX
+    ON DWH_DIM_CARDS_HIST (account_num)
+    WHERE effective_to = DATETIME('2999-12-31 23:59:59');
+
+CREATE INDEX IF NOT EXISTS DWH_DIM_ACCOUNTS_HIST_CURRENT_ACCOUNT_NUM_IDX
+    ON DWH_DIM_ACCOUNTS_HIST (account_num)
+    WHERE effective_to = DATETIME('2999-12-31 23:59:59');
+
+CREATE INDEX IF NOT EXISTS DWH_DIM_ACCOUNTS_HIST_CURRENT_CLIENT_IDX
+    ON DWH_DIM_ACCOUNTS_HIST (client)
+    WHERE effective_to = DATETIME('2999-12-31 23:59:59');
+
+CREATE INDEX IF NOT EXISTS DWH_DIM_CLIENTS_HIST_CURRENT_CLIENT_ID_IDX
+    ON DWH_DIM_CLIENTS_HIST (client_id)
+    WHERE effective_to = DATETIME('2999-12-31 23:59:59');
+
+-- covering index for the join of transactions with the city of the terminal
+CREATE INDEX IF NOT EXISTS DWH_DIM_TERMINALS_HIST_CURRENT_TERMINAL_ID_IDX
+    ON DWH_DIM_TERMINALS_HIST (terminal_id, terminal_city)
+    WHERE effective_to = DATETIME('2999-12-31 23:59:59');
+
+-- STG tables
+
+-- snapshots are searched by key by the loading of SCD2 tables
+CREATE INDEX IF NOT EXISTS STG_CARDS_CARD_NUM_IDX
+    ON STG_CARDS (card_num);
+
+CREATE INDEX IF NOT EXISTS STG_ACCOUNTS_ACCOUNT_NUM_IDX
+    ON STG_ACCOUNTS (account_num);
+
+CREATE INDEX IF NOT EXISTS STG_CLIENTS_CLIENT_ID_IDX
+    ON STG_CLIENTS (client_id);
+
+-- deleted terminals are searched in the snapshot
+CREATE INDEX IF NOT EXISTS STG_TERMINALS_TERMINAL_ID_IDX
+    ON STG_TERMINALS (terminal_id);
+
+-- Data Mart
+
+-- dedup of the report
+CREATE INDEX IF NOT EXISTS REP_FRAUD_PASSPORT_IDX
+    ON REP_FRAUD (passport, event_dt);
@@ -1,52 +1,39 @@
 -- DROP TABLES
 
--- Clear staging tables from ddl_dml.sql
-DROP TABLE IF EXISTS CARDS;
-DROP TABLE IF EXISTS ACCOUNTS;
-DROP TABLE IF EXISTS CLIENTS;
-
--- CARDS
+-- SCD1 tables
 DROP TABLE IF EXISTS STG_CARDS;
-DROP TABLE IF EXISTS STG_NOT_MATCHED_ROWS_CARDS;
-DROP TABLE IF EXISTS STG_MATCHED_ROWS_CARDS;
-DROP TABLE IF EXISTS STG_NEW_ROWS_CARDS;
-DROP TABLE IF EXISTS STG_DELETED_ROWS_CARDS;
-DROP TABLE IF EXISTS STG_CHANGED_ROWS_CARDS;
-
--- ACCOUNTS
 DROP TABLE IF EXISTS STG_ACCOUNTS;
-DROP TABLE IF EXISTS STG_NOT_MATCHED_ROWS_ACCOUNTS;
-DROP TABLE IF EXISTS STG_MATCHED_ROWS_ACCOUNTS;
-DROP TABLE IF EXISTS STG_NEW_ROWS_ACCOUNTS;
-DROP TABLE IF EXISTS STG_DELETED_ROWS_ACCOUNTS;
-DROP TABLE IF EXISTS STG_CHANGED_ROWS_ACCOUNTS;
-
--- CLIENTS
 DROP TABLE IF EXISTS STG_CLIENTS;
-DROP TABLE IF EXISTS STG_NOT_MATCHED_ROWS_CLIENTS;
-DROP TABLE IF EXISTS STG_MATCHED_ROWS_CLIENTS;
-DROP TABLE IF EXISTS STG_NEW_ROWS_CLIENTS;
-DROP TABLE IF EXISTS STG_DELETED_ROWS_CLIENTS;
-DROP TABLE IF EXISTS STG_CHANGED_ROWS_CLIENTS;
 
--- DIM tables between staging and final DIM tables
-DROP TABLE IF EXISTS DWH_DIM_CARDS;
-DROP TABLE IF EXISTS DWH_DIM_CLIENTS;
-DROP TABLE IF EXISTS DWH_DIM_ACCOUNTS;
+-- SCD2 tables: new, changed and deleted rows
+DROP TABLE IF EXISTS STG_DIFF_CARDS;
+DROP TABLE IF EXISTS STG_DIFF_ACCOUNTS;
+DROP TABLE IF EXISTS STG_DIFF_CLIENTS;
+DROP TABLE IF EXISTS STG_DIFF_TERMINALS;
+
+-- cards loaded into DWH_CARD_ENRICHMENT
+DROP TABLE IF EXISTS STG_CARD_ENRICHMENT;
 
 -- TERMINALS
 DROP TABLE IF EXISTS STG_TERMINALS;
-DROP TABLE IF EXISTS STG_NEW_ROWS_TERMINALS;
-DROP TABLE IF EXISTS STG_DELETED_ROWS_TERMINALS;
-DROP TABLE IF EXISTS STG_CHANGED_ROWS_TERMINALS;
+
+-- views of the previous versions of the loading
+DROP VIEW IF EXISTS STG_VIEW_CARDS;
+DROP VIEW IF EXISTS STG_VIEW_ACCOUNTS;
+DROP VIEW IF EXISTS STG_VIEW_CLIENTS;
+DROP VIEW IF EXISTS STG_VIEW_TERMINALS;
 
 -- TRANSACTIONS
 DROP TABLE IF EXISTS STG_TRANSACTIONS;
+DROP TABLE IF EXISTS STG_TRANSACTION_PARTITIONS;
 
 -- PASSPORT_BLACKLIST
 DROP TABLE IF EXISTS STG_PASSPORT_BLACKLIST;
 
 -- REP_FRAUD
 DROP TABLE IF EXISTS STG_REP_FRAUD;
+DROP TABLE IF EXISTS STG_DETECTION_CARDS;
+DROP TABLE IF EXISTS STG_DETECTION_HISTORY;
+DROP TABLE IF EXISTS STG_DETECTION_TRANSACTIONS;
 DROP VIEW IF EXISTS STG_DETECTION_FRAUD_DIFFERENT_CITY;
 DROP VIEW IF EXISTS STG_DETECTION_FRAUD_SUM_UP;
\ No newline at end of file
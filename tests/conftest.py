@@ -0,0 +1,167 @@
+# Import dependencies
+import collections
+import os
+import pathlib
+import shutil
+import sys
+import pytest
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+
+# the tables of ddl_dml.sql
+SNAPSHOT_TABLES = {
+    "cards": "card_num VARCHAR(128), account VARCHAR(128), create_dt DATE, update_dt DATE",
+    "accounts": "account VARCHAR(128), valid_to DATE, client INTEGER, create_dt DATE, update_dt DATE",
+    "clients": """client_id INTEGER, last_name VARCHAR(128), first_name VARCHAR(128), patronymic VARCHAR(128),
+        date_of_birth DATE, passport_num VARCHAR(128), passport_valid_to DATE, phone VARCHAR(128),
+        create_dt DATE, update_dt DATE"""
+}
+
+# terminal_id, terminal_type, terminal_city, terminal_address
+TERMINALS = [
+    ("P0001", "POS", "Москва", "ул. Ленина, 1"),
+    ("P0002", "POS", "Москва", "ул. Тверская, 2"),
+    ("A0001", "ATM", "Казань", "ул. Баумана, 1")
+]
+
+
+class Warehouse:
+    """
+    - The fixture database of the tests: the steps of execute_etl_day over rows instead of files
+    """
+
+    def __init__(self, ps, etl_tools, conn, cursor):
+        self.ps = ps
+        self.etl_tools = etl_tools
+        self.conn = conn
+        self.cursor = cursor
+
+    def reset(self):
+        """
+        - Drop every table and create the schema again
+        """
+
+        with self.ps.transaction():
+            objects = self.cursor.execute(
+                "SELECT type, name FROM SQLITE_MASTER WHERE type IN ('view', 'table') AND name NOT LIKE 'sqlite_%' "
+                "ORDER BY type = 'table'"
+            ).fetchall()
+
+            for object_type, name in objects:
+                self.cursor.execute(f"DROP {object_type} IF EXISTS {name}")
+
+            self.ps.migrate_schema()
+            self.ps.load_sql_db("etl_schema")
+
+    def load_snapshot(self, cards: list, accounts: list, clients: list):
+        """
+        - Replace the tables of ddl_dml.sql
+        """
+
+        for (name, columns), rows in zip(SNAPSHOT_TABLES.items(), [cards, accounts, clients]):
+            self.cursor.execute(f"DROP TABLE IF EXISTS {name}")
+            self.cursor.execute(f"CREATE TABLE {name} ({columns})")
+
+            if rows:
+                self.cursor.executemany(f"INSERT INTO {name} VALUES ({', '.join('?' * len(rows[0]))})", rows)
+
+    def load_day(self, date: str, transactions: list, snapshot: tuple = None, passport_blacklist: list = (),
+                 terminals: list = TERMINALS, statements: list = (), detector: str = "sql", commit: bool = True):
+        """
+        - Load a day and build the data mart
+        - snapshot: (cards, accounts, clients) of a new full snapshot, None keeps the snapshot tables
+        - statements: run before the staging, changes of the snapshot tables
+        - commit: False rolls the day back, the same day is loaded again by the next call
+        - Returns the events of STG_REP_FRAUD: Counter of (event_dt, passport, fio, phone, event_type)
+          and the traced statements with full scans: sql -> scans
+        """
+
+        self.etl_tools.start_plan_check()
+
+        self.cursor.execute("BEGIN IMMEDIATE")
+
+        try:
+            self.ps.load_sql_db("etl_schema")
+
+            if snapshot is not None:
+                self.load_snapshot(*snapshot)
+
+            for statement in statements:
+                self.cursor.execute(statement)
+
+            self.cursor.executemany(
+                "INSERT INTO STG_TERMINALS (terminal_id, terminal_type, terminal_city, terminal_address) "
+                "VALUES (?, ?, ?, ?)",
+                terminals
+            )
+            self.cursor.executemany("INSERT INTO STG_TRANSACTIONS VALUES (?, ?, ?, ?, ?, ?, ?)", transactions)
+            self.cursor.executemany("INSERT INTO STG_PASSPORT_BLACKLIST VALUES (?, ?)", passport_blacklist)
+
+            self.ps.load_dim_fact_tables(snapshot is not None)
+            self.ps.build_data_mart(date, detector)
+
+            events = collections.Counter(
+                self.cursor.execute("SELECT event_dt, passport, fio, phone, event_type FROM STG_REP_FRAUD")
+            )
+            scans = self.traced_full_scans()
+
+            self.ps.load_sql_db("etl_stg_drop")
+        except BaseException:
+            self.cursor.execute("ROLLBACK")
+            raise
+
+        self.cursor.execute("COMMIT" if commit else "ROLLBACK")
+
+        return events, scans
+
+    def traced_full_scans(self) -> dict:
+        """
+        - The traced statements with full scans: sql -> scans
+        """
+
+        scans = {sql: self.etl_tools.full_scans(sql) for sql in list(self.etl_tools.TRACED_STATEMENTS)}
+
+        return {sql: sql_scans for sql, sql_scans in scans.items() if sql_scans}
+
+    def rows(self, sql: str) -> list:
+        """
+        - Rows of a query
+        """
+
+        return self.cursor.execute(sql).fetchall()
+
+
+@pytest.fixture(scope="session")
+def etl(tmp_path_factory):
+    """
+    - Warehouse of the session: main connects to database.db of the working directory once per process,
+      the sql scripts are read from it
+    """
+
+    cwd = os.getcwd()
+    workdir = tmp_path_factory.mktemp("etl")
+    shutil.copytree(ROOT / "sql_scripts", workdir / "sql_scripts")
+    os.chdir(workdir)
+    sys.path.insert(0, str(ROOT))
+
+    import py_scripts as ps
+    from py_scripts import etl_tools
+    from main import conn, cursor
+
+    # WAL as in execute_etl
+    ps.use_profile("bulk_load")
+
+    yield Warehouse(ps, etl_tools, conn, cursor)
+
+    os.chdir(cwd)
+
+
+@pytest.fixture
+def warehouse(etl):
+    """
+    - Empty warehouse of a test
+    """
+
+    etl.reset()
+
+    return etl
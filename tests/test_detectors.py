@@ -0,0 +1,86 @@
+# Import dependencies
+import pytest
+
+# DETECTORS of py_scripts, the package is imported by the fixture
+DETECTORS = ["sql", "vectorized", "stream"]
+
+CARD_1 = "1111 0000 0000 0001"
+CARD_2 = "1111 0000 0000 0002"
+CARD_3 = "1111 0000 0000 0003"
+
+# card 3 has no account: its events need a known card or have no client
+CARDS = [
+    (CARD_1, "40817810000000000001", "2021-01-01", None),
+    (CARD_2, "40817810000000000002", "2021-01-01", None)
+]
+
+# the account of card 2 expires on the second day
+ACCOUNTS = [
+    ("40817810000000000001", "2022-01-01", 1, "2021-01-01", None),
+    ("40817810000000000002", "2021-03-02", 2, "2021-01-01", None)
+]
+
+CLIENTS = [
+    (1, "Иванов", "Иван", "Иванович", "1980-01-01", "0000 000001", None, "+7 900 000-00-01", "2021-01-01", None),
+    (2, "Петров", "Петр", "Петрович", "1980-01-01", "0000 000002", "2022-01-01", "+7 900 000-00-02", "2021-01-01", None)
+]
+
+# trans_id, trans_date, card_num, oper_type, amt, oper_result, terminal
+DAYS = [
+    ("01032021", [
+        ("1", "2021-03-01 10:00:00", CARD_1, "PAYMENT", 100.0, "SUCCESS", "P0001"),
+        ("2", "2021-03-01 10:30:00", CARD_1, "PAYMENT", 100.0, "SUCCESS", "P0002"),
+        ("3", "2021-03-01 11:00:00", CARD_2, "PAYMENT", 500.0, "REJECT", "P0001"),
+        ("4", "2021-03-01 11:05:00", CARD_2, "PAYMENT", 400.0, "REJECT", "P0001"),
+        ("5", "2021-03-01 11:10:00", CARD_2, "PAYMENT", 300.0, "REJECT", "P0001"),
+        ("6", "2021-03-01 11:15:00", CARD_2, "PAYMENT", 200.0, "SUCCESS", "P0001"),
+        ("7", "2021-03-01 12:00:00", CARD_3, "PAYMENT", 100.0, "SUCCESS", "P0001"),
+        ("8", "2021-03-01 12:10:00", CARD_3, "PAYMENT", 100.0, "SUCCESS", "A0001")
+    ], []),
+    # a late transaction in another city between two loaded ones, the expired account of card 2
+    # and the blacklisted passport of card 1
+    ("02032021", [
+        ("9", "2021-03-01 10:20:00", CARD_1, "PAYMENT", 100.0, "SUCCESS", "A0001"),
+        ("10", "2021-03-02 09:00:00", CARD_2, "PAYMENT", 100.0, "SUCCESS", "P0001"),
+        ("11", "2021-03-02 09:30:00", CARD_3, "PAYMENT", 100.0, "SUCCESS", "P0001")
+    ], [("0000 000001", "2021-03-02")]),
+    # a late rejected operation completes a chain before a loaded successful one
+    ("03032021", [
+        ("12", "2021-03-02 08:50:00", CARD_2, "PAYMENT", 900.0, "REJECT", "P0001"),
+        ("13", "2021-03-02 08:55:00", CARD_2, "PAYMENT", 800.0, "REJECT", "P0001"),
+        ("14", "2021-03-02 08:58:00", CARD_2, "PAYMENT", 700.0, "REJECT", "P0001")
+    ], [])
+]
+
+
+def test_detectors_report_the_same_events(warehouse):
+    snapshot = (CARDS, ACCOUNTS, CLIENTS)
+
+    for date, transactions, passport_blacklist in DAYS:
+        events = {
+            detector: warehouse.load_day(
+                date, transactions, snapshot, passport_blacklist, detector=detector, commit=False
+            )[0]
+            for detector in DETECTORS
+        }
+
+        assert events["sql"], date
+        assert events["vectorized"] == events["sql"], date
+        assert events["stream"] == events["sql"], date
+
+        # the day is loaded once more and kept for the next one
+        warehouse.load_day(date, transactions, snapshot, passport_blacklist)
+        snapshot = None
+
+
+@pytest.mark.parametrize("detector", DETECTORS)
+def test_late_transaction_changes_loaded_events(warehouse, detector):
+    warehouse.load_day("01032021", DAYS[0][1][:2], (CARDS, ACCOUNTS, CLIENTS))
+
+    events, _ = warehouse.load_day("02032021", DAYS[1][1][:1], detector=detector)
+
+    # the late transaction and the loaded transaction after it in another city
+    assert sorted((event_dt, event_type) for event_dt, *_, event_type in events.elements()) == [
+        ("2021-03-01 10:20:00", "3"),
+        ("2021-03-01 10:30:00", "3")
+    ]
@@ -0,0 +1,60 @@
+# Import dependencies
+import pytest
+
+# DETECTORS of py_scripts, the package is imported by the fixture
+DETECTORS = ["sql", "vectorized", "stream"]
+
+CARD = "1111 0000 0000 0001"
+
+SNAPSHOT = (
+    [(CARD, "40817810000000000001", "2021-01-01", None)],
+    [("40817810000000000001", "2022-01-01", 1, "2021-01-01", None)],
+    [(1, "Иванов", "Иван", "Иванович", "1980-01-01", "0000 000001", None, "+7 900 000-00-01", "2021-01-01", None)]
+)
+
+
+def city_events(warehouse, detector: str, transactions: list) -> list:
+    """
+    - event_dt of the different city events of one day, an event per row
+    """
+
+    rows = [
+        (str(number), trans_date, CARD, "PAYMENT", 100.0, "SUCCESS", terminal)
+        for number, (trans_date, terminal) in enumerate(transactions)
+    ]
+
+    events, _ = warehouse.load_day("01032021", rows, SNAPSHOT, detector=detector)
+
+    return sorted(event_dt for event_dt, *_, event_type in events.elements() if event_type == "3")
+
+
+@pytest.mark.parametrize("detector", DETECTORS)
+def test_run_of_the_same_city_keeps_the_other_city(warehouse, detector):
+    # Москва, Москва, Казань, Казань within the hour: the last time in another city is carried by the run
+    assert city_events(warehouse, detector, [
+        ("2021-03-01 10:00:00", "P0001"),
+        ("2021-03-01 10:10:00", "P0002"),
+        ("2021-03-01 10:30:00", "A0001"),
+        ("2021-03-01 10:40:00", "A0001")
+    ]) == ["2021-03-01 10:30:00", "2021-03-01 10:40:00"]
+
+
+@pytest.mark.parametrize("detector", DETECTORS)
+def test_one_event_per_transaction(warehouse, detector):
+    # two transactions in Москва before the transaction in Казань
+    assert city_events(warehouse, detector, [
+        ("2021-03-01 10:00:00", "P0001"),
+        ("2021-03-01 10:05:00", "P0002"),
+        ("2021-03-01 10:10:00", "A0001")
+    ]) == ["2021-03-01 10:10:00"]
+
+
+@pytest.mark.parametrize("detector", DETECTORS)
+def test_another_city_after_the_lookback(warehouse, detector):
+    # 3600 seconds are inside the lookback, 3601 seconds are not
+    assert city_events(warehouse, detector, [
+        ("2021-03-01 10:00:00", "P0001"),
+        ("2021-03-01 11:00:00", "A0001"),
+        ("2021-03-01 13:00:00", "P0001"),
+        ("2021-03-01 14:00:01", "A0001")
+    ]) == ["2021-03-01 11:00:00"]
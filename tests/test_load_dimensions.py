@@ -0,0 +1,32 @@
+CARD_1 = ("1111 0000 0000 0001", "40817810000000000001", "2021-02-01", None)
+CARD_2 = ("1111 0000 0000 0002", "40817810000000000002", "2021-01-01", None)
+
+ACCOUNTS = [
+    ("40817810000000000001", "2022-01-01", 1, "2021-01-01", None),
+    ("40817810000000000002", "2022-01-01", 2, "2021-01-01", None)
+]
+
+CLIENTS = [
+    (1, "Иванов", "Иван", "Иванович", "1980-01-01", "0000 000001", None, "+7 900 000-00-01", "2021-01-01", None),
+    (2, "Петров", "Петр", "Петрович", "1980-01-01", "0000 000002", None, "+7 900 000-00-02", "2021-01-01", None)
+]
+
+
+def test_full_snapshot_restores_deleted_key(warehouse):
+    # card 2 is deleted by the second snapshot and is back in the third one,
+    # its create_dt is older than the watermark set by card 1
+    warehouse.load_day("01032021", [], ([CARD_1, CARD_2], ACCOUNTS, CLIENTS))
+    warehouse.load_day("02032021", [], ([CARD_1], ACCOUNTS, CLIENTS))
+
+    assert warehouse.rows("SELECT card_num FROM DWH_DIM_CARDS") == [(CARD_1[0],)]
+
+    warehouse.load_day("03032021", [], ([CARD_1, CARD_2], ACCOUNTS, CLIENTS))
+
+    assert sorted(warehouse.rows("SELECT card_num FROM DWH_DIM_CARDS")) == [(CARD_1[0],), (CARD_2[0],)]
+    assert warehouse.rows(
+        f"""SELECT deleted_flg FROM DWH_DIM_CARDS_HIST
+        WHERE card_num = '{CARD_2[0]}' AND effective_to = DATETIME('2999-12-31 23:59:59')"""
+    ) == [(0,)]
+    assert warehouse.rows(f"SELECT passport_num FROM DWH_CARD_ENRICHMENT WHERE card_num = '{CARD_2[0]}'") == [
+        ("0000 000002",)
+    ]
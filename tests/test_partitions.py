@@ -0,0 +1,44 @@
+# trans_id, trans_date, card_num, oper_type, amt, oper_result, terminal
+MARCH = ("1", "2021-03-01 10:00:00", "1111 0000 0000 0001", "PAYMENT", 100.0, "SUCCESS", "P0001")
+APRIL = ("2", "2021-04-01 10:00:00", "1111 0000 0000 0001", "PAYMENT", 200.0, "SUCCESS", "P0001")
+
+# the trans_id of MARCH in another month with another amount
+CONFLICT = ("1", "2021-04-02 10:00:00", "1111 0000 0000 0001", "PAYMENT", 300.0, "SUCCESS", "P0001")
+
+
+def test_loaded_trans_id_goes_to_conflicts(warehouse):
+    warehouse.load_day("01032021", [MARCH])
+    warehouse.load_day("02042021", [APRIL, CONFLICT])
+
+    assert sorted(warehouse.rows("SELECT trans_id, partition_name FROM META_LOADED_TRANSACTIONS")) == [
+        ("1", "DWH_FACT_TRANSACTIONS_202103"),
+        ("2", "DWH_FACT_TRANSACTIONS_202104")
+    ]
+    assert warehouse.rows("SELECT amt FROM DWH_FACT_TRANSACTIONS WHERE trans_id = '1'") == [(100.0,)]
+    assert warehouse.rows("SELECT trans_id, amt FROM DWH_FACT_TRANSACTIONS_CONFLICTS") == [("1", 300.0)]
+
+
+def test_archived_trans_id_leaves_loaded_ids(warehouse, tmp_path):
+    warehouse.load_day("01032021", [MARCH])
+    warehouse.load_day("01042021", [APRIL])
+
+    warehouse.ps.archive_partitions(1, str(tmp_path))
+
+    assert warehouse.rows("SELECT trans_id FROM META_LOADED_TRANSACTIONS") == [("2",)]
+    assert warehouse.rows("SELECT trans_id FROM META_ARCHIVED_TRANSACTIONS") == [("1",)]
+
+    # an archived trans_id is ignored and not compared
+    warehouse.load_day("02042021", [CONFLICT])
+
+    assert warehouse.rows("SELECT trans_id FROM DWH_FACT_TRANSACTIONS") == [("2",)]
+    assert warehouse.rows("SELECT trans_id FROM DWH_FACT_TRANSACTIONS_CONFLICTS") == []
+
+
+def test_detection_skips_months_before_scope(warehouse):
+    warehouse.load_day("01032021", [MARCH])
+    warehouse.load_day("01042021", [APRIL])
+
+    traced = list(warehouse.etl_tools.TRACED_STATEMENTS)
+
+    assert any("INSERT INTO STG_DETECTION_HISTORY" in sql and "DWH_FACT_TRANSACTIONS_202104" in sql for sql in traced)
+    assert not any("DWH_FACT_TRANSACTIONS_202103" in sql for sql in traced)
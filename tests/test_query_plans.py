@@ -0,0 +1,87 @@
+# Import dependencies
+import pytest
+
+# DETECTORS of py_scripts, the package is imported by the fixture
+DETECTORS = ["sql", "vectorized", "stream"]
+
+CARDS = [
+    ("1111 0000 0000 0001", "40817810000000000001", "2021-01-01", None),
+    ("1111 0000 0000 0002", "40817810000000000002", "2021-01-01", None)
+]
+
+ACCOUNTS = [
+    ("40817810000000000001", "2022-01-01", 1, "2021-01-01", None),
+    ("40817810000000000002", "2022-01-01", 2, "2021-01-01", None)
+]
+
+CLIENTS = [
+    (1, "Иванов", "Иван", "Иванович", "1980-01-01", "0000 000001", None, "+7 900 000-00-01", "2021-01-01", None),
+    (2, "Петров", "Петр", "Петрович", "1980-01-01", "0000 000002", "2022-01-01", "+7 900 000-00-02", "2021-01-01", None)
+]
+
+TERMINALS = [
+    ("P0001", "POS", "Москва", "ул. Ленина, 1"),
+    ("A0002", "ATM", "Казань", "ул. Баумана, 2")
+]
+
+# trans_id, trans_date, card_num, oper_type, amt, oper_result, terminal
+TRANSACTIONS = {
+    "01032021": [
+        ("1", "2021-03-01 10:00:00", "1111 0000 0000 0001", "PAYMENT", 100.0, "SUCCESS", "P0001"),
+        ("2", "2021-03-01 11:00:00", "1111 0000 0000 0002", "PAYMENT", 200.0, "SUCCESS", "P0001")
+    ],
+    "02032021": [
+        ("3", "2021-03-02 10:00:00", "1111 0000 0000 0001", "PAYMENT", 300.0, "REJECT", "P0001"),
+        ("4", "2021-03-02 10:10:00", "1111 0000 0000 0001", "PAYMENT", 200.0, "SUCCESS", "A0002"),
+        ("5", "2021-03-02 11:00:00", "1111 0000 0000 0002", "WITHDRAW", 50.0, "SUCCESS", "A0002")
+    ]
+}
+
+PASSPORT_BLACKLIST = {
+    "01032021": [],
+    "02032021": [("0000 000002", "2021-03-02")]
+}
+
+
+@pytest.fixture(scope="module")
+def first_day(etl):
+    """
+    - Fixture database with the snapshot and the first day loaded
+    - Returns the full scans of the first day
+    """
+
+    etl.reset()
+
+    _, scans = etl.load_day(
+        "01032021", TRANSACTIONS["01032021"], (CARDS, ACCOUNTS, CLIENTS), PASSPORT_BLACKLIST["01032021"], TERMINALS
+    )
+
+    return scans
+
+
+def test_first_day_without_history_scans(first_day):
+    assert first_day == {}
+
+
+@pytest.mark.parametrize("detector", DETECTORS)
+def test_day_without_history_scans(etl, first_day, detector):
+    # every detector loads the same day, the day is rolled back
+    _, scans = etl.load_day(
+        "02032021", TRANSACTIONS["02032021"], passport_blacklist=PASSPORT_BLACKLIST["02032021"],
+        terminals=TERMINALS, detector=detector, commit=False,
+        # a changed account of the snapshot
+        statements=["UPDATE accounts SET valid_to = '2021-03-02', update_dt = '2021-03-02' WHERE client = 1"]
+    )
+
+    assert scans == {}
+
+
+def test_history_scans_are_reported(etl, first_day):
+    # the closed versions and every partition are read
+    assert etl.etl_tools.full_scans("SELECT * FROM DWH_DIM_CARDS_HIST WHERE deleted_flg = 1")
+    assert etl.etl_tools.full_scans("SELECT t1.card_num FROM DWH_FACT_TRANSACTIONS t1")
+
+    # the partial index of the current versions
+    assert not etl.etl_tools.full_scans(
+        "SELECT card_num FROM DWH_DIM_CARDS_HIST WHERE effective_to = DATETIME('2999-12-31 23:59:59')"
+    )
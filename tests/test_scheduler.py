@@ -0,0 +1,30 @@
+# Import dependencies
+import pytest
+
+
+def count_blacklist(connection) -> int:
+    return connection.execute("SELECT COUNT(*) FROM DWH_FACT_PASSPORT_BLACKLIST").fetchone()[0]
+
+
+def test_worker_reads_committed_warehouse(warehouse):
+    from py_scripts.etl_scheduler import run_stages
+
+    results = {}
+
+    with warehouse.ps.transaction():
+        warehouse.cursor.execute("INSERT INTO DWH_FACT_PASSPORT_BLACKLIST VALUES ('0000 000001', '2021-03-01')")
+
+        timings = run_stages({
+            "WORKER": (lambda result: results.update(worker=result), [], count_blacklist),
+            "DAY": (lambda: results.update(day=count_blacklist(warehouse.conn)), [])
+        })
+
+    assert results == {"worker": 0, "day": 1}
+    assert set(timings) == {"WORKER", "DAY"}
+
+
+def test_compute_with_dependencies_is_rejected(warehouse):
+    from py_scripts.etl_scheduler import order_stages
+
+    with pytest.raises(ValueError):
+        order_stages({"A": (print, []), "B": (print, ["A"], count_blacklist)})
@@ -0,0 +1,98 @@
+# Import dependencies
+import pytest
+
+# DETECTORS of py_scripts, the package is imported by the fixture
+DETECTORS = ["sql", "vectorized", "stream"]
+
+CARD = "1111 0000 0000 0001"
+
+SNAPSHOT = (
+    [(CARD, "40817810000000000001", "2021-01-01", None)],
+    [("40817810000000000001", "2022-01-01", 1, "2021-01-01", None)],
+    [(1, "Иванов", "Иван", "Иванович", "1980-01-01", "0000 000001", None, "+7 900 000-00-01", "2021-01-01", None)]
+)
+
+
+def stage_operations(operations: list) -> list:
+    """
+    - Rows of STG_TRANSACTIONS from (trans_date, amt, oper_result)
+    """
+
+    return [
+        (str(number), trans_date, CARD, "PAYMENT", amt, oper_result, "P0001")
+        for number, (trans_date, amt, oper_result) in enumerate(operations)
+    ]
+
+
+def sum_up_events(warehouse, detector: str, operations: list) -> list:
+    """
+    - event_dt of the sum up events of one day
+    """
+
+    events, _ = warehouse.load_day("01032021", stage_operations(operations), SNAPSHOT, detector=detector)
+
+    return sorted(event_dt for event_dt, *_, event_type in events.elements() if event_type == "4")
+
+
+@pytest.mark.parametrize("detector", DETECTORS)
+@pytest.mark.parametrize("rejected, expected", [(2, []), (3, ["2021-03-01 10:15:00"]), (4, ["2021-03-01 10:15:00"])])
+def test_chain_length(warehouse, detector, rejected, expected):
+    # SUM_UP_CHAIN rejected operations with decreasing amounts or more
+    operations = [
+        (f"2021-03-01 10:1{number}:00", 800.0 - number * 100, "REJECT")
+        for number in range(4 - rejected, 4)
+    ]
+
+    assert sum_up_events(warehouse, detector, operations + [("2021-03-01 10:15:00", 100.0, "SUCCESS")]) == expected
+
+
+@pytest.mark.parametrize("detector", DETECTORS)
+def test_not_decreasing_reject_breaks_the_run(warehouse, detector):
+    # the run starts again at 600
+    assert sum_up_events(warehouse, detector, [
+        ("2021-03-01 10:00:00", 500.0, "REJECT"),
+        ("2021-03-01 10:01:00", 400.0, "REJECT"),
+        ("2021-03-01 10:02:00", 600.0, "REJECT"),
+        ("2021-03-01 10:03:00", 300.0, "REJECT"),
+        ("2021-03-01 10:04:00", 200.0, "SUCCESS")
+    ]) == []
+
+
+@pytest.mark.parametrize("detector", DETECTORS)
+@pytest.mark.parametrize("success, expected", [("10:20:00", ["2021-03-01 10:20:00"]), ("10:20:01", [])])
+def test_window(warehouse, detector, success, expected):
+    # the first operation of the chain at most SUM_UP_WINDOW = 1200 seconds before the successful one
+    assert sum_up_events(warehouse, detector, [
+        ("2021-03-01 10:00:00", 500.0, "REJECT"),
+        ("2021-03-01 10:05:00", 400.0, "REJECT"),
+        ("2021-03-01 10:10:00", 300.0, "REJECT"),
+        (f"2021-03-01 {success}", 200.0, "SUCCESS")
+    ]) == expected
+
+
+def test_rule_follows_chain_and_window(warehouse):
+    from py_scripts import etl_data_mart
+
+    warehouse.load_day("01032021", stage_operations([
+        ("2021-03-01 10:00:00", 500.0, "REJECT"),
+        ("2021-03-01 10:30:00", 400.0, "REJECT"),
+        ("2021-03-01 10:40:00", 300.0, "SUCCESS")
+    ]), SNAPSHOT)
+
+    counts = []
+
+    # the day is evaluated again with every chain and window, the changes are rolled back
+    warehouse.cursor.execute("BEGIN IMMEDIATE")
+    try:
+        warehouse.ps.load_sql_db("etl_schema")
+        warehouse.ps.load_dim_fact_tables()
+
+        for chain, window in [(3, 1200), (2, 1200), (2, 2400)]:
+            warehouse.cursor.execute("DELETE FROM STG_REP_FRAUD")
+            etl_data_mart.create_detection_scope("01032021", window=window)
+            etl_data_mart.detection_sum_up_fraud(chain, window)
+            counts.append(warehouse.rows("SELECT COUNT(*) FROM STG_REP_FRAUD")[0][0])
+    finally:
+        warehouse.cursor.execute("ROLLBACK")
+
+    assert counts == [0, 0, 1]